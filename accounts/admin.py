@@ -1,4 +1,46 @@
 from django.contrib import admin
-from .models import CustomUser
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.forms import UserChangeForm, UserCreationForm
+from pages.admin import LargeTableAdmin
+from .models import CustomUser, Profile
 
-admin.site.register(CustomUser)
+
+class CustomUserCreationForm(UserCreationForm):
+    class Meta(UserCreationForm.Meta):
+        model = CustomUser
+        fields = ('email',)
+
+
+class CustomUserChangeForm(UserChangeForm):
+    class Meta(UserChangeForm.Meta):
+        model = CustomUser
+
+
+@admin.register(CustomUser)
+class CustomUserAdmin(LargeTableAdmin, UserAdmin):
+    form = CustomUserChangeForm
+    add_form = CustomUserCreationForm
+    list_display = ('id', 'email', 'first_name', 'last_name', 'is_active', 'is_staff')
+    list_filter = ('is_active', 'is_staff', 'is_superuser')
+    search_fields = ('email__startswith',)
+    ordering = ('-pk',)
+    filter_horizontal = ('groups', 'user_permissions')
+    fieldsets = (
+        (None, {'fields': ('email', 'password')}),
+        ('Personal info', {'fields': ('first_name', 'last_name')}),
+        ('Permissions', {'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions')}),
+        ('Important dates', {'fields': ('last_login',)}),
+    )
+    add_fieldsets = (
+        (None, {'classes': ('wide',), 'fields': ('email', 'password1', 'password2')}),
+    )
+
+
+@admin.register(Profile)
+class ProfileAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'full_name', 'phone_number', 'birth_date', 'gender')
+    list_filter = ('gender',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    search_fields = ('user__email__startswith',)
+    search_id_fields = ('pk', 'user_id')
@@ -0,0 +1,183 @@
+"""
+Medication adherence.
+
+Patients record each scheduled dose of a ``Medication2`` as taken or missed
+(``record()``), and ``record_missed()`` marks the doses nobody recorded once
+``ADHERENCE_GRACE_MINUTES`` have passed.  Doses are scheduled at the
+medication's active reminder times, or at its timing's usual hour without
+reminders, on each day of its course.
+
+Adherence is never computed by counting events: every change adjusts the
+counters on the medication and on the patient's ``UserAdherence`` in the
+same transaction, and the patient's doctor summaries are refreshed from
+those.  Changes to one medication's events hold a lock on its row, so the
+counters can't drift when a patient and the missed-dose job race.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import summaries
+from .models import DoseEvent, Medication2, UserAdherence
+
+CHUNK_SIZE = 500
+
+# Dose times of medications without reminders.
+TIMING_TIMES = {
+    'morning': datetime.time(8),
+    'afternoon': datetime.time(14),
+    'evening': datetime.time(19),
+    'night': datetime.time(22),
+}
+
+
+def _grace():
+    return datetime.timedelta(minutes=getattr(settings, 'ADHERENCE_GRACE_MINUTES', 120))
+
+
+def _adjust(medication, using, taken, missed):
+    """Add to the dose counters of ``medication`` and its patient."""
+    if not (taken or missed):
+        return
+    Medication2.objects.using(using).filter(pk=medication.pk).update(
+        doses_taken=F('doses_taken') + taken, doses_missed=F('doses_missed') + missed
+    )
+    UserAdherence.objects.using(using).bulk_create([UserAdherence(user_id=medication.user_id)], ignore_conflicts=True)
+    UserAdherence.objects.using(using).filter(user_id=medication.user_id).update(
+        doses_taken=F('doses_taken') + taken, doses_missed=F('doses_missed') + missed, updated_at=timezone.now()
+    )
+    transaction.on_commit(
+        lambda: summaries.refresh(medication.user_id, ['adherence'], using=using), using=using
+    )
+
+
+def _lock(medication, using):
+    list(Medication2.objects.using(using).select_for_update().filter(pk=medication.pk).values_list('pk'))
+
+
+def record(medication, scheduled_at, taken, taken_at=None, using=None):
+    """Record a dose as taken or missed; returns ``(event, created)``."""
+    using = using or medication._state.db
+    if taken and taken_at is None:
+        taken_at = timezone.now()
+    with transaction.atomic(using=using):
+        _lock(medication, using)
+        event = DoseEvent.objects.using(using).filter(medication=medication, scheduled_at=scheduled_at).first()
+        if event is None:
+            event = DoseEvent.objects.using(using).create(
+                medication=medication, scheduled_at=scheduled_at, taken=taken, taken_at=taken_at if taken else None
+            )
+            _adjust(medication, using, int(taken), int(not taken))
+            return event, True
+        change = int(taken) - int(event.taken)
+        event.taken = taken
+        event.taken_at = taken_at if taken else None
+        event.save(using=using, update_fields=['taken', 'taken_at'])
+        _adjust(medication, using, change, -change)
+        return event, False
+
+
+def remove(event, using=None):
+    """Delete a dose event and take it out of the counters."""
+    using = using or event._state.db
+    medication = event.medication
+    with transaction.atomic(using=using):
+        _lock(medication, using)
+        if DoseEvent.objects.using(using).filter(pk=event.pk).delete()[0]:
+            _adjust(medication, using, -int(event.taken), -int(not event.taken))
+
+
+def medication_deleted(medication, using):
+    """Take a medication's doses out of its patient's counters before it is deleted."""
+    counts = Medication2.objects.using(using).filter(pk=medication.pk).values('doses_taken', 'doses_missed').first()
+    if not counts or not (counts['doses_taken'] or counts['doses_missed']):
+        return
+    UserAdherence.objects.using(using).filter(user_id=medication.user_id).update(
+        doses_taken=F('doses_taken') - counts['doses_taken'],
+        doses_missed=F('doses_missed') - counts['doses_missed'],
+        updated_at=timezone.now(),
+    )
+    transaction.on_commit(
+        lambda: summaries.refresh(medication.user_id, ['adherence'], using=using), using=using
+    )
+
+
+def course_end(medication):
+    return medication.created_at + datetime.timedelta(days=medication.duration_days)
+
+
+def schedule(medication, after, until, times=None):
+    """The medication's dose times in ``(after, until]``, oldest first."""
+    if times is None:
+        times = [reminder.reminder_time for reminder in medication.reminders.all() if reminder.is_active]
+    times = sorted(set(times or [TIMING_TIMES.get(medication.timing, TIMING_TIMES['morning'])]))
+    zone = timezone.get_default_timezone()
+    after = max(after, medication.created_at)
+    until = min(until, course_end(medication))
+    doses = []
+    day = timezone.localtime(after, zone).date()
+    last_day = timezone.localtime(until, zone).date()
+    while day <= last_day:
+        for at in times:
+            dose = datetime.datetime.combine(day, at, tzinfo=zone)
+            if after < dose <= until:
+                doses.append(dose)
+        day += datetime.timedelta(days=1)
+    return doses
+
+
+def is_scheduled(medication, at):
+    return schedule(medication, at - datetime.timedelta(seconds=1), at) == [at]
+
+
+def _record_missed_for(medication, using, cutoff):
+    checked = medication.doses_checked_through or medication.created_at
+    due = schedule(medication, checked, cutoff)
+    through = min(cutoff, course_end(medication))
+    with transaction.atomic(using=using):
+        _lock(medication, using)
+        recorded = set(
+            DoseEvent.objects.using(using)
+            .filter(medication=medication, scheduled_at__gt=checked, scheduled_at__lte=through)
+            .values_list('scheduled_at', flat=True)
+        )
+        missed = [
+            DoseEvent(medication=medication, scheduled_at=dose, taken=False)
+            for dose in due if dose not in recorded
+        ]
+        DoseEvent.objects.using(using).bulk_create(missed)
+        _adjust(medication, using, 0, len(missed))
+        Medication2.objects.using(using).filter(pk=medication.pk).update(doses_checked_through=through)
+    return len(missed)
+
+
+def record_missed(using, now=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Mark every unrecorded dose on shard ``using`` that is past the grace
+    period as missed, from where the last run stopped.  Returns the number
+    of doses marked.
+    """
+    cutoff = (now or timezone.now()) - _grace()
+    medications = (
+        Medication2.objects.using(using)
+        .filter(created_at__lt=cutoff)
+        .prefetch_related('reminders')
+        .order_by('pk')
+    )
+    marked = 0
+    last_pk = 0
+    while True:
+        chunk = list(medications.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        for medication in chunk:
+            if medication.doses_checked_through and medication.doses_checked_through >= min(cutoff, course_end(medication)):
+                continue
+            marked += _record_missed_for(medication, using, cutoff)
+        if progress:
+            progress(using, marked)
+    return marked
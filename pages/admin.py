@@ -1,14 +1,448 @@
+import json
+import zlib
+
+from django.conf import settings
 from django.contrib import admin
-from . import models
-
-admin.site.register(models.UserFiles)
-admin.site.register(models.Allergy)
-admin.site.register(models.Medication)
-admin.site.register(models.HealthProblem)
-admin.site.register(models.LabReport)
-admin.site.register(models.Imaging)
-admin.site.register(models.Vaccination)
-admin.site.register(models.Medication2)
-admin.site.register(models.MedicationReminder)
-admin.site.register(models.Conversation)
-admin.site.register(models.Message)
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.functional import cached_property
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
+
+from . import models, profiling, sharding
+
+
+def planner_estimate(queryset):
+    """The PostgreSQL planner's estimate of how many rows ``queryset`` returns."""
+    queryset = queryset.order_by()
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counts exactly only when the planner expects fewer than
+    ``ADMIN_EXACT_COUNT_LIMIT`` rows; past that the estimate is used, so
+    opening a changelist over tens of millions of rows doesn't wait on
+    ``COUNT(*)``.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and connections[queryset.db].vendor == 'postgresql':
+            estimate = planner_estimate(queryset)
+            if estimate >= getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', 100000):
+                return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist defaults for tables too big to scan: pages in primary key
+    order, counts via ``EstimatedCountPaginator``, and searches that only
+    use indexes.  A numeric search term matches ``search_id_fields``
+    exactly; anything else goes to ``search_fields``, which should be exact
+    or ``startswith`` lookups on indexed columns.  Foreign keys belong in
+    ``raw_id_fields`` and related columns in ``list_select_related``.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-pk',)
+    search_id_fields = ('pk',)
+    search_help_text = 'An ID, or the start of an email address.'
+
+    def get_search_fields(self, request):
+        # Non-empty so the search box shows even when only ids are searchable.
+        return super().get_search_fields(request) or self.search_id_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if term.isdigit() and self.search_id_fields:
+            query = Q()
+            for field in self.search_id_fields:
+                query |= Q(**{field: int(term)})
+            return queryset.filter(query), False
+        if not self.search_fields:
+            return (queryset.none() if term else queryset), False
+        return super().get_search_results(request, queryset, term)
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in sharding.shard_aliases()]
+
+    def queryset(self, request, queryset):
+        if self.value() in sharding.shard_aliases():
+            return queryset.using(self.value())
+        return queryset
+
+
+class ShardedModelAdmin(LargeTableAdmin):
+    """Browses one shard at a time and finds objects on whichever shard holds them."""
+
+    def get_list_filter(self, request):
+        list_filter = list(super().get_list_filter(request))
+        if sharding.is_sharded():
+            list_filter.insert(0, ShardListFilter)
+        return list_filter
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if sharding.is_sharded():
+            return queryset.using(request.GET.get('shard') or sharding.shard_aliases()[0])
+        return queryset
+
+    def get_object(self, request, object_id, from_field=None):
+        if not sharding.is_sharded():
+            return super().get_object(request, object_id, from_field)
+        queryset = super().get_queryset(request)
+        field = self.model._meta.get_field(from_field) if from_field else self.model._meta.pk
+        try:
+            object_id = field.to_python(object_id)
+        except (ValidationError, ValueError):
+            return None
+        for obj in sharding.fan_out_queryset(queryset.filter(**{field.name: object_id})):
+            return obj
+        return None
+
+
+class UserFilesAdmin(ShardedModelAdmin):
+    list_display = ('id', 'user', 'height', 'weight', 'heart_rate', 'blood_pressure', 'updated_at')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    search_fields = ('user__email__startswith',)
+    search_id_fields = ('pk', 'user_id')
+
+
+class UserRecordAdmin(ShardedModelAdmin):
+    """Records that belong to one patient through a ``user`` foreign key."""
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    search_fields = ('user__email__startswith',)
+    search_id_fields = ('pk', 'user_id')
+
+
+class AllergyAdmin(UserRecordAdmin):
+    list_display = ('id', 'title', 'user', 'start_date', 'end_date', 'is_passed', 'updated_at')
+    list_filter = ('is_passed',)
+
+
+class MedicationAdmin(UserRecordAdmin):
+    list_display = ('id', 'name', 'dosage', 'user', 'start_date', 'end_date', 'is_passed', 'updated_at')
+    list_filter = ('is_passed',)
+
+
+class HealthProblemAdmin(UserRecordAdmin):
+    list_display = ('id', 'title', 'user', 'diagnosis_date', 'resolved', 'updated_at')
+    list_filter = ('resolved',)
+
+
+class LabReportAdmin(UserRecordAdmin):
+    list_display = ('id', 'user', 'report_date', 'extraction_status', 'updated_at')
+    list_filter = ('extraction_status',)
+
+
+class ImagingAdmin(UserRecordAdmin):
+    list_display = ('id', 'imaging_type', 'user', 'imaging_date', 'updated_at')
+
+
+class VaccinationAdmin(UserRecordAdmin):
+    list_display = ('id', 'name', 'user', 'date_administered', 'next_dose_date', 'updated_at')
+
+
+class VaccinationRecallAdmin(ShardedModelAdmin):
+    list_display = ('id', 'vaccination', 'due_date', 'notified_at')
+    list_select_related = ('vaccination',)
+    raw_id_fields = ('vaccination',)
+    search_id_fields = ('pk', 'vaccination_id', 'vaccination__user_id')
+    search_help_text = 'A recall, vaccination or patient ID.'
+
+
+class Medication2Admin(UserRecordAdmin):
+    list_display = ('id', 'name', 'timing', 'user', 'adherence', 'created_at')
+    list_filter = ('timing',)
+    readonly_fields = ('doses_taken', 'doses_missed', 'doses_checked_through')
+
+
+class PregnancyAdmin(UserRecordAdmin):
+    list_display = ('id', 'user', 'start_date', 'created_at')
+
+
+class AIChatSessionAdmin(UserRecordAdmin):
+    list_display = ('id', 'title', 'user', 'summarized_through', 'updated_at')
+
+
+class HealthInsightAdmin(UserRecordAdmin):
+    list_display = ('id', 'user', 'covers_until', 'generated_at')
+
+
+class NoteEmbeddingAdmin(UserRecordAdmin):
+    list_display = ('id', 'user', 'source', 'object_id', 'embedder', 'updated_at')
+    list_filter = ('source',)
+    search_id_fields = ('pk', 'user_id', 'object_id')
+    exclude = ('vector',)
+
+
+class LabResultAdmin(UserRecordAdmin):
+    list_display = ('id', 'user', 'analyte', 'value_text', 'unit', 'flag', 'observed_on')
+    list_filter = ('flag',)
+    raw_id_fields = ('user', 'report')
+    search_id_fields = ('pk', 'user_id', 'report_id')
+
+
+class VitalsBatchAdmin(UserRecordAdmin):
+    list_display = ('id', 'user', 'signal', 'device', 'starts_at', 'ends_at', 'count', 'mean')
+    list_filter = ('signal',)
+    exclude = ('offsets', 'values')
+
+
+class MedicationReminderAdmin(ShardedModelAdmin):
+    list_display = ('id', 'medication', 'reminder_time', 'is_active', 'created_at')
+    list_filter = ('is_active',)
+    list_select_related = ('medication',)
+    raw_id_fields = ('medication',)
+    search_fields = ('medication__user__email__startswith',)
+    search_id_fields = ('pk', 'medication_id', 'medication__user_id')
+
+
+class DoseEventAdmin(ShardedModelAdmin):
+    list_display = ('id', 'medication', 'scheduled_at', 'taken', 'taken_at')
+    list_filter = ('taken',)
+    list_select_related = ('medication',)
+    raw_id_fields = ('medication',)
+    search_fields = ('medication__user__email__startswith',)
+    search_id_fields = ('pk', 'medication_id', 'medication__user_id')
+
+    # Events change through adherence.py, which keeps the counters.
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class UserAdherenceAdmin(UserRecordAdmin):
+    list_display = ('user', 'doses_taken', 'doses_missed', 'adherence', 'updated_at')
+    readonly_fields = ('doses_taken', 'doses_missed')
+
+
+class ConversationAdmin(ShardedModelAdmin):
+    list_display = ('id', 'patient', 'doctor', 'created_at')
+    list_select_related = ('patient', 'doctor')
+    raw_id_fields = ('patient', 'doctor')
+    search_fields = ('patient__email__startswith', 'doctor__email__startswith')
+    search_id_fields = ('pk', 'patient_id', 'doctor_id')
+
+
+class MessageAdmin(ShardedModelAdmin):
+    list_display = ('id', 'conversation_id', 'sender', 'timestamp')
+    list_select_related = ('sender',)
+    raw_id_fields = ('conversation', 'sender')
+    search_fields = ('sender__email__startswith',)
+    search_id_fields = ('pk', 'conversation_id')
+
+
+class MessageArchiveAdmin(MessageAdmin):
+    pass
+
+
+class PatientSummaryAdmin(LargeTableAdmin):
+    list_display = ('id', 'patient_name', 'patient_email', 'doctor', 'last_message_at', 'vitals_updated_at')
+    list_select_related = ('doctor',)
+    raw_id_fields = ('doctor', 'patient')
+    search_fields = ('doctor__email__startswith',)
+    search_id_fields = ('pk', 'patient_id', 'doctor_id')
+
+
+class VitalsAlertAdmin(ShardedModelAdmin):
+    list_display = ('rule', 'severity', 'value', 'conversation', 'occurrences', 'suppressed', 'created_at', 'resolved_at')
+    list_filter = ('severity', 'rule', 'suppressed')
+    list_select_related = ('conversation__patient', 'conversation__doctor')
+    raw_id_fields = ('conversation',)
+    search_fields = ('conversation__patient__email__startswith',)
+    search_id_fields = ('pk', 'conversation_id', 'conversation__patient_id')
+
+
+class PatientShardAdmin(LargeTableAdmin):
+    list_display = ('user', 'shard', 'placed_at', 'moved_at')
+    list_filter = ('shard',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    search_fields = ('user__email__startswith',)
+    search_id_fields = ('pk', 'user_id')
+
+
+class InsightRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'since', 'until', 'total', 'succeeded', 'failed', 'started_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('last_user_id', 'total', 'succeeded', 'failed', 'errors')
+
+
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'format', 'resource', 'status', 'progress', 'rows_imported', 'rows_failed', 'created_at')
+    list_filter = ('status', 'format')
+    readonly_fields = ('total_bytes', 'bytes_done', 'rows_read', 'rows_imported', 'rows_failed', 'rows_skipped', 'errors')
+
+
+class AccountDeletionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user_id', 'status', 'files_queued', 'requested_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('=user_id',)
+    readonly_fields = ('user_id', 'rows_deleted', 'files_queued', 'error', 'finished_at')
+
+
+class DeletedFileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'field', 'attempts', 'created_at')
+    list_filter = ('field',)
+    readonly_fields = ('last_error',)
+
+
+class AuditEventAdmin(LargeTableAdmin):
+    list_display = ('timestamp', 'actor_id', 'action', 'resource', 'object_id', 'patient_id', 'status_code', 'ip_address')
+    list_filter = ('action',)
+    search_id_fields = ('pk', 'patient_id', 'actor_id')
+    search_help_text = 'An event, patient or actor ID.'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class RequestProfileAdmin(LargeTableAdmin):
+    list_display = ('created_at', 'method', 'path', 'view', 'status_code', 'duration_ms', 'query_count', 'query_ms', 'trigger')
+    list_filter = ('trigger', 'method')
+    search_fields = ('view__startswith',)
+    search_id_fields = ('pk', 'user_id')
+    search_help_text = 'A profile or user ID, or the start of a view name such as ConversationViewSet.'
+    fields = (
+        'created_at', 'method', 'path', 'view', 'status_code', 'user_id', 'trigger', 'duration_ms',
+        'samples', 'interval_ms', 'flame_graph', 'query_count', 'query_ms', 'slowest_queries',
+    )
+    readonly_fields = fields
+
+    # Frames under this share of the samples are left out of the flame graph.
+    MIN_SHARE = 0.005
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/collapsed/', self.admin_site.admin_view(self.collapsed), name='pages_requestprofile_collapsed'),
+            *super().get_urls(),
+        ]
+
+    def collapsed(self, request, pk):
+        """The raw collapsed stacks, for flamegraph.pl or speedscope."""
+        profile = get_object_or_404(models.RequestProfile, pk=pk)
+        response = HttpResponse(profile.stacks + '\n', content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{pk}.folded"'
+        return response
+
+    def _flames(self, nodes, parent, total):
+        rows = []
+        for frame, (count, children) in sorted(nodes.items(), key=lambda item: -item[1][0]):
+            if count < total * self.MIN_SHARE:
+                continue
+            rows.append(
+                '<div class="flame" style="flex: 0 0 {width:.2f}%" title="{title}">'
+                '<div class="frame" style="background: hsl({hue}, 70%, 65%)">{frame}</div>'
+                '<div class="flames">{children}</div></div>'.format(
+                    width=100 * count / parent,
+                    title=escape(f"{frame}: {count} samples ({100 * count / total:.1f}%)"),
+                    # Warm colours, one per file.
+                    hue=zlib.crc32(frame.rpartition('(')[2].split(':')[0].encode()) % 60,
+                    frame=escape(frame),
+                    children=self._flames(children, count, total),
+                )
+            )
+        return ''.join(rows)
+
+    @admin.display(description='Flame graph')
+    def flame_graph(self, obj):
+        if not obj.stacks:
+            return 'No samples: the request finished within one sampling interval.'
+        nodes = profiling.tree(obj.stacks)
+        total = sum(count for count, _ in nodes.values())
+        return format_html(
+            '<style>'
+            '.flames {{ display: flex; width: 100%; }}'
+            '.flame {{ min-width: 0; }}'
+            '.frame {{ font: 11px monospace; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;'
+            ' border: 1px solid #fff; padding: 1px 2px; }}'
+            '</style>'
+            '<div style="width: 100%; min-width: 800px;"><div class="flames">{}</div></div>'
+            '<p><a href="{}">Download collapsed stacks</a></p>',
+            mark_safe(self._flames(nodes, total, total)),
+            reverse('admin:pages_requestprofile_collapsed', args=[obj.pk]),
+        )
+
+    @admin.display(description='Slowest queries')
+    def slowest_queries(self, obj):
+        rows = ''.join(
+            format_html(
+                '<tr><td>{}</td><td>{}</td><td>{}</td><td><code>{}</code></td></tr>',
+                query['count'], query['ms'], query['database'], query['sql'],
+            )
+            for query in obj.queries
+        )
+        return format_html(
+            '<table><tr><th>Count</th><th>ms</th><th>Database</th><th>SQL</th></tr>{}</table>', mark_safe(rows)
+        )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(models.UserFiles, UserFilesAdmin)
+admin.site.register(models.Allergy, AllergyAdmin)
+admin.site.register(models.Medication, MedicationAdmin)
+admin.site.register(models.HealthProblem, HealthProblemAdmin)
+admin.site.register(models.LabReport, LabReportAdmin)
+admin.site.register(models.Imaging, ImagingAdmin)
+admin.site.register(models.Vaccination, VaccinationAdmin)
+admin.site.register(models.VaccinationRecall, VaccinationRecallAdmin)
+admin.site.register(models.Medication2, Medication2Admin)
+admin.site.register(models.MedicationReminder, MedicationReminderAdmin)
+admin.site.register(models.DoseEvent, DoseEventAdmin)
+admin.site.register(models.UserAdherence, UserAdherenceAdmin)
+admin.site.register(models.Pregnancy, PregnancyAdmin)
+admin.site.register(models.AIChatSession, AIChatSessionAdmin)
+admin.site.register(models.HealthInsight, HealthInsightAdmin)
+admin.site.register(models.NoteEmbedding, NoteEmbeddingAdmin)
+admin.site.register(models.LabResult, LabResultAdmin)
+admin.site.register(models.VitalsBatch, VitalsBatchAdmin)
+admin.site.register(models.Conversation, ConversationAdmin)
+admin.site.register(models.Message, MessageAdmin)
+admin.site.register(models.MessageArchive, MessageArchiveAdmin)
+admin.site.register(models.PatientSummary, PatientSummaryAdmin)
+admin.site.register(models.VitalsAlert, VitalsAlertAdmin)
+admin.site.register(models.PatientShard, PatientShardAdmin)
+admin.site.register(models.ImportJob, ImportJobAdmin)
+admin.site.register(models.InsightRun, InsightRunAdmin)
+admin.site.register(models.AuditEvent, AuditEventAdmin)
+admin.site.register(models.AccountDeletion, AccountDeletionAdmin)
+admin.site.register(models.DeletedFile, DeletedFileAdmin)
+admin.site.register(models.RequestProfile, RequestProfileAdmin)
@@ -0,0 +1,213 @@
+"""
+AI chat sessions with bounded prompts.
+
+Every prompt carries the patient's latest vitals, the session's rolling
+summary, the turns not yet summarized and the new question.  Once the
+unsummarized turns pass ``AI_CHAT_RECENT_TOKENS``, the oldest are folded into
+the summary until about half that is left.  The fold is one extra LLM call
+every few turns; its result is stored on the session and reused by every
+prompt after it, so prompt size stays bounded however long the chat gets.
+Prompts never carry more than ``AI_CHAT_RECENT_TOKENS`` of recent turns,
+newest first, so they stay bounded even while a fold is late or has failed.
+
+The model is ``AI_CHAT_LLM``, a dotted path to a class with
+``generate(prompt) -> str``: ``GeminiLLM`` in production, ``StubLLM`` for
+tests and local development.
+"""
+import math
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+
+from . import lazy, sharding
+from .models import AIChatSession, AIChatTurn, UserFiles
+
+genai = lazy.module('google.generativeai')
+
+CHARS_PER_TOKEN = 4
+TITLE_LENGTH = 60
+
+
+def estimate_tokens(text):
+    """Rough token count; close enough for budgeting without a tokenizer."""
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+class GeminiLLM:
+    def __init__(self):
+        api_key = getattr(settings, 'GEMINI_API_KEY', '')
+        if not api_key:
+            raise ImproperlyConfigured("Set GEMINI_API_KEY to use the Gemini AI chat backend.")
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(getattr(settings, 'GEMINI_MODEL', 'gemini-2.0-flash'))
+
+    def generate(self, prompt):
+        return self.model.generate_content(prompt).text
+
+
+class StubLLM:
+    """Answers without a network call, recording the prompts it was given."""
+
+    def __init__(self):
+        self.prompts = []
+
+    def generate(self, prompt):
+        self.prompts.append(prompt)
+        if prompt.startswith(SUMMARY_INSTRUCTIONS):
+            return f"Summary of {prompt.count('Patient:')} patient messages."
+        question = prompt.rsplit('Patient Question:', 1)[-1].strip().splitlines()[0]
+        return f"Stub answer to: {question}"
+
+
+@lru_cache(maxsize=None)
+def get_llm():
+    return import_string(getattr(settings, 'AI_CHAT_LLM', 'pages.aichat.GeminiLLM'))()
+
+
+PROMPT = """
+You are a medical doctor. Respond to the patient's question below using their health data
+and the conversation so far. Maintain a professional but compassionate tone.
+
+Patient Data:
+{health}
+{history}
+Patient Question: {prompt}
+
+Doctor's Response:
+"""
+
+SUMMARY_INSTRUCTIONS = "Summarize this conversation between a patient and a doctor"
+
+
+def health_context(user):
+    record = UserFiles.objects.filter(user=user).order_by('-created_at').first()
+    if record is None:
+        return "- No health data recorded"
+    return "\n".join([
+        f"- Weight: {record.weight} kg",
+        f"- Height: {record.height} cm",
+        f"- Blood Pressure: {record.blood_pressure}",
+        f"- Blood Sugar: {record.blood_sugar_level} mg/dL",
+        f"- BMI: {record.body_mass_index}",
+    ])
+
+
+def _transcript(turns):
+    speakers = {'user': 'Patient', 'assistant': 'Doctor'}
+    return "\n".join(f"{speakers[turn.role]}: {turn.content}" for turn in turns)
+
+
+def recent(turns):
+    """
+    The newest of ``turns`` within ``AI_CHAT_RECENT_TOKENS``, so a fold that
+    is late or failed can't make the prompt grow.
+    """
+    budget = getattr(settings, 'AI_CHAT_RECENT_TOKENS', 1500)
+    start = len(turns)
+    while start > 0 and turns[start - 1].tokens <= budget:
+        start -= 1
+        budget -= turns[start].tokens
+    # Whole exchanges only, as in summarize().
+    while start < len(turns) and turns[start].role != 'user':
+        start += 1
+    return turns[start:]
+
+
+def build_prompt(session, prompt, turns):
+    turns = recent(turns)
+    history = ""
+    if session.summary:
+        history += f"\nEarlier in this conversation (summary):\n{session.summary}\n"
+    if turns:
+        history += f"\nRecent conversation:\n{_transcript(turns)}\n"
+    return PROMPT.format(health=health_context(session.user_id), history=history, prompt=prompt)
+
+
+def unsummarized(session):
+    return list(AIChatTurn.objects.filter(session=session, id__gt=session.summarized_through).order_by('id'))
+
+
+def ask(session, prompt, llm=None):
+    """Answer ``prompt`` in ``session``, store both turns and return the answer."""
+    llm = llm or get_llm()
+    answer = llm.generate(build_prompt(session, prompt, unsummarized(session)))
+    with transaction.atomic(using=session._state.db):
+        AIChatTurn.objects.create(session=session, role='user', content=prompt, tokens=estimate_tokens(prompt))
+        AIChatTurn.objects.create(session=session, role='assistant', content=answer, tokens=estimate_tokens(answer))
+        if not session.title:
+            session.title = prompt[:TITLE_LENGTH]
+        session.save(update_fields=['title', 'updated_at'])
+
+    if sum(turn.tokens for turn in unsummarized(session)) > getattr(settings, 'AI_CHAT_RECENT_TOKENS', 1500):
+        if getattr(settings, 'AI_CHAT_SUMMARIZE_IN_BACKGROUND', True):
+            _summarize_in_background(session.pk, session._state.db, llm)
+        else:
+            summarize(session, llm)
+    return answer
+
+
+def summarize(session, llm=None):
+    """
+    Fold the oldest unsummarized turns into the summary, leaving about half of
+    ``AI_CHAT_RECENT_TOKENS`` in recent turns.  Returns whether it did.
+    """
+    llm = llm or get_llm()
+    turns = unsummarized(session)
+    keep = getattr(settings, 'AI_CHAT_RECENT_TOKENS', 1500) // 2
+    kept = 0
+    split = len(turns)
+    while split > 0 and kept + turns[split - 1].tokens <= keep:
+        split -= 1
+        kept += turns[split].tokens
+    # Whole exchanges only, so the recent part never starts with an answer.
+    while split > 0 and turns[split - 1].role == 'user':
+        split -= 1
+    folded = turns[:split]
+    if not folded:
+        return False
+
+    limit = getattr(settings, 'AI_CHAT_SUMMARY_TOKENS', 300)
+    summary = llm.generate(
+        f"{SUMMARY_INSTRUCTIONS} in at most {limit * 3 // 4} words, keeping symptoms, "
+        f"medications, advice given and open questions.\n\n"
+        f"Summary so far:\n{session.summary or '(none)'}\n\n"
+        f"New turns:\n{_transcript(folded)}\n"
+    )
+    summary = summary[:limit * CHARS_PER_TOKEN]
+    # Only the first of two concurrent folds of the same turns is kept.
+    updated = AIChatSession.objects.using(session._state.db).filter(
+        pk=session.pk, summarized_through=session.summarized_through
+    ).update(summary=summary, summarized_through=folded[-1].pk)
+    if updated:
+        session.summary = summary
+        session.summarized_through = folded[-1].pk
+    return bool(updated)
+
+
+_summarizing = set()
+_summarizing_lock = threading.Lock()
+
+
+def _summarize_in_background(session_id, using, llm):
+    # One fold per session at a time in this process; later turns wait for it.
+    with _summarizing_lock:
+        if session_id in _summarizing:
+            return
+        _summarizing.add(session_id)
+
+    def target():
+        try:
+            with sharding.pinned_to(using):
+                session = AIChatSession.objects.filter(pk=session_id).first()
+                if session is not None:
+                    summarize(session, llm)
+        finally:
+            with _summarizing_lock:
+                _summarizing.discard(session_id)
+            close_old_connections()
+
+    threading.Thread(target=target, name=f"ai-chat-summary-{session_id}", daemon=True).start()
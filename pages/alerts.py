@@ -0,0 +1,234 @@
+"""
+Threshold alerts on vitals.
+
+Rules (``VITALS_ALERT_RULES``, ``DEFAULT_RULES`` unless overridden) are
+compiled once into per-field checks, so evaluating a reading costs a few
+comparisons.  Every vitals write is evaluated as it arrives; ``reevaluate``
+runs the same checks over existing rows in chunks, for backfills after the
+rules change.
+
+A rule that keeps firing updates its open alert instead of raising a new one,
+and the alert resolves once the reading is back in range.  New alerts go to
+each of the patient's doctors, one ``VitalsAlert`` per conversation.  Past
+``VITALS_ALERT_RATE_LIMIT`` new alerts per patient and window they are still
+recorded, but suppressed; a suppressed alert that is still firing is shown
+once a later window has room for it.
+"""
+import operator
+from functools import lru_cache
+from typing import Callable, NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Conversation, UserFiles, VitalsAlert
+
+CHUNK_SIZE = 2000
+
+# (name, field, operator, threshold, severity, message).  ``systolic`` and
+# ``diastolic`` are read from ``blood_pressure``; rules sharing a name raise
+# a single alert.
+DEFAULT_RULES = [
+    ('spo2_low', 'oxygen_saturation', '<', 90, 'critical', "Oxygen saturation below 90%"),
+    ('bp_crisis', 'systolic', '>', 180, 'critical', "Blood pressure above 180/120"),
+    ('bp_crisis', 'diastolic', '>', 120, 'critical', "Blood pressure above 180/120"),
+    ('blood_sugar_low', 'blood_sugar_level', '<', 54, 'critical', "Blood sugar below 54 mg/dL"),
+    ('blood_sugar_high', 'blood_sugar_level', '>', 400, 'critical', "Blood sugar above 400 mg/dL"),
+]
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+SEVERITY_ORDER = {'critical': 0, 'warning': 1}
+BLOOD_PRESSURE_FIELDS = ('systolic', 'diastolic')
+
+
+class Rule(NamedTuple):
+    name: str
+    field: str
+    test: Callable
+    threshold: float
+    severity: str
+    message: str
+
+
+class CompiledRules(NamedTuple):
+    by_field: dict   # field -> rules on that field
+    columns: tuple   # UserFiles columns the rules read
+
+
+@lru_cache(maxsize=None)
+def compiled_rules():
+    definitions = getattr(settings, 'VITALS_ALERT_RULES', None) or DEFAULT_RULES
+    by_field = {}
+    columns = set()
+    for name, field, op, threshold, severity, message in definitions:
+        if op not in OPERATORS:
+            raise ImproperlyConfigured(f"Unknown operator {op!r} in vitals alert rule {name!r}")
+        if severity not in SEVERITY_ORDER:
+            raise ImproperlyConfigured(f"Unknown severity {severity!r} in vitals alert rule {name!r}")
+        if field in BLOOD_PRESSURE_FIELDS:
+            columns.add('blood_pressure')
+        else:
+            UserFiles._meta.get_field(field)  # Fails early on a typo
+            columns.add(field)
+        by_field.setdefault(field, []).append(
+            Rule(name, field, OPERATORS[op], threshold, severity, message)
+        )
+    return CompiledRules(by_field, tuple(sorted(columns)))
+
+
+def _blood_pressure(reading):
+    systolic, _, diastolic = (reading or '').partition('/')
+    try:
+        return {'systolic': int(systolic), 'diastolic': int(diastolic)}
+    except ValueError:
+        return {}
+
+
+def evaluate(values):
+    """
+    Check one reading, a mapping of UserFiles column to value, and return
+    ``{rule name: (rule, displayed value)}`` for the rules it breaks.
+    """
+    rules = compiled_rules()
+    readings = dict(values)
+    if 'blood_pressure' in rules.columns:
+        readings.update(_blood_pressure(values.get('blood_pressure')))
+    triggered = {}
+    for field, field_rules in rules.by_field.items():
+        value = readings.get(field)
+        if value is None:
+            continue
+        for rule in field_rules:
+            if rule.name not in triggered and rule.test(value, rule.threshold):
+                shown = values['blood_pressure'] if field in BLOOD_PRESSURE_FIELDS else value
+                triggered[rule.name] = (rule, str(shown))
+    return triggered
+
+
+def _columns(user_files):
+    return {column: getattr(user_files, column) for column in compiled_rules().columns}
+
+
+def _allowance(patient_id, wanted):
+    """How many of ``wanted`` new alerts the patient's rate limit lets through."""
+    limit = getattr(settings, 'VITALS_ALERT_RATE_LIMIT', 5)
+    window = getattr(settings, 'VITALS_ALERT_RATE_WINDOW', 60 * 60)
+    key = f'pages:alerts:rate:{patient_id}'
+    cache.add(key, 0, window)
+    try:
+        used = cache.incr(key, wanted)
+    except ValueError:
+        # The counter expired between add() and incr().
+        cache.set(key, wanted, window)
+        used = wanted
+    return max(0, min(wanted, limit - (used - wanted)))
+
+
+def apply(results, using):
+    """
+    Raise, refresh or resolve alerts on shard ``using`` from
+    ``{patient_id: evaluate(...)}``.  Patients missing from ``results`` are
+    left alone.
+    """
+    if not results:
+        return
+    now = timezone.now()
+    alerts = VitalsAlert.objects.using(using)
+
+    open_rules = {}
+    refreshed = {}
+    resolved = []
+    held = {}  # patient_id -> {rule name: suppressed alerts still firing}
+    for pk, conversation_id, patient_id, rule, suppressed in alerts.filter(
+        conversation__patient_id__in=list(results), resolved_at__isnull=True,
+    ).values_list('pk', 'conversation_id', 'conversation__patient_id', 'rule', 'suppressed'):
+        open_rules.setdefault(conversation_id, set()).add(rule)
+        if rule in results[patient_id]:
+            refreshed.setdefault(results[patient_id][rule][1], []).append(pk)
+            if suppressed:
+                held.setdefault(patient_id, {}).setdefault(rule, []).append(pk)
+        else:
+            resolved.append(pk)
+    if resolved:
+        alerts.filter(pk__in=resolved).update(resolved_at=now)
+    for value, pks in refreshed.items():
+        alerts.filter(pk__in=pks).update(
+            value=value, last_seen_at=now, occurrences=F('occurrences') + 1
+        )
+
+    firing = [patient_id for patient_id, triggered in results.items() if triggered]
+    if not firing:
+        return
+    conversations = {}
+    for conversation_id, patient_id in Conversation.objects.using(using).filter(
+        patient_id__in=firing,
+    ).values_list('pk', 'patient_id'):
+        conversations.setdefault(patient_id, []).append(conversation_id)
+
+    new = []
+    released = []
+    for patient_id in firing:
+        rules = sorted(
+            (rule for rule, value in results[patient_id].values()),
+            key=lambda rule: SEVERITY_ORDER[rule.severity],
+        )
+        # A rule needs the allowance if any of the patient's doctors lacks
+        # it, or it is still held back from them.
+        rules = [
+            rule for rule in rules
+            if rule.name in held.get(patient_id, {})
+            or any(rule.name not in open_rules.get(c, ()) for c in conversations.get(patient_id, ()))
+        ]
+        if not rules:
+            continue
+        allowed = _allowance(patient_id, len(rules))
+        for position, rule in enumerate(rules):
+            if position < allowed:
+                released.extend(held.get(patient_id, {}).get(rule.name, ()))
+            value = results[patient_id][rule.name][1]
+            for conversation_id in conversations[patient_id]:
+                if rule.name in open_rules.get(conversation_id, ()):
+                    continue
+                new.append(VitalsAlert(
+                    conversation_id=conversation_id,
+                    rule=rule.name,
+                    severity=rule.severity,
+                    message=rule.message,
+                    value=value,
+                    suppressed=position >= allowed,
+                ))
+    if released:
+        alerts.filter(pk__in=released).update(suppressed=False)
+    # A concurrent write may have opened the same alert; the partial unique
+    # constraint keeps one.
+    alerts.bulk_create(new, ignore_conflicts=True)
+
+
+def vitals_saved(user_files, using=None):
+    """Evaluate one vitals write."""
+    apply({user_files.user_id: evaluate(_columns(user_files))}, using or user_files._state.db)
+
+
+def vitals_written(objs, using):
+    """Evaluate a batch of vitals written together, e.g. by ``bulk_create``."""
+    apply({obj.user_id: evaluate(_columns(obj)) for obj in objs}, using)
+
+
+def reevaluate(using, chunk_size=CHUNK_SIZE, progress=None):
+    """Re-check every vitals row on shard ``using``; returns the rows seen."""
+    columns = compiled_rules().columns
+    rows = UserFiles.objects.using(using).order_by('pk').values('pk', 'user_id', *columns)
+    last_pk = 0
+    seen = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return seen
+        last_pk = chunk[-1]['pk']
+        apply({row['user_id']: evaluate(row) for row in chunk}, using)
+        seen += len(chunk)
+        if progress:
+            progress(seen)
@@ -0,0 +1,225 @@
+"""
+Population analytics over vitals: BMI and BSA distributions, blood pressure
+buckets and SpO2 outliers, broken down by age band and gender.
+
+Columns are pulled once with ``values_list`` into NumPy arrays and every
+statistic is computed in vectorized form.  The results are cached under the
+current population version; a vitals write only bumps the version (one
+``incr``), and the next request that finds its cached results out of date
+recomputes them.
+"""
+import time
+from datetime import date
+
+import numpy as np
+from django.core.cache import cache
+from django.utils import timezone
+
+from accounts.models import Profile
+from . import sharding
+from .models import UserFiles
+
+CACHE_KEY = 'pages:analytics:population'
+VERSION_KEY = 'pages:analytics:population:version'
+CACHE_TIMEOUT = 60 * 60
+
+AGE_BANDS = [0, 18, 30, 45, 60, 75, 200]
+AGE_LABELS = ['0-17', '18-29', '30-44', '45-59', '60-74', '75+']
+GENDERS = {'': 0, 'm': 1, 'f': 2}
+GENDER_LABELS = ['unknown', 'male', 'female']
+BMI_BINS = [0, 16, 18.5, 25, 30, 35, 40, 100]
+BSA_BINS = np.round(np.arange(0.5, 3.01, 0.25), 2).tolist()
+BP_LABELS = ['normal', 'elevated', 'stage_1', 'stage_2', 'crisis', 'unknown']
+SPO2_OUTLIER_BELOW = 90
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def _float(values):
+    # None becomes NaN.
+    return np.array(values, dtype=float)
+
+
+def _split_blood_pressure(readings):
+    """'120/80' strings to systolic and diastolic arrays, NaN where missing."""
+    readings = np.array([reading or 'nan/nan' for reading in readings], dtype=str)
+    if not readings.size:
+        return np.array([]), np.array([])
+    parts = np.char.partition(readings, '/')
+    return parts[:, 0].astype(float), parts[:, 2].astype(float)
+
+
+def _age_years(birth_dates, today):
+    births = np.array(birth_dates, dtype='datetime64[D]')  # None becomes NaT
+    ages = (np.datetime64(today, 'D') - births).astype(float) / 365.25
+    ages[np.isnat(births)] = np.nan
+    return ages
+
+
+def load_population():
+    """Load the vitals and demographics columns for every patient."""
+    rows = []
+    for chunk in sharding.fan_out(lambda alias: list(
+        UserFiles.objects.using(alias).values_list(
+            'user_id', 'weight', 'height', 'blood_pressure', 'oxygen_saturation'
+        )
+    )):
+        rows.extend(chunk)
+    rows.sort()
+    user_ids, weights, heights, pressures, spo2 = zip(*rows) if rows else ([],) * 5
+    systolic, diastolic = _split_blood_pressure(pressures)
+    user_ids = np.array(user_ids, dtype=np.int64)
+    population = {
+        'user_id': user_ids,
+        'weight': _float(weights),
+        'height': _float(heights),
+        'systolic': systolic,
+        'diastolic': diastolic,
+        'oxygen_saturation': _float(spo2),
+        'age': np.full(user_ids.size, np.nan),
+        'gender': np.zeros(user_ids.size, dtype=np.int8),
+    }
+
+    # Demographics live with the users on default, so they're joined here
+    # rather than in SQL.
+    profiles = sorted(
+        Profile.objects.using(sharding.GLOBAL_DB).values_list('user_id', 'birth_date', 'gender')
+    )
+    if profiles and user_ids.size:
+        profile_ids, births, genders = zip(*profiles)
+        profile_ids = np.array(profile_ids, dtype=np.int64)
+        index = np.searchsorted(profile_ids, user_ids).clip(max=profile_ids.size - 1)
+        matched = profile_ids[index] == user_ids
+        ages = _age_years(births, date.today())
+        codes = np.array([GENDERS.get(gender or '', 0) for gender in genders], dtype=np.int8)
+        population['age'][matched] = ages[index[matched]]
+        population['gender'][matched] = codes[index[matched]]
+    return population
+
+
+def _distribution(values, bins):
+    values = values[~np.isnan(values)]
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        'count': int(values.size),
+        'mean': round(float(values.mean()), 2) if values.size else None,
+        'percentiles': dict(zip(
+            [f"p{p}" for p in PERCENTILES],
+            np.round(np.percentile(values, PERCENTILES), 2).tolist() if values.size else [None] * len(PERCENTILES),
+        )),
+        'histogram': {'bins': np.asarray(edges).tolist(), 'counts': counts.tolist()},
+    }
+
+
+def _blood_pressure_buckets(systolic, diastolic):
+    """AHA categories as integer codes into BP_LABELS."""
+    return np.select(
+        [
+            np.isnan(systolic) | np.isnan(diastolic),
+            (systolic > 180) | (diastolic > 120),
+            (systolic >= 140) | (diastolic >= 90),
+            (systolic >= 130) | (diastolic >= 80),
+            systolic >= 120,
+        ],
+        [5, 4, 3, 2, 1],
+        default=0,
+    )
+
+
+def _crosstab(age_band, gender, values=None, size=None):
+    """Count rows per age band x gender, optionally split by category codes ``values``."""
+    shape = (len(AGE_LABELS) + 1, len(GENDER_LABELS)) + ((size,) if size else ())
+    table = np.zeros(shape, dtype=np.int64)
+    index = (age_band, gender) + ((values,) if size else ())
+    np.add.at(table, index, 1)
+    return table
+
+
+def _labelled(table, labels=None):
+    age_labels = AGE_LABELS + ['unknown']
+    result = {}
+    for a, age_label in enumerate(age_labels):
+        result[age_label] = {}
+        for g, gender_label in enumerate(GENDER_LABELS):
+            cell = table[a, g]
+            result[age_label][gender_label] = (
+                dict(zip(labels, cell.tolist())) if labels else int(cell)
+            )
+    return result
+
+
+def compute_statistics(population):
+    weight, height = population['weight'], population['height']
+    height_m = height / 100
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bmi = weight / height_m ** 2
+        bsa = np.sqrt(height * weight / 3600)
+
+    age = population['age']
+    # Unknown ages go into the extra last band.
+    age_band = np.where(np.isnan(age), len(AGE_LABELS), np.digitize(np.nan_to_num(age), AGE_BANDS[1:-1]))
+    gender = population['gender'].astype(np.int64)
+
+    bp = _blood_pressure_buckets(population['systolic'], population['diastolic'])
+    spo2 = population['oxygen_saturation']
+    outlier = spo2 < SPO2_OUTLIER_BELOW
+
+    with np.errstate(invalid='ignore'):
+        bmi_known = ~np.isnan(bmi)
+        bmi_sum = np.zeros((len(AGE_LABELS) + 1, len(GENDER_LABELS)))
+        np.add.at(bmi_sum, (age_band[bmi_known], gender[bmi_known]), bmi[bmi_known])
+        bmi_count = _crosstab(age_band[bmi_known], gender[bmi_known])
+        mean_bmi = np.where(bmi_count > 0, np.round(bmi_sum / np.maximum(bmi_count, 1), 1), np.nan)
+
+    return {
+        'patients': int(population['user_id'].size),
+        'computed_at': timezone.now().isoformat(),
+        'bmi': _distribution(bmi, BMI_BINS),
+        'bsa': _distribution(bsa, BSA_BINS),
+        'blood_pressure': {
+            'buckets': dict(zip(BP_LABELS, np.bincount(bp, minlength=len(BP_LABELS)).tolist())),
+            'by_age_gender': _labelled(_crosstab(age_band, gender, bp, len(BP_LABELS)), BP_LABELS),
+        },
+        'oxygen_saturation': {
+            **_distribution(spo2, np.arange(70, 101, 2)),
+            'outlier_threshold': SPO2_OUTLIER_BELOW,
+            'outliers': int(outlier.sum()),
+            'outliers_by_age_gender': _labelled(_crosstab(age_band[outlier], gender[outlier])),
+        },
+        'patients_by_age_gender': _labelled(_crosstab(age_band, gender)),
+        'mean_bmi_by_age_gender': {
+            age_label: {
+                gender_label: (None if np.isnan(mean_bmi[a, g]) else float(mean_bmi[a, g]))
+                for g, gender_label in enumerate(GENDER_LABELS)
+            }
+            for a, age_label in enumerate(AGE_LABELS + ['unknown'])
+        },
+    }
+
+
+def _version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Never a version seen before, in case the key was evicted.
+        cache.add(VERSION_KEY, time.time_ns(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def population_statistics(refresh=False):
+    version = _version()
+    state = None if refresh else cache.get(CACHE_KEY)
+    if state is None or state['version'] != version:
+        # Writes during the load bump the version again, so results that
+        # miss them are recomputed by the next request.
+        state = {'version': version, 'statistics': compute_statistics(load_population())}
+        cache.set(CACHE_KEY, state, CACHE_TIMEOUT)
+    return state['statistics']
+
+
+def mark_stale():
+    """Note that vitals changed; statistics are recomputed on the next request."""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # No version yet, so nothing has been cached under one.
+        pass
@@ -0,0 +1,228 @@
+"""
+Audit trail of who read or changed which medical record.
+
+``AuditMiddleware`` (in ``wikaya.middleware``) records one ``AuditEvent`` per
+request under ``AUDIT_PATH_PREFIXES``: actor, action, view, object and
+response status.  Views add what only they know, chiefly whose record it was,
+with ``AuditMixin`` or ``note()``.
+
+Events are not written by the request.  They go to a bounded in-process
+queue that a background thread drains with ``bulk_create``, up to
+``AUDIT_BATCH_SIZE`` rows at a time and at least every
+``AUDIT_FLUSH_SECONDS``.  When the database falls behind and the queue is
+full, a request waits up to ``AUDIT_BLOCK_MS`` for room and then writes its
+own event, so events are slowed down rather than lost.  Whatever is queued is
+written when the process exits.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from . import sharding
+from .models import AuditEvent
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = {
+    'GET': 'read',
+    'HEAD': 'read',
+    'POST': 'create',
+    'PUT': 'update',
+    'PATCH': 'update',
+    'DELETE': 'delete',
+}
+
+WRITE_ATTEMPTS = 3
+
+_STOP = object()
+
+
+class AuditWriter:
+    def __init__(self, batch_size, flush_seconds, max_queued, block_seconds):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.block_seconds = block_seconds
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.overflowed = 0
+
+    def submit(self, event):
+        self._ensure_started()
+        try:
+            self.queue.put(event, timeout=self.block_seconds)
+        except queue.Full:
+            self.overflowed += 1
+            self.write([event])
+
+    def _ensure_started(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self.queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is _STOP:
+                    stopping = True
+                    break
+                batch.append(event)
+            self.write(batch)
+        close_old_connections()
+
+    def write(self, batch):
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                AuditEvent.objects.using(sharding.GLOBAL_DB).bulk_create(batch)
+                return
+            except DatabaseError as exc:
+                error = exc
+                close_old_connections()
+                time.sleep(0.1 * 2 ** attempt)
+        # Don't lose the events even if the database won't take them.
+        logger.error("Could not write %d audit events", len(batch), exc_info=error)
+        for event in batch:
+            logger.error(
+                "audit event: %s %s %s %s %s patient=%s status=%s",
+                event.timestamp.isoformat(), event.actor_id, event.action, event.resource,
+                event.object_id, event.patient_id, event.status_code,
+            )
+
+    def flush(self, timeout=10):
+        """Write everything queued so far, stopping the writer thread to do it."""
+        thread = self.thread
+        if thread is not None and thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+                thread.join(timeout)
+            except queue.Full:
+                pass
+        self.thread = None
+        batch = []
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is not _STOP:
+                batch.append(event)
+            if len(batch) >= self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    # A forked worker starts with a copy of the parent's queue but no thread.
+    if _writer is None or _writer.pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid():
+                _writer = AuditWriter(
+                    batch_size=getattr(settings, 'AUDIT_BATCH_SIZE', 500),
+                    flush_seconds=getattr(settings, 'AUDIT_FLUSH_SECONDS', 1.0),
+                    max_queued=getattr(settings, 'AUDIT_QUEUE_SIZE', 10000),
+                    block_seconds=getattr(settings, 'AUDIT_BLOCK_MS', 50) / 1000,
+                )
+    return _writer
+
+
+def flush():
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.flush()
+
+
+atexit.register(flush)
+
+
+def record(event):
+    """Queue an unsaved ``AuditEvent`` for writing."""
+    get_writer().submit(event)
+
+
+def note(request, **details):
+    """
+    Attach details such as ``patient_id`` or ``object_id`` to the request's
+    audit event.  The first value noted for a field is kept.
+    """
+    request = getattr(request, '_request', request)
+    if not hasattr(request, 'audit_details'):
+        request.audit_details = {}
+    for field, value in details.items():
+        if value is not None:
+            request.audit_details.setdefault(field, value)
+
+
+def audited(request):
+    prefixes = getattr(settings, 'AUDIT_PATH_PREFIXES', ['/api/'])
+    return (
+        getattr(settings, 'AUDIT_ENABLED', True)
+        and request.method in ACTIONS
+        and request.path.startswith(tuple(prefixes))
+    )
+
+
+def record_request(request, response):
+    details = getattr(request, 'audit_details', {})
+    match = request.resolver_match
+    object_id = details.get('object_id')
+    if object_id is None and match is not None:
+        object_id = match.kwargs.get('pk') or match.kwargs.get('object_id')
+    user = getattr(request, 'user', None)
+    record(AuditEvent(
+        actor_id=user.pk if user is not None and user.is_authenticated else None,
+        patient_id=details.get('patient_id'),
+        action=ACTIONS[request.method],
+        resource=match.view_name[:100] if match is not None else '',
+        object_id=str(object_id or '')[:64],
+        method=request.method,
+        path=request.path[:255],
+        status_code=response.status_code,
+        ip_address=request.META.get('REMOTE_ADDR') or None,
+    ))
+
+
+class AuditMixin:
+    """
+    Notes on the audit event whose record the view touched (by default the
+    requesting user's own) and the id of anything it created.
+    """
+
+    def get_audit_patient(self, request):
+        return request.user.pk if request.user and request.user.is_authenticated else None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        created = None
+        if response.status_code == 201 and isinstance(getattr(response, 'data', None), dict):
+            created = response.data.get('id')
+        note(request, patient_id=self.get_audit_patient(request), object_id=created)
+        return response
@@ -0,0 +1,259 @@
+"""
+Medication name autocomplete.
+
+Suggestions come from the local dictionary (``pages/data/drug_names.txt`` and
+the names in the interaction dataset) and from names already used in
+patients' records, ranked by how often they are used.  A name that is not in
+the dictionary is only suggested once ``AUTOCOMPLETE_MIN_PATIENTS`` patients
+use it, so one patient's free text (typos included) never reaches another.  They are held in a
+prefix trie whose nodes each keep their best ``TOP_K`` completions, so a
+prefix query walks ``len(prefix)`` nodes and reads a list.  Every word of a
+name is indexed, so "clav" finds "amoxicillin clavulanate".  When the prefix
+finds too little, a trigram index adds near matches for typos, for as long as
+``AUTOCOMPLETE_BUDGET_MS`` allows.
+
+Each worker builds the index on first use and rebuilds it in the background
+every ``AUTOCOMPLETE_REBUILD_SECONDS``; uses of names it already holds are
+counted as they are saved.
+"""
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count
+
+from . import sharding
+from .interactions import index_paths, normalize
+from .models import Medication, Medication2
+
+DICTIONARY = Path(__file__).resolve().parent / 'data' / 'drug_names.txt'
+TOP_K = 10
+MIN_FUZZY_LENGTH = 3
+MIN_SIMILARITY = 0.3
+# Most names read from trigram postings per query.  Rare trigrams are read
+# first, so what gets cut is the common ones that say little.
+MAX_POSTINGS = 1500
+
+
+def _trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _word_starts(key):
+    return [0] + [i + 1 for i, char in enumerate(key) if char == ' ']
+
+
+class _Node:
+    __slots__ = ('children', 'top')
+
+    def __init__(self):
+        self.children = {}
+        self.top = []  # Best completions, best first; a tuple once built
+
+
+class NameIndex:
+    def __init__(self, weights, sources):
+        self.weights = dict(weights)
+        self.sources = dict(sources)
+        self.root = _Node()
+        self.trigrams = defaultdict(set)
+        self.gram_counts = {}
+        self.lock = threading.Lock()
+
+        # Visiting keys best first fills every node's list in rank order.
+        for key in sorted(self.weights, key=self._rank):
+            for start in _word_starts(key):
+                node = self.root
+                for char in key[start:]:
+                    node = node.children.setdefault(char, _Node())
+                    if len(node.top) < TOP_K and key not in node.top:
+                        node.top.append(key)
+            self._index_trigrams(key)
+        self._freeze(self.root)
+
+    def _freeze(self, root):
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            node.top = tuple(node.top)
+            stack.extend(node.children.values())
+
+    def _rank(self, key):
+        return (-self.weights[key], len(key), key)
+
+    def _index_trigrams(self, key):
+        grams = _trigrams(key)
+        self.gram_counts[key] = len(grams)
+        for gram in grams:
+            self.trigrams[gram].add(key)
+
+    def add(self, name, weight=1, source='records'):
+        """Count one more use of ``name``, indexing it if it is new."""
+        key = normalize(name)
+        if not key:
+            return
+        with self.lock:
+            if key not in self.weights:
+                self.weights[key] = 0
+                self.sources[key] = source
+                self._index_trigrams(key)
+            self.weights[key] += weight
+            for start in _word_starts(key):
+                node = self.root
+                for char in key[start:]:
+                    node = node.children.setdefault(char, _Node())
+                    top = node.top
+                    if key in top or len(top) < TOP_K or self._rank(key) < self._rank(top[-1]):
+                        # Replaced, not sorted in place: readers don't lock.
+                        node.top = tuple(sorted(set(top) | {key}, key=self._rank)[:TOP_K])
+
+    def prefix(self, key):
+        node = self.root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return ()
+        return node.top
+
+    def fuzzy(self, key, limit, deadline, exclude=()):
+        """Keys sharing enough trigrams with ``key``, best first."""
+        grams = _trigrams(key)
+        shared = Counter()
+        # Rare trigrams first: they say the most and cost the least.
+        read = 0
+        for postings in sorted((self.trigrams.get(gram, ()) for gram in grams), key=len):
+            read += len(postings)
+            if read > MAX_POSTINGS or time.perf_counter() > deadline:
+                break
+            shared.update(postings)
+        # Below this many shared trigrams the similarity can't reach the minimum.
+        needed = MIN_SIMILARITY * len(grams)
+        scored = []
+        for candidate, count in shared.items():
+            if count < needed or candidate in exclude:
+                continue
+            similarity = count / (len(grams) + self.gram_counts[candidate] - count)
+            if similarity >= MIN_SIMILARITY:
+                scored.append((-similarity, self._rank(candidate), candidate))
+        scored.sort()
+        return [candidate for _, _, candidate in scored[:limit]]
+
+    def entry(self, key, match):
+        return {
+            'name': key[:1].upper() + key[1:],
+            'source': self.sources[key],
+            'uses': self.weights[key],
+            'match': match,
+        }
+
+
+def dictionary_names():
+    with open(DICTIONARY, encoding='utf-8') as lines:
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    with open(index_paths()[0], encoding='utf-8') as source:
+        data = json.load(source)
+    for members in data.get('classes', {}).values():
+        yield from members
+    yield from data.get('drugs', [])
+    yield from data.get('aliases', {})
+
+
+def record_names(alias):
+    """``{key: (uses, patients)}`` of the names in shard ``alias``'s records."""
+    uses = Counter()
+    patients = defaultdict(set)
+    for model in (Medication, Medication2):
+        for name, user_id, count in (
+            model.objects.using(alias).values('name', 'user_id').annotate(uses=Count('pk'))
+            .values_list('name', 'user_id', 'uses')
+        ):
+            key = normalize(name)
+            if key:
+                uses[key] += count
+                patients[key].add(user_id)
+    return {key: (count, len(patients[key])) for key, count in uses.items()}
+
+
+def build():
+    weights = Counter()
+    sources = {}
+    for name in dictionary_names():
+        key = normalize(name)
+        if key:
+            weights[key] += 1
+            sources[key] = 'dictionary'
+    # A patient's record lives on one shard, so patients add up across them.
+    record_uses = Counter()
+    patients = Counter()
+    for names in sharding.fan_out(record_names):
+        for key, (uses, count) in names.items():
+            record_uses[key] += uses
+            patients[key] += count
+    min_patients = getattr(settings, 'AUTOCOMPLETE_MIN_PATIENTS', 5)
+    for key, uses in record_uses.items():
+        if key in sources or patients[key] >= min_patients:
+            weights[key] += uses
+            sources.setdefault(key, 'records')
+    return NameIndex(weights, sources)
+
+
+_index = None
+_built_at = 0.0
+_build_lock = threading.Lock()
+
+
+def _rebuild():
+    global _index, _built_at
+    try:
+        _index = build()
+        _built_at = time.monotonic()
+    finally:
+        connections.close_all()
+        _build_lock.release()
+
+
+def get_index():
+    global _index, _built_at
+    if _index is None:
+        with _build_lock:
+            if _index is None:
+                _index = build()
+                _built_at = time.monotonic()
+    elif time.monotonic() - _built_at > getattr(settings, 'AUTOCOMPLETE_REBUILD_SECONDS', 600):
+        # Keep serving the current index while a new one is built.
+        if _build_lock.acquire(blocking=False):
+            threading.Thread(target=_rebuild, name='autocomplete-rebuild', daemon=True).start()
+    return _index
+
+
+def name_used(name):
+    """Count a use of a saved name the worker's index already suggests."""
+    # New names wait for a rebuild, which checks how many patients use them.
+    if _index is not None and normalize(name) in _index.weights:
+        _index.add(name)
+
+
+def suggest(query, limit=TOP_K, budget_ms=None, index=None):
+    """Ranked suggestions for ``query``: completions first, then near matches."""
+    if budget_ms is None:
+        budget_ms = getattr(settings, 'AUTOCOMPLETE_BUDGET_MS', 5)
+    deadline = time.perf_counter() + budget_ms / 1000
+    index = index or get_index()
+    key = normalize(query)
+    if not key:
+        return []
+    completions = list(index.prefix(key)[:limit])
+    results = [index.entry(candidate, 'prefix') for candidate in completions]
+    # Near matches only when the prefix found little, e.g. after a typo.
+    if len(results) < max(1, limit // 2) and len(key) >= MIN_FUZZY_LENGTH:
+        for candidate in index.fuzzy(key, limit - len(results), deadline, exclude=set(completions)):
+            results.append(index.entry(candidate, 'fuzzy'))
+    return results
@@ -0,0 +1,218 @@
+"""
+Account deletion.
+
+``request_deletion()`` takes effect at once: the account is deactivated, its
+email freed, its tokens revoked and it disappears from doctors' patient
+lists.  Its data is then purged by ``purge()`` in the background, table by
+table and ``ACCOUNT_PURGE_BATCH_SIZE`` rows per transaction, so no request
+or transaction ever has to hold a long-time patient's whole record.
+
+The tables come from the relations that cascade from the user (and from
+what cascades from those), deepest first, so every batch can be deleted with
+a plain ``DELETE ... WHERE id IN (...)``: nothing refers to those rows any
+more and no per-row signals are needed.  The user row itself goes last, by
+which time Django's cascade has nothing left to collect.  Files of purged
+records are queued as ``DeletedFile`` and removed from storage separately
+by ``purge_files()``.
+
+Audit events refer to users by plain id and are kept.
+"""
+import logging
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import sharding
+from .models import AccountDeletion, DeletedFile, PatientShard, PatientSummary
+
+logger = logging.getLogger(__name__)
+
+# Left for the final delete of the user row: routing still uses it.
+KEPT_UNTIL_LAST = {PatientShard}
+
+MAX_FILE_ATTEMPTS = 5
+
+
+def _batch_size():
+    return getattr(settings, 'ACCOUNT_PURGE_BATCH_SIZE', 1000)
+
+
+def _relations(model):
+    return [
+        field for field in model._meta.get_fields(include_hidden=True)
+        if (field.one_to_many or field.one_to_one) and field.auto_created and not field.concrete
+    ]
+
+
+def plan():
+    """
+    ``[(model, action, paths)]`` in the order to run them, where each path
+    leads from the model to the user.  A ``'set_null'`` step has one path
+    and clears its first field; ``'delete'`` steps come deepest table first.
+    """
+    delete_paths, null_paths = {}, {}
+    order = []
+    stack = set()
+
+    def visit(model, prefix):
+        stack.add(model)
+        for relation in _relations(model):
+            child = relation.related_model
+            path = f"{relation.field.name}__{prefix}" if prefix else relation.field.name
+            if relation.on_delete is models.SET_NULL:
+                null_paths.setdefault(child, []).append(path)
+            elif relation.on_delete is models.CASCADE:
+                if child in KEPT_UNTIL_LAST or child._meta.auto_created or child in stack:
+                    continue
+                first_visit = child not in delete_paths
+                delete_paths.setdefault(child, []).append(path)
+                visit(child, path)
+                if first_visit:
+                    order.append(child)
+        stack.discard(model)
+
+    visit(get_user_model(), '')
+    return (
+        [(model, 'set_null', [path]) for model, paths in null_paths.items() for path in paths]
+        + [(model, 'delete', delete_paths[model]) for model in order]
+    )
+
+
+def _aliases(model):
+    if sharding.is_sharded_model(model):
+        return sharding.shard_aliases()
+    return [sharding.GLOBAL_DB]
+
+
+def _file_fields(model):
+    return [field for field in model._meta.concrete_fields if isinstance(field, models.FileField)]
+
+
+def request_deletion(user):
+    """Deactivate ``user`` now and queue the purge; returns the AccountDeletion."""
+    # Imported here: the token apps' models aren't needed by anything else.
+    from rest_framework.authtoken.models import Token
+    from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+    with transaction.atomic(using=sharding.GLOBAL_DB):
+        user.is_active = False
+        user.email = f"deleted-{user.pk}@deleted.invalid"
+        user.first_name = user.last_name = ''
+        user.set_unusable_password()
+        user.save(update_fields=['is_active', 'email', 'first_name', 'last_name', 'password'])
+        Token.objects.filter(user=user).delete()
+        BlacklistedToken.objects.bulk_create(
+            [BlacklistedToken(token=token) for token in OutstandingToken.objects.filter(user=user)],
+            ignore_conflicts=True,
+        )
+        PatientSummary.objects.filter(Q(patient=user) | Q(doctor=user)).delete()
+        job = AccountDeletion.objects.create(user_id=user.pk)
+    if getattr(settings, 'ACCOUNT_PURGE_IN_BACKGROUND', True):
+        transaction.on_commit(lambda: run_in_background(job.pk), using=sharding.GLOBAL_DB)
+    return job
+
+
+def _purge_table(job, model, action, paths, alias):
+    lookup = Q()
+    for path in paths:
+        lookup |= Q(**{path: job.user_id})
+    label = model._meta.label_lower
+    file_fields = _file_fields(model)
+    rows = model._base_manager.using(alias).filter(lookup)
+    while True:
+        ids = list(rows.order_by().values_list('pk', flat=True)[:_batch_size()])
+        if not ids:
+            return
+        batch = model._base_manager.using(alias).filter(pk__in=ids)
+        with transaction.atomic(using=alias):
+            if action == 'set_null':
+                batch.update(**{paths[0].split('__')[0]: None})
+            else:
+                if file_fields:
+                    queued = [
+                        DeletedFile(field=f"{label}.{field.name}", name=name)
+                        for field in file_fields
+                        for name in batch.exclude(**{field.name: ''}).values_list(field.name, flat=True)
+                    ]
+                    DeletedFile.objects.using(sharding.GLOBAL_DB).bulk_create(queued, ignore_conflicts=True)
+                    job.files_queued += len(queued)
+                # Everything pointing at these rows is already gone (deepest
+                # tables first), so skip the collector and its signals.
+                batch._raw_delete(alias)
+        job.rows_deleted[label] = job.rows_deleted.get(label, 0) + len(ids)
+        job.save(update_fields=['rows_deleted', 'files_queued', 'updated_at'])
+
+
+def purge(job):
+    """Delete everything of ``job``'s user, resuming where a previous try stopped."""
+    try:
+        for model, action, paths in plan():
+            for alias in _aliases(model):
+                _purge_table(job, model, action, paths, alias)
+        user = get_user_model().objects.filter(pk=job.user_id).first()
+        if user is not None:
+            user.delete()
+        sharding.forget_placements()
+    except Exception as exc:
+        logger.exception("Purging user %s failed", job.user_id)
+        job.status = 'failed'
+        job.error = str(exc)[:2000]
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        return job
+    job.status = 'done'
+    job.error = ''
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished_at', 'updated_at'])
+    return job
+
+
+def claim(job_id, force=False):
+    """Mark a job running unless another worker already is; returns the job or None."""
+    jobs = AccountDeletion.objects.filter(pk=job_id).exclude(status='done')
+    if not force:
+        jobs = jobs.exclude(status='running')
+    if not jobs.update(status='running'):
+        return None
+    return AccountDeletion.objects.get(pk=job_id)
+
+
+def run_in_background(job_id):
+    def target():
+        try:
+            job = claim(job_id)
+            if job is not None:
+                purge(job)
+                purge_files()
+        finally:
+            close_old_connections()
+
+    thread = threading.Thread(target=target, name=f"account-purge-{job_id}", daemon=True)
+    thread.start()
+    return thread
+
+
+def purge_files(limit=None):
+    """Remove queued files from storage; returns ``(removed, failed)``."""
+    removed = failed = 0
+    queued = DeletedFile.objects.filter(attempts__lt=MAX_FILE_ATTEMPTS).order_by('pk')
+    if limit:
+        queued = queued[:limit]
+    for deleted in queued.iterator(chunk_size=_batch_size()):
+        app_label, model_name, field_name = deleted.field.split('.')
+        storage = apps.get_model(app_label, model_name)._meta.get_field(field_name).storage
+        try:
+            storage.delete(deleted.name)
+        except Exception as exc:
+            failed += 1
+            DeletedFile.objects.filter(pk=deleted.pk).update(
+                attempts=deleted.attempts + 1, last_error=str(exc)[:1000]
+            )
+            continue
+        deleted.delete()
+        removed += 1
+    return removed, failed
@@ -0,0 +1,134 @@
+"""
+Streaming export of a patient's whole record as a FHIR-style JSON bundle,
+optionally packed into a ZIP together with their lab report and imaging files.
+
+Rows are read with ``.iterator(chunk_size=...)`` and written out as they come,
+so memory use stays flat however large the record is.
+"""
+import json
+import zipfile
+from collections import deque
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import (
+    Allergy, HealthProblem, Imaging, LabReport, Medication,
+    Medication2, Message, MessageArchive, Pregnancy, UserFiles, Vaccination,
+)
+from .serializers import (
+    AllergySerializer, ArchivedMessageSerializer, HealthProblemSerializer,
+    ImagingSerializer, LabReportSerializer, Medication2Serializer,
+    MedicationSerializer, MessageSerializer, PregnancySerializer,
+    UserFilesSerializer, VaccinationSerializer,
+)
+
+CHUNK_SIZE = 500
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+# (FHIR resource type, rows for a user, serializer)
+RESOURCES = [
+    ('Observation', lambda user: UserFiles.objects.filter(user=user), UserFilesSerializer),
+    ('AllergyIntolerance', lambda user: Allergy.objects.filter(user=user), AllergySerializer),
+    ('Condition', lambda user: HealthProblem.objects.filter(user=user), HealthProblemSerializer),
+    ('MedicationStatement', lambda user: Medication.objects.filter(user=user), MedicationSerializer),
+    ('MedicationRequest',
+     lambda user: Medication2.objects.filter(user=user).prefetch_related('reminders'),
+     Medication2Serializer),
+    ('DiagnosticReport', lambda user: LabReport.objects.filter(user=user), LabReportSerializer),
+    ('ImagingStudy', lambda user: Imaging.objects.filter(user=user), ImagingSerializer),
+    ('Immunization', lambda user: Vaccination.objects.filter(user=user), VaccinationSerializer),
+    ('EpisodeOfCare', lambda user: Pregnancy.objects.filter(user=user), PregnancySerializer),
+    ('Communication',
+     lambda user: MessageArchive.objects.filter(conversation__patient=user),
+     ArchivedMessageSerializer),
+    ('Communication',
+     lambda user: Message.objects.filter(conversation__patient=user),
+     MessageSerializer),
+]
+
+FILE_MODELS = [LabReport, Imaging]
+
+
+def iter_resources(user, using, chunk_size=CHUNK_SIZE):
+    """Yield one FHIR-style resource dict per row of ``user``'s record."""
+    for resource_type, rows, serializer_class in RESOURCES:
+        queryset = rows(user).using(using).order_by('pk')
+        model_name = queryset.model._meta.model_name
+        for obj in queryset.iterator(chunk_size=chunk_size):
+            yield {
+                'fullUrl': f"urn:wikaya:{model_name}:{obj.pk}",
+                'resource': {
+                    # The serializer's own id is the bare pk, which repeats
+                    # across types; the typed id wins.
+                    **serializer_class(obj).data,
+                    'resourceType': resource_type,
+                    'id': f"{model_name}-{obj.pk}",
+                    'subject': {'reference': f"Patient/{user.pk}", 'display': user.email},
+                },
+            }
+
+
+def bundle_chunks(user, using, chunk_size=CHUNK_SIZE):
+    """Yield the JSON bundle as text, one entry at a time."""
+    header = json.dumps({
+        'resourceType': 'Bundle',
+        'type': 'collection',
+        'timestamp': timezone.now().isoformat(),
+        'subject': {'reference': f"Patient/{user.pk}", 'display': user.email},
+    })
+    yield header[:-1] + ', "entry": ['
+    separator = ''
+    for entry in iter_resources(user, using, chunk_size):
+        yield separator + json.dumps(entry, cls=DjangoJSONEncoder)
+        separator = ','
+    yield ']}'
+
+
+class _ChunkBuffer:
+    """Write-only file object that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self.chunks = deque()
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        while self.chunks:
+            yield self.chunks.popleft()
+
+
+def zip_chunks(user, using, chunk_size=CHUNK_SIZE):
+    """
+    Yield a ZIP holding ``bundle.json`` and every lab report and imaging
+    file under ``files/``.  Entries are written incrementally; the buffer is
+    drained after every write.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('bundle.json', 'w', force_zip64=True) as entry:
+            for text in bundle_chunks(user, using, chunk_size):
+                entry.write(text.encode())
+                yield from buffer.drain()
+
+        for model in FILE_MODELS:
+            queryset = model.objects.using(using).filter(user=user).order_by('pk')
+            for obj in queryset.iterator(chunk_size=chunk_size):
+                if not obj.file:
+                    continue
+                try:
+                    source = obj.file.open('rb')
+                except OSError:
+                    # A missing file shouldn't abort the rest of the export.
+                    continue
+                with source, archive.open(f"files/{obj.file.name}", 'w', force_zip64=True) as entry:
+                    for data in source.chunks(FILE_CHUNK_SIZE):
+                        entry.write(data)
+                        yield from buffer.drain()
+    yield from buffer.drain()
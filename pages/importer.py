@@ -0,0 +1,357 @@
+"""
+Streaming bulk import of clinic records from CSV, FHIR JSON bundles and FHIR
+NDJSON.
+
+Input is parsed one record at a time.  Records are validated in batches with
+the app's serializers and inserted with ``bulk_create``, one transaction per
+batch and shard.  After every batch the job stores the byte offset of the
+next unread record, so an interrupted import resumes from there instead of
+from the start; at most the batch in flight when it stopped is replayed.
+Imported rows carry the job and offset they came from as ``import_key``, so
+replaying a batch that was already stored adds nothing.
+
+CSV files hold one resource type (``ImportJob.resource``) and identify the
+patient with a ``patient_email`` or ``user_id`` column.  FHIR resources are
+matched on ``resourceType`` and identify the patient through ``subject``
+(``display`` email or ``Patient/<id>`` reference), as in ``/api/export/``.
+"""
+import codecs
+import csv
+import json
+import re
+import threading
+from typing import NamedTuple
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+from . import alerts, sharding, summaries
+from .models import Allergy, HealthProblem, ImportJob, Medication, UserFiles, Vaccination
+from .serializers import (
+    AllergySerializer, HealthProblemSerializer, MedicationSerializer,
+    UserFilesSerializer, VaccinationSerializer,
+)
+
+BATCH_SIZE = 1000
+MAX_STORED_ERRORS = 100
+
+RESOURCES = {
+    'allergy': (Allergy, AllergySerializer),
+    'medication': (Medication, MedicationSerializer),
+    'healthproblem': (HealthProblem, HealthProblemSerializer),
+    'vaccination': (Vaccination, VaccinationSerializer),
+    'vitals': (UserFiles, UserFilesSerializer),
+}
+
+# bulk_create sends no signals, so doctor summaries are refreshed (and
+# vitals alerts checked) per batch.
+SUMMARY_PARTS = {
+    'allergy': 'allergies',
+    'medication': 'medications',
+    'vitals': 'vitals',
+}
+
+FHIR_RESOURCE_TYPES = {
+    'AllergyIntolerance': 'allergy',
+    'MedicationStatement': 'medication',
+    'Condition': 'healthproblem',
+    'Immunization': 'vaccination',
+    'Observation': 'vitals',
+}
+
+# Keys of an exported resource that describe it rather than hold data.
+FHIR_META_KEYS = {'resourceType', 'id', 'subject', 'user', 'created_at', 'updated_at'}
+
+
+class Record(NamedTuple):
+    resource: str
+    patient: str
+    data: dict
+    offset: int  # Byte offset just past this record
+
+
+class _OffsetLines:
+    """Decoded lines of a binary stream, tracking the byte offset consumed."""
+
+    def __init__(self, stream, start):
+        stream.seek(start)
+        self.stream = stream
+        self.offset = start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.stream.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+
+def read_csv(stream, resource, start=0):
+    header_line = stream.readline()
+    header = next(csv.reader([header_line.decode('utf-8-sig')]))
+    # csv.reader pulls one physical line at a time, so the offset is exact
+    # after each record even when quoted fields span lines.
+    lines = _OffsetLines(stream, max(start, len(header_line)))
+    for row in csv.reader(lines):
+        if not any(row):
+            continue
+        data = {key: value for key, value in zip(header, row) if value != ''}
+        patient = data.pop('patient_email', None) or data.pop('user_id', '')
+        yield Record(resource, patient, data, lines.offset)
+
+
+def _record_from_resource(resource, offset):
+    subject = resource.get('subject') or {}
+    patient = subject.get('display') or subject.get('reference', '').rpartition('/')[2]
+    data = {key: value for key, value in resource.items() if key not in FHIR_META_KEYS}
+    return Record(FHIR_RESOURCE_TYPES.get(resource.get('resourceType')), patient, data, offset)
+
+
+def read_ndjson(stream, start=0):
+    lines = _OffsetLines(stream, start)
+    for line in lines:
+        if line.strip():
+            yield _record_from_resource(json.loads(line), lines.offset)
+
+
+ENTRY_ARRAY = re.compile(r'"entry"\s*:\s*\[')
+
+
+def read_bundle(stream, start=0, read_size=1 << 20):
+    """Yield the entries of a Bundle's ``entry`` array without loading it whole."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    stream.seek(start)
+    offset = start
+    buffer = ''
+
+    def read_more():
+        data = stream.read(read_size)
+        return text_decoder.decode(data, final=not data), bool(data)
+
+    if start == 0:
+        # Skip everything up to and including `"entry": [`.
+        while True:
+            more, ok = read_more()
+            buffer += more
+            match = ENTRY_ARRAY.search(buffer)
+            if match:
+                offset += len(buffer[:match.end()].encode())
+                buffer = buffer[match.end():]
+                break
+            if not ok:
+                return
+
+    while True:
+        stripped = buffer.lstrip(' \t\r\n,')
+        offset += len(buffer[:len(buffer) - len(stripped)].encode())
+        buffer = stripped
+        if buffer.startswith(']'):
+            return
+        try:
+            entry, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            more, ok = read_more()
+            if not ok:
+                if buffer.strip():
+                    raise ValueError(f"Truncated bundle at byte {offset}")
+                return
+            buffer += more
+            continue
+        offset += len(buffer[:end].encode())
+        buffer = buffer[end:]
+        yield _record_from_resource(entry.get('resource') or {}, offset)
+
+
+def read_records(job, stream):
+    if job.format == 'csv':
+        return read_csv(stream, job.resource, job.bytes_done)
+    if job.format == 'ndjson':
+        return read_ndjson(stream, job.bytes_done)
+    return read_bundle(stream, job.bytes_done)
+
+
+class Importer:
+    def __init__(self, job, batch_size=BATCH_SIZE, progress=None):
+        self.job = job
+        self.batch_size = batch_size
+        self.progress = progress
+
+    def run(self):
+        job = self.job
+        job.status = 'running'
+        job.save(update_fields=['status', 'updated_at'])
+        try:
+            with job.open_source() as stream:
+                if not job.total_bytes:
+                    stream.seek(0, 2)
+                    job.total_bytes = stream.tell()
+                    stream.seek(0)
+                batch = []
+                for record in read_records(job, stream):
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        self.flush(batch)
+                        batch = []
+                if batch:
+                    self.flush(batch)
+        except Exception as exc:
+            job.status = 'failed'
+            self.add_error({'error': str(exc)})
+            job.save()
+            raise
+        job.status = 'done'
+        job.bytes_done = job.total_bytes
+        job.save()
+        return job
+
+    def add_error(self, error):
+        if len(self.job.errors) < MAX_STORED_ERRORS:
+            self.job.errors.append(error)
+
+    def fail(self, record, errors):
+        self.job.rows_failed += 1
+        self.add_error({'offset': record.offset, 'patient': record.patient, 'errors': errors})
+
+    def resolve_patients(self, batch):
+        UserModel = get_user_model()
+        keys = {record.patient for record in batch if record.patient}
+        emails = {key for key in keys if '@' in key}
+        ids = {int(key) for key in keys - emails if key.isdigit()}
+        by_email = {}
+        if emails:
+            lookup = Q()
+            for email in emails:
+                lookup |= Q(email__iexact=email)
+            by_email = {user.email.lower(): user for user in UserModel.objects.filter(lookup)}
+        if self.job.create_users:
+            for email in sorted(emails):
+                if email.lower() not in by_email:
+                    by_email[email.lower()] = UserModel.objects.create_user(email=email)
+        users = {email: by_email[email.lower()] for email in emails if email.lower() in by_email}
+        users.update({str(user.pk): user for user in UserModel.objects.filter(pk__in=ids)})
+        return users
+
+    def flush(self, batch):
+        job = self.job
+        users = self.resolve_patients(batch)
+        groups = {}
+        by_resource = {}
+        for record in batch:
+            if record.resource is None:
+                job.rows_skipped += 1
+            elif record.patient not in users:
+                self.fail(record, {'patient': ["Unknown patient"]})
+            else:
+                by_resource.setdefault(record.resource, []).append(record)
+
+        for resource, records in by_resource.items():
+            model, serializer_class = RESOURCES[resource]
+            # One serializer validates the whole batch, as ListSerializer
+            # would, but invalid rows don't take the valid ones down with them.
+            validator = serializer_class()
+            for record in records:
+                try:
+                    validated = validator.run_validation(record.data)
+                except ValidationError as exc:
+                    self.fail(record, exc.detail)
+                    continue
+                user = users[record.patient]
+                key = (sharding.shard_for_user(user), model)
+                obj = model(user=user, **validated)
+                if model is not UserFiles:
+                    obj.import_key = f"{job.pk}:{record.offset}"
+                groups.setdefault(key, []).append((record, obj))
+
+        for (alias, model), rows in groups.items():
+            self.insert(alias, model, rows)
+            if model is UserFiles:
+                from . import analytics  # Keeps NumPy out of startup
+                alerts.vitals_written([obj for record, obj in rows], alias)
+                analytics.mark_stale()
+
+        touched = {}
+        for resource, records in by_resource.items():
+            if resource in SUMMARY_PARTS:
+                for record in records:
+                    touched.setdefault(users[record.patient].pk, set()).add(SUMMARY_PARTS[resource])
+        for patient_id, parts in touched.items():
+            summaries.refresh(patient_id, parts)
+
+        job.rows_read += len(batch)
+        job.bytes_done = batch[-1].offset
+        job.save()
+        if self.progress:
+            self.progress(job)
+
+    def insert(self, alias, model, rows):
+        try:
+            with transaction.atomic(using=alias):
+                objs = [obj for record, obj in rows]
+                stored = self.already_stored(alias, model, objs)
+                self.bulk_create(alias, model, objs)
+            self.job.rows_imported += len(rows) - stored
+            return
+        except IntegrityError:
+            pass
+        # Something in the batch broke a constraint; insert row by row to
+        # find out which records to report.
+        for record, obj in rows:
+            try:
+                with transaction.atomic(using=alias):
+                    stored = self.already_stored(alias, model, [obj])
+                    self.bulk_create(alias, model, [obj])
+                self.job.rows_imported += 1 - stored
+            except IntegrityError as exc:
+                self.fail(record, {'non_field_errors': [str(exc)]})
+
+    def already_stored(self, alias, model, objs):
+        """How many of ``objs`` an earlier try of the job stored; bulk_create skips them."""
+        if model is UserFiles:
+            # Upserted, so every row counts.
+            return 0
+        keys = [obj.import_key for obj in objs]
+        return model.objects.using(alias).filter(import_key__in=keys).count()
+
+    def bulk_create(self, alias, model, objs):
+        manager = model.objects.using(alias)
+        if model is UserFiles:
+            # One vitals file per patient: later rows update it.
+            fields = [
+                field.name for field in UserFiles._meta.concrete_fields
+                if not field.primary_key and field.name not in ('user', 'created_at')
+            ]
+            return manager.bulk_create(
+                objs, update_conflicts=True, unique_fields=['user'], update_fields=fields
+            )
+        # Rows stored before an interruption are already there.
+        return manager.bulk_create(objs, ignore_conflicts=True)
+
+
+def claim(job_id, force=False):
+    """Mark a job running unless another worker already is; returns the job or None."""
+    jobs = ImportJob.objects.filter(pk=job_id).exclude(status='done')
+    if not force:
+        jobs = jobs.exclude(status='running')
+    if not jobs.update(status='running'):
+        return None
+    return ImportJob.objects.get(pk=job_id)
+
+
+def run_in_background(job_id):
+    def target():
+        try:
+            job = claim(job_id)
+            if job is not None:
+                Importer(job).run()
+        finally:
+            close_old_connections()
+
+    thread = threading.Thread(target=target, name=f"import-{job_id}", daemon=True)
+    thread.start()
+    return thread
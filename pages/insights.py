@@ -0,0 +1,189 @@
+"""
+Precomputed health insights.
+
+``run()`` finds every patient whose vitals or medical records changed since
+the last finished run and asks the LLM for a short personalized overview,
+stored as ``HealthInsight`` on the patient's shard for instant retrieval.
+Calls go through a pool of ``INSIGHTS_CONCURRENCY`` threads, each retried
+with exponential backoff.  Patients are handled in id order in chunks; each
+chunk's insights are written with one upsert per shard and the run's
+progress is saved with them, so a killed run picks up where it stopped.
+
+The provider is ``INSIGHTS_LLM`` (default ``AI_CHAT_LLM``), any class with
+``generate(prompt) -> str``; ``pages.aichat.StubLLM`` works offline.
+"""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import aichat, sharding
+from .models import (
+    Allergy, HealthInsight, HealthProblem, Imaging, InsightRun, LabReport, Medication,
+    Medication2, Pregnancy, UserFiles, Vaccination,
+)
+
+# Where a change means a patient's insight is out of date.
+CHANGE_SOURCES = [
+    (UserFiles, 'updated_at'),
+    (Allergy, 'updated_at'),
+    (Medication, 'updated_at'),
+    (HealthProblem, 'updated_at'),
+    (LabReport, 'updated_at'),
+    (Imaging, 'updated_at'),
+    (Vaccination, 'updated_at'),
+    (Medication2, 'updated_at'),
+    (Pregnancy, 'updated_at'),
+]
+
+MAX_ERRORS = 100
+
+PROMPT = """
+You are a medical doctor writing a short, friendly overview for your patient of how they are
+doing, based on their health data below. Point out anything worth attention and suggest
+next steps. Do not invent data that is not listed.
+
+Patient Data:
+{health}
+
+Active allergies: {allergies}
+Active medications: {medications}
+Ongoing health problems: {problems}
+
+Overview:
+"""
+
+
+def get_provider():
+    return import_string(
+        getattr(settings, 'INSIGHTS_LLM', None) or getattr(settings, 'AI_CHAT_LLM', 'pages.aichat.GeminiLLM')
+    )()
+
+
+def changed_users(since, until):
+    """Ids of patients with record changes in ``(since, until]``, in order."""
+    def query(alias):
+        ids = set()
+        for model, field in CHANGE_SOURCES:
+            rows = model.objects.using(alias).filter(**{f'{field}__lte': until})
+            if since is not None:
+                rows = rows.filter(**{f'{field}__gt': since})
+            ids.update(rows.values_list('user_id', flat=True).distinct())
+        return ids
+
+    users = set()
+    for ids in sharding.fan_out(query):
+        users |= ids
+    return sorted(users)
+
+
+def build_prompt(user_id):
+    def listed(values):
+        return ", ".join(values) or "none"
+
+    return PROMPT.format(
+        health=aichat.health_context(user_id),
+        allergies=listed(Allergy.objects.filter(user_id=user_id).active().values_list('title', flat=True)),
+        medications=listed(
+            f"{name} {dosage}".strip() if dosage else name
+            for name, dosage in Medication.objects.filter(user_id=user_id).active().values_list('name', 'dosage')
+        ),
+        problems=listed(
+            HealthProblem.objects.filter(user_id=user_id, resolved=False).values_list('title', flat=True)
+        ),
+    )
+
+
+def generate(provider, user_id):
+    """One patient's insight text, retrying the provider with backoff."""
+    attempts = getattr(settings, 'INSIGHTS_MAX_ATTEMPTS', 4)
+    base = getattr(settings, 'INSIGHTS_BACKOFF_SECONDS', 1.0)
+    try:
+        with sharding.pinned_to(sharding.shard_for_user(user_id)):
+            prompt = build_prompt(user_id)
+    finally:
+        close_old_connections()
+    for attempt in range(attempts):
+        try:
+            return provider.generate(prompt)
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            # Full jitter, so retries from many workers don't line up.
+            time.sleep(random.uniform(0, base * 2 ** attempt))
+
+
+def store(results, covers_until):
+    """Upsert ``{user_id: content}``, one statement per shard."""
+    now = timezone.now()
+    by_shard = {}
+    for user_id, content in results.items():
+        by_shard.setdefault(sharding.shard_for_user(user_id), []).append(
+            HealthInsight(user_id=user_id, content=content, covers_until=covers_until, generated_at=now)
+        )
+    for alias, rows in by_shard.items():
+        HealthInsight.objects.using(alias).bulk_create(
+            rows, update_conflicts=True, unique_fields=['user'],
+            update_fields=['content', 'covers_until', 'generated_at'],
+        )
+
+
+def start_or_resume(since=None, restart=False):
+    """The unfinished run to resume, or a new one covering changes since the last."""
+    unfinished = InsightRun.objects.filter(status='running').first()
+    if unfinished is not None and not restart:
+        return unfinished
+    if unfinished is not None:
+        unfinished.status = 'abandoned'
+        unfinished.finished_at = timezone.now()
+        unfinished.save(update_fields=['status', 'finished_at'])
+    if since is None:
+        # Runs with failures don't count, so their patients come up again.
+        last = InsightRun.objects.filter(status='done', failed=0).order_by('-until').first()
+        since = last.until if last else None
+    return InsightRun.objects.create(since=since, until=timezone.now())
+
+
+def run(job, concurrency=None, chunk_size=None, provider=None, progress=None):
+    """Generate insights for ``job``'s remaining patients; returns the job."""
+    concurrency = concurrency or getattr(settings, 'INSIGHTS_CONCURRENCY', 8)
+    chunk_size = chunk_size or concurrency * 4
+    provider = provider or get_provider()
+
+    users = changed_users(job.since, job.until)
+    if not job.total:
+        job.total = len(users)
+        job.save(update_fields=['total'])
+    remaining = [user_id for user_id in users if user_id > job.last_user_id]
+
+    started = time.monotonic()
+    done = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='insights') as pool:
+        for offset in range(0, len(remaining), chunk_size):
+            chunk = remaining[offset:offset + chunk_size]
+            futures = [(user_id, pool.submit(generate, provider, user_id)) for user_id in chunk]
+            results = {}
+            for user_id, future in futures:
+                error = future.exception()
+                if error is None:
+                    results[user_id] = future.result()
+                else:
+                    job.failed += 1
+                    if len(job.errors) < MAX_ERRORS:
+                        job.errors.append({'user': user_id, 'error': str(error)[:200]})
+            store(results, job.until)
+            job.succeeded += len(results)
+            job.last_user_id = chunk[-1]
+            job.save(update_fields=['succeeded', 'failed', 'errors', 'last_user_id'])
+            done += len(chunk)
+            if progress:
+                progress(job, done, done / max(time.monotonic() - started, 1e-9))
+
+    job.status = 'done'
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at'])
+    return job
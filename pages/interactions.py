@@ -0,0 +1,346 @@
+"""
+Drug-drug and drug-allergy interaction checks.
+
+The dataset (``INTERACTIONS_DATASET``, ``pages/data/interactions.json`` by
+default) lists drug classes, brand and alternative names, interacting pairs
+and allergy cross-reactivity.  It is compiled into a binary index of
+open-addressing hash tables (``INTERACTIONS_INDEX``) that every worker maps
+read-only with ``mmap``, so the pages are shared between processes and a
+lookup is one hash and a probe or two.  The index is compiled when it is
+missing or older than the dataset, or with ``manage.py compile_interactions``.
+
+Names resolve to *terms*: the generic drug plus every class it belongs to.
+Two drugs interact when any pair of their terms is listed; a drug conflicts
+with an allergy when they share a term or a listed cross-reactivity links
+them.
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+
+from . import sharding
+from .models import Allergy, Medication, Medication2
+
+DEFAULT_DATASET = Path(__file__).resolve().parent / 'data' / 'interactions.json'
+
+SEVERITIES = ['minor', 'moderate', 'major', 'contraindicated']
+INTERACTION, CROSS_REACTIVITY = 0, 1
+
+MAGIC = b'WKINTX01'
+# magic, term count, then offsets of the term, term list, name and pair
+# tables and of the strings, with the slot counts of the two hash tables.
+HEADER = struct.Struct('<8s8I')
+TERM = struct.Struct('<IHBx')           # name offset, name length, is a class
+NAME_SLOT = struct.Struct('<QIHHI')     # hash, name offset, name length, term count, first term
+PAIR_SLOT = struct.Struct('<QIIIHBB')   # hash, term a, term b, text offset, text length, kind, severity
+TERM_ID = struct.Struct('<I')
+
+# Strengths and dosage forms that don't change which drug a name means.
+STRENGTH = re.compile(r'\b\d+(?:[.,]\d+)?\s*(?:mg|mcg|µg|g|ml|iu|units?|%)(?=\W|$)')
+FORMS = re.compile(
+    r'\b(?:tablets?|tabs?|capsules?|caps?|syrup|suspension|solution|injection|inj|'
+    r'cream|ointment|gel|drops|spray|patch|er|xr|sr|cr|la|retard)\b'
+)
+COMPONENTS = re.compile(r'[/+,;&]|\band\b|\bwith\b')
+
+
+def normalize(name):
+    name = re.sub(r'\(.*?\)', ' ', name.lower())
+    name = FORMS.sub(' ', STRENGTH.sub(' ', name))
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', name).split())
+
+
+def _hash(key):
+    # 0 marks an empty slot.
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+def _pair_hash(kind, a, b):
+    return _hash(f"{kind}:{a}:{b}")
+
+
+def _hash_table(entries, slot):
+    """Lay ``(hash, packed slot)`` entries out in a linear-probing table."""
+    size = 8
+    while size < 2 * len(entries):
+        size *= 2
+    slots = [None] * size
+    for key_hash, packed in entries:
+        position = key_hash & (size - 1)
+        while slots[position] is not None:
+            position = (position + 1) & (size - 1)
+        slots[position] = packed
+    empty = bytes(slot.size)
+    return size, b''.join(packed or empty for packed in slots)
+
+
+def compile_index(dataset_path, index_path):
+    """Compile the JSON dataset into the binary index, replacing it atomically."""
+    with open(dataset_path, encoding='utf-8') as source:
+        data = json.load(source)
+
+    strings = bytearray()
+
+    def string(text):
+        encoded = text.encode()
+        strings.extend(encoded)
+        return len(strings) - len(encoded), len(encoded)
+
+    terms = {}  # normalized term -> (id, is a class)
+    names = {}  # normalized name -> term ids
+
+    def term(name, is_class=False):
+        key = normalize(name)
+        if key not in terms:
+            terms[key] = (len(terms), is_class)
+        names.setdefault(key, set()).add(terms[key][0])
+        return terms[key][0]
+
+    for class_name, members in data.get('classes', {}).items():
+        class_id = term(class_name, is_class=True)
+        for member in members:
+            term(member)
+            names[normalize(member)].add(class_id)
+    for drug in data.get('drugs', []):
+        term(drug)
+    for alias, target in data.get('aliases', {}).items():
+        term(target)
+        names.setdefault(normalize(alias), set()).update(names[normalize(target)])
+
+    pairs = {}
+    for a, b, severity, description in data.get('interactions', []):
+        a, b = sorted((term(a), term(b)))
+        pairs[(INTERACTION, a, b)] = (SEVERITIES.index(severity), description)
+    for allergen, drug, severity, description in data.get('cross_reactivity', []):
+        pairs[(CROSS_REACTIVITY, term(allergen), term(drug))] = (SEVERITIES.index(severity), description)
+
+    term_table = bytearray()
+    for key, (term_id, is_class) in sorted(terms.items(), key=lambda item: item[1][0]):
+        term_table += TERM.pack(*string(key), is_class)
+
+    term_lists = bytearray()
+    name_entries = []
+    for key, term_ids in names.items():
+        first = len(term_lists) // TERM_ID.size
+        for term_id in sorted(term_ids):
+            term_lists += TERM_ID.pack(term_id)
+        name_entries.append((_hash(key), NAME_SLOT.pack(_hash(key), *string(key), len(term_ids), first)))
+    name_slots, name_table = _hash_table(name_entries, NAME_SLOT)
+
+    pair_entries = []
+    for (kind, a, b), (severity, description) in pairs.items():
+        key_hash = _pair_hash(kind, a, b)
+        pair_entries.append((key_hash, PAIR_SLOT.pack(key_hash, a, b, *string(description), kind, severity)))
+    pair_slots, pair_table = _hash_table(pair_entries, PAIR_SLOT)
+
+    terms_at = HEADER.size
+    lists_at = terms_at + len(term_table)
+    names_at = lists_at + len(term_lists)
+    pairs_at = names_at + len(name_table)
+    strings_at = pairs_at + len(pair_table)
+    header = HEADER.pack(
+        MAGIC, len(terms), terms_at, lists_at, name_slots, names_at, pair_slots, pairs_at, strings_at
+    )
+
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    # Workers may have the old index mapped; replacing the file leaves their
+    # mapping intact until they reload.
+    fd, tmp_path = tempfile.mkstemp(dir=index_path.parent, prefix=index_path.name)
+    with os.fdopen(fd, 'wb') as out:
+        for part in (header, term_table, term_lists, name_table, pair_table, strings):
+            out.write(part)
+    # mkstemp makes it 0600; web workers may run as another user.
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, index_path)
+    return len(names), len(pairs)
+
+
+class InteractionIndex:
+    """Read-only view of a compiled index."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as source:
+            self.buffer = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.term_count, self.terms_at, self.lists_at, self.name_slots,
+         self.names_at, self.pair_slots, self.pairs_at, self.strings_at) = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an interaction index")
+
+    def _string(self, offset, length):
+        start = self.strings_at + offset
+        return self.buffer[start:start + length].decode()
+
+    def term(self, term_id):
+        """``(name, is a class)`` of a term."""
+        offset, length, is_class = TERM.unpack_from(self.buffer, self.terms_at + term_id * TERM.size)
+        return self._string(offset, length), bool(is_class)
+
+    def terms(self, name):
+        """Term ids for a normalized name, or ``()`` if it is unknown."""
+        key_hash = _hash(name)
+        mask = self.name_slots - 1
+        position = key_hash & mask
+        while True:
+            slot_hash, offset, length, count, first = NAME_SLOT.unpack_from(
+                self.buffer, self.names_at + position * NAME_SLOT.size
+            )
+            if slot_hash == 0:
+                return ()
+            if slot_hash == key_hash and self._string(offset, length) == name:
+                return struct.unpack_from(f'<{count}I', self.buffer, self.lists_at + first * TERM_ID.size)
+            position = (position + 1) & mask
+
+    def pair(self, kind, a, b):
+        """``(severity, description)`` listed for two terms, or None."""
+        key_hash = _pair_hash(kind, a, b)
+        mask = self.pair_slots - 1
+        position = key_hash & mask
+        while True:
+            slot_hash, slot_a, slot_b, offset, length, slot_kind, severity = PAIR_SLOT.unpack_from(
+                self.buffer, self.pairs_at + position * PAIR_SLOT.size
+            )
+            if slot_hash == 0:
+                return None
+            if (slot_hash, slot_a, slot_b, slot_kind) == (key_hash, a, b, kind):
+                return SEVERITIES[severity], self._string(offset, length)
+            position = (position + 1) & mask
+
+
+def index_paths():
+    dataset = Path(getattr(settings, 'INTERACTIONS_DATASET', None) or DEFAULT_DATASET)
+    index = Path(getattr(settings, 'INTERACTIONS_INDEX', None) or dataset.with_suffix('.idx'))
+    return dataset, index
+
+
+@lru_cache(maxsize=None)
+def get_index():
+    dataset, path = index_paths()
+    if not path.exists() or path.stat().st_mtime < dataset.stat().st_mtime:
+        compile_index(dataset, path)
+    return InteractionIndex(path)
+
+
+def reload():
+    get_index.cache_clear()
+
+
+def resolve(name):
+    """Terms of a free-text medication or allergy name, empty if unrecognized."""
+    index = get_index()
+    terms = set()
+    for component in COMPONENTS.split(name.lower()):
+        key = normalize(component)
+        if not key:
+            continue
+        found = index.terms(key)
+        if not found:
+            # "Amoxicillin clavulanate", "Warfarin sodium": try word by word.
+            found = [term_id for word in key.split() for term_id in index.terms(word)]
+        terms.update(found)
+    return frozenset(terms)
+
+
+def _describe_shared(index, shared):
+    names = [index.term(term_id) for term_id in sorted(shared)]
+    drugs = [name for name, is_class in names if not is_class]
+    if drugs:
+        return f"Both contain {', '.join(drugs)}."
+    return f"Both are {', '.join(name for name, is_class in names)}."
+
+
+def _worst(index, kind, pairs):
+    found = [index.pair(kind, a, b) for a, b in pairs]
+    found = [match for match in found if match]
+    return max(found, key=lambda match: SEVERITIES.index(match[0])) if found else None
+
+
+def _drug_finding(index, drug, drug_terms, other, other_terms):
+    shared = drug_terms & other_terms
+    if shared:
+        return {'type': 'duplicate', 'drug': drug, 'with': other,
+                'severity': 'moderate', 'description': _describe_shared(index, shared)}
+    match = _worst(index, INTERACTION, (
+        (min(a, b), max(a, b)) for a in drug_terms for b in other_terms
+    ))
+    if match:
+        return {'type': 'interaction', 'drug': drug, 'with': other,
+                'severity': match[0], 'description': match[1]}
+    return None
+
+
+def _allergy_finding(index, drug, drug_terms, allergy, allergy_terms):
+    shared = drug_terms & allergy_terms
+    if shared:
+        via = ', '.join(index.term(term_id)[0] for term_id in sorted(shared))
+        return {'type': 'allergy', 'drug': drug, 'with': allergy,
+                'severity': 'contraindicated', 'description': f"Patient is allergic to {via}."}
+    match = _worst(index, CROSS_REACTIVITY, (
+        (allergen, term) for allergen in allergy_terms for term in drug_terms
+    ))
+    if match:
+        return {'type': 'cross_reactivity', 'drug': drug, 'with': allergy,
+                'severity': match[0], 'description': match[1]}
+    return None
+
+
+def check(drugs, medications=(), allergies=()):
+    """
+    Check each name in ``drugs`` against the others, against ``medications``
+    and against ``allergies`` (allergy titles).  Returns the findings, worst
+    first, and the drug names that weren't recognized.
+    """
+    index = get_index()
+    resolved = {}
+
+    def terms(name):
+        if name not in resolved:
+            resolved[name] = resolve(name)
+        return resolved[name]
+
+    drugs = list(drugs)
+    findings = []
+    for position, drug in enumerate(drugs):
+        drug_terms = terms(drug)
+        if not drug_terms:
+            continue
+        for other in drugs[position + 1:] + list(medications):
+            other_terms = terms(other)
+            finding = other_terms and _drug_finding(index, drug, drug_terms, other, other_terms)
+            if finding:
+                findings.append(finding)
+        for allergy in allergies:
+            allergy_terms = terms(allergy)
+            finding = allergy_terms and _allergy_finding(index, drug, drug_terms, allergy, allergy_terms)
+            if finding:
+                findings.append(finding)
+    findings.sort(key=lambda finding: SEVERITIES.index(finding['severity']), reverse=True)
+    return findings, [drug for drug in drugs if not resolved[drug]]
+
+
+def patient_record(user, using=None):
+    """Names of the patient's active medications and titles of their active allergies."""
+    using = using or sharding.shard_for_user(user)
+    medications = list(
+        Medication.objects.using(using).filter(user=user).active().values_list('name', flat=True)
+    )
+    medications += Medication2.objects.using(using).filter(user=user).active_names()
+    allergies = list(
+        Allergy.objects.using(using).filter(user=user).active().values_list('title', flat=True)
+    )
+    return medications, allergies
+
+
+def check_for_patient(user, name, using=None):
+    """Findings for adding medication ``name`` to ``user``'s record."""
+    medications, allergies = patient_record(user, using)
+    findings, _ = check([name], medications, allergies)
+    return findings
@@ -0,0 +1,247 @@
+"""
+Text extraction and lab value parsing for lab reports.
+
+Nothing here touches Django, so ``labs`` can run it in worker processes that
+only import this module.  ``extract()`` takes a report's file contents and
+returns the values found as plain dicts.
+
+PDFs are read with a small built-in reader of the text operators in their
+content streams, which covers the text layer that lab systems generate.
+Scanned images carry no text and would need OCR; they come back empty.
+"""
+import re
+import zlib
+from functools import lru_cache
+from pathlib import Path
+
+ANALYTES = Path(__file__).resolve().parent / 'data' / 'lab_analytes.txt'
+
+STREAM = re.compile(rb'<<(.*?)>>\s*stream\r?\n(.*?)\r?\nendstream', re.S)
+# Literal strings, hex strings, arrays and operators of a content stream.
+TOKEN = re.compile(rb'\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>|\[|\]|-?\d*\.?\d+|/[^\s/\[\]()<>]+|[A-Za-z\'"*]+', re.S)
+ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+
+NUMBER = r'\d+(?:[.,]\d{1,3})?'
+RESULT = re.compile(
+    r'^(?P<name>[A-Za-z][A-Za-z0-9 ,()/\-.]*?)\s*:?\s+'
+    r'(?P<value>[<>≤≥]?\s?' + NUMBER + r')\s*'
+    r'(?P<unit>(?:x\s?10\^?\d+\s?/\s?[A-Za-zµμ]+|[A-Za-zµμ%][A-Za-z0-9µμ%/.*^]*))?\s*'
+    r'(?:\(?\s*(?:ref(?:erence)?(?:\s+range)?\s*:?\s*)?'
+    r'(?:(?P<low>' + NUMBER + r')\s*[-–]\s*(?P<high>' + NUMBER + r')|(?P<below>[<≤])\s*(?P<upper>' + NUMBER + r')'
+    r'|(?P<above>[>≥])\s*(?P<lower>' + NUMBER + r'))\s*\)?)?\s*'
+    r'(?P<flag>H|L|HIGH|LOW|High|Low|\*)?$'
+)
+FLAGS = {'H': 'high', 'HIGH': 'high', 'High': 'high', 'L': 'low', 'LOW': 'low', 'Low': 'low'}
+
+
+def _unescape(literal):
+    out = bytearray()
+    i = 0
+    while i < len(literal):
+        char = literal[i:i + 1]
+        if char != b'\\':
+            out += char
+            i += 1
+            continue
+        following = literal[i + 1:i + 2]
+        octal = re.match(rb'[0-7]{1,3}', literal[i + 1:i + 4])
+        if octal:
+            out.append(int(octal.group(), 8) & 0xFF)
+            i += 1 + len(octal.group())
+        else:
+            out += ESCAPES.get(following, following)
+            i += 2
+    return bytes(out)
+
+
+def _decode(token):
+    if token.startswith(b'('):
+        raw = _unescape(token[1:-1])
+    else:
+        digits = re.sub(rb'\s', b'', token[1:-1])
+        raw = bytes.fromhex((digits + b'0' * (len(digits) % 2)).decode())
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', 'replace')
+    return raw.decode('latin-1')
+
+
+def _fragments(content):
+    """``(y, x, order, text)`` of every string a content stream shows."""
+    fragments = []
+    operands = []
+    x = y = 0.0
+    leading = 0.0
+    for token in TOKEN.findall(content):
+        if token[:1] in b'(<[]-.0123456789/':
+            operands.append(token)
+            continue
+        numbers = [float(operand) for operand in operands if operand[:1] in b'-.0123456789']
+        if token == b'BT':
+            x = y = 0.0
+        elif token == b'Tm' and len(numbers) >= 6:
+            x, y = numbers[-2], numbers[-1]
+        elif token in (b'Td', b'TD') and len(numbers) >= 2:
+            x, y = x + numbers[-2], y + numbers[-1]
+            if token == b'TD':
+                leading = -numbers[-1]
+        elif token == b'TL' and numbers:
+            leading = numbers[-1]
+        elif token == b'T*':
+            y -= leading
+        elif token in (b'Tj', b'TJ', b"'", b'"'):
+            if token in (b"'", b'"'):
+                y -= leading
+            text = []
+            for operand in operands:
+                if operand[:1] in b'(<':
+                    text.append(_decode(operand))
+                elif token == b'TJ' and operand[:1] in b'-.0123456789' and float(operand) < -200:
+                    # Big negative kerning in a TJ array is a word gap.
+                    text.append(' ')
+            fragments.append((y, x, len(fragments), ''.join(text)))
+        operands = []
+    return fragments
+
+
+def _lines(fragments):
+    """Fragments on the same baseline joined left to right, top line first."""
+    lines = []
+    last_y = None
+    for y, x, _, text in sorted(fragments, key=lambda fragment: (-fragment[0], fragment[1], fragment[2])):
+        if last_y is not None and abs(y - last_y) < 2:
+            lines[-1].append(text)
+        else:
+            lines.append([text])
+            last_y = y
+    return [' '.join(line) for line in lines]
+
+
+def pdf_text(data):
+    """Text of a PDF's content streams; empty if it has no text layer."""
+    lines = []
+    for dictionary, stream in STREAM.findall(data):
+        if b'/FlateDecode' in dictionary:
+            try:
+                stream = zlib.decompress(stream)
+            except zlib.error:
+                continue
+        elif b'/Filter' in dictionary:
+            # Images and other encodings carry no text operators.
+            continue
+        if b'BT' not in stream:
+            continue
+        lines.extend(_lines(_fragments(stream)))
+    return '\n'.join(lines)
+
+
+def file_text(data, name):
+    if name.lower().endswith('.pdf') or data[:5] == b'%PDF-':
+        return pdf_text(data)
+    return ''
+
+
+@lru_cache(maxsize=None)
+def analytes():
+    """``{name as printed, normalized: analyte code}``."""
+    names = {}
+    with open(ANALYTES, encoding='utf-8') as lines:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            code, _, listed = line.partition(':')
+            for name in listed.split(','):
+                names[name.strip()] = code.strip()
+    return names
+
+
+def normalize(name):
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', name.lower()).split())
+
+
+def analyte_code(name):
+    """The code of a known analyte, or None."""
+    known = analytes()
+    for candidate in (name, re.sub(r'\(.*?\)', ' ', name)):
+        code = known.get(normalize(candidate))
+        if code:
+            return code
+    return None
+
+
+def _number(text):
+    text = text.strip().lstrip('<>≤≥').strip()
+    # "6,4" is a decimal comma, "150,000" a thousands separator.
+    if re.fullmatch(r'\d+,\d{1,2}', text):
+        text = text.replace(',', '.')
+    return float(text.replace(',', ''))
+
+
+def parse_line(line):
+    """A result dict for a line like "HbA1c 6.4 % 4.0-5.6 H", or None."""
+    match = RESULT.match(' '.join(line.split()))
+    if not match:
+        return None
+    name = match['name'].strip(' ,:-')
+    unit = match['unit'] or ''
+    flag = match['flag'] or ''
+    if unit in FLAGS and not flag:
+        unit, flag = '', unit
+    low = high = None
+    if match['low']:
+        low, high = _number(match['low']), _number(match['high'])
+    elif match['upper']:
+        high = _number(match['upper'])
+    elif match['lower']:
+        low = _number(match['lower'])
+
+    code = analyte_code(name)
+    if code is None:
+        # Unknown names only count in a lab table layout, with a range.
+        if low is None and high is None:
+            return None
+        code = normalize(name).replace(' ', '_')[:50]
+    value_text = match['value'].replace(' ', '')
+    value = _number(value_text)
+
+    if flag in FLAGS:
+        flag = FLAGS[flag]
+    elif low is not None or high is not None:
+        if high is not None and value > high:
+            flag = 'high'
+        elif low is not None and value < low:
+            flag = 'low'
+        else:
+            flag = 'normal'
+    else:
+        flag = ''
+    return {
+        'analyte': code,
+        'name': name[:100],
+        'value': value,
+        'value_text': value_text[:30],
+        'unit': unit[:30],
+        'reference_low': low,
+        'reference_high': high,
+        'flag': flag,
+    }
+
+
+def parse(text):
+    """Every result in ``text``, the first one of each analyte only."""
+    results = []
+    seen = set()
+    for line in text.splitlines():
+        result = parse_line(line)
+        if result and result['analyte'] not in seen:
+            seen.add(result['analyte'])
+            results.append(result)
+    return results
+
+
+def extract(data, name, notes=''):
+    """``(found_text, results)`` for a report's file contents and notes."""
+    text = file_text(data, name)
+    if notes:
+        text = f"{text}\n{notes}"
+    return bool(text.strip()), parse(text)
@@ -0,0 +1,198 @@
+"""
+Structured lab values from uploaded lab reports.
+
+After a report is saved with a new file, its text is extracted and parsed
+into ``LabResult`` rows (see ``labparse``) off the request: a few threads,
+``LAB_EXTRACTION_WORKERS`` of them, read the files from storage and hand the
+bytes to a process pool of the same size for the CPU-bound parsing, then
+replace the report's results with what was found.  ``extract_lab_reports``
+runs the same pipeline in bulk, e.g. after improving the parser.
+
+Results are copied onto the patient's shard with the report's date, kept
+in step when the date is edited, so that ``trend()`` is one indexed query
+per analyte.
+"""
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from . import labparse, sharding
+from .models import LabReport, LabResult
+
+logger = logging.getLogger(__name__)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _workers():
+    return getattr(settings, 'LAB_EXTRACTION_WORKERS', 2)
+
+
+def process_pool():
+    """This process's parsing pool, started on first use."""
+    with _pools_lock:
+        pool = _pools.get('process')
+        if pool is None:
+            # Spawned workers only import ``labparse``: no Django, no
+            # inherited database connections or threads.
+            pool = ProcessPoolExecutor(
+                max_workers=_workers(), mp_context=multiprocessing.get_context('spawn')
+            )
+            _pools['process'] = pool
+        return pool
+
+
+def _thread_pool():
+    with _pools_lock:
+        pool = _pools.get('thread')
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=_workers(), thread_name_prefix='lab-extraction')
+            _pools['thread'] = pool
+        return pool
+
+
+def _drop_broken(pool):
+    # A worker that died takes the whole pool down; the next report starts a new one.
+    with _pools_lock:
+        if _pools.get('process') is pool:
+            del _pools['process']
+
+
+def needs_extraction(report):
+    return bool(report.file) and report.file.name != report.extracted_file
+
+
+def read(report):
+    with report.file.open('rb') as handle:
+        return handle.read()
+
+
+def submit(report):
+    """Start parsing ``report``'s file in the process pool; returns the future."""
+    data = read(report)
+    pool = process_pool()
+    try:
+        future = pool.submit(labparse.extract, data, report.file.name, report.notes or '')
+    except BrokenProcessPool:
+        _drop_broken(pool)
+        pool = process_pool()
+        future = pool.submit(labparse.extract, data, report.file.name, report.notes or '')
+    future.pool = pool
+    return future
+
+
+def store(report, using, found_text, results):
+    """Replace ``report``'s results; returns the status it ended up with."""
+    status = 'done' if found_text else 'no_text'
+    with transaction.atomic(using=using):
+        LabResult.objects.using(using).filter(report=report).delete()
+        LabResult.objects.using(using).bulk_create([
+            LabResult(user_id=report.user_id, report=report, observed_on=report.report_date, **result)
+            for result in results
+        ])
+        # A queryset update, so updated_at (and the nightly insights) only
+        # move when the patient changed the report.
+        LabReport.objects.using(using).filter(pk=report.pk).update(
+            extraction_status=status, extracted_file=report.file.name
+        )
+    return status
+
+
+def failed(report, using, error):
+    logger.error("Could not extract lab values from report %s", report.pk, exc_info=error)
+    LabReport.objects.using(using).filter(pk=report.pk).update(
+        extraction_status='failed', extracted_file=report.file.name
+    )
+    return 'failed'
+
+
+def finish(report, using, future):
+    """Store the outcome of ``submit(report)``; returns the report's status."""
+    timeout = getattr(settings, 'LAB_EXTRACTION_TIMEOUT', 60)
+    try:
+        found_text, results = future.result(timeout=timeout)
+    except Exception as error:
+        if isinstance(error, BrokenProcessPool):
+            _drop_broken(future.pool)
+        return failed(report, using, error)
+    return store(report, using, found_text, results)
+
+
+def extract(report, using):
+    """Extract ``report`` now (waiting on the process pool); returns its status."""
+    try:
+        future = submit(report)
+    except Exception as error:
+        return failed(report, using, error)
+    return finish(report, using, future)
+
+
+def extract_in_background(report_id, using):
+    def target():
+        try:
+            report = LabReport.objects.using(using).filter(pk=report_id).first()
+            if report is not None and needs_extraction(report):
+                extract(report, using)
+        finally:
+            close_old_connections()
+
+    return _thread_pool().submit(target)
+
+
+def report_saved(report, using):
+    # Results carry the report's date, which may have been edited.
+    LabResult.objects.using(using).filter(report=report).exclude(
+        observed_on=report.report_date
+    ).update(observed_on=report.report_date)
+    if not needs_extraction(report):
+        return
+    if report.extraction_status != 'pending':
+        # A new file: until it is read, the results shown are the old file's.
+        LabReport.objects.using(using).filter(pk=report.pk).update(extraction_status='pending')
+        report.extraction_status = 'pending'
+    if getattr(settings, 'LAB_EXTRACTION_IN_BACKGROUND', True):
+        # After commit, so the worker sees the report and its file.
+        transaction.on_commit(lambda: extract_in_background(report.pk, using), using=using)
+    else:
+        report.extraction_status = extract(report, using)
+
+
+def extract_all(using, reports, chunk_size=50, progress=None):
+    """
+    Extract every report in the ``reports`` queryset on shard ``using``, a
+    chunk at a time so every process in the pool has work.  Returns
+    ``{status: count}``.
+    """
+    counts = {}
+    last_pk = 0
+    reports = reports.using(using).order_by('pk')
+    while True:
+        chunk = list(reports.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        submitted = []
+        for report in chunk:
+            try:
+                submitted.append((report, submit(report)))
+            except Exception as error:
+                status = failed(report, using, error)
+                counts[status] = counts.get(status, 0) + 1
+        for report, future in submitted:
+            status = finish(report, using, future)
+            counts[status] = counts.get(status, 0) + 1
+        if progress:
+            progress(using, sum(counts.values()))
+    return counts
+
+
+def trend(user_id, analyte, using=None):
+    """The patient's results for ``analyte``, oldest first."""
+    using = using or sharding.shard_for_user(user_id)
+    return LabResult.objects.using(using).filter(user_id=user_id, analyte=analyte).order_by('observed_on', 'id')
@@ -0,0 +1,38 @@
+"""
+Deferred imports for heavy optional SDKs.
+
+``lazy.module('google.generativeai')`` returns a stand-in that imports the
+real module the first time one of its attributes is used.  Modules that only
+a few requests need can then be named at the top of ``views.py`` without
+every worker boot and management command paying for the import.
+``manage.py profile_startup`` checks that they stay out of startup.
+"""
+import importlib
+import threading
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        # Only called for names not set in __init__, i.e. the module's own.
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def module(name):
+    """A stand-in for ``import name`` that imports on first attribute access."""
+    return LazyModule(name)
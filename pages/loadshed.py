@@ -0,0 +1,191 @@
+"""
+Priority load shedding.
+
+Every request is put in a tier by its route (``LOAD_SHEDDING_ROUTES``, then
+safe methods are ``read`` and the rest ``write``).  A tier is admitted while
+the worker's requests in flight stay below its share of
+``LOAD_SHEDDING_CAPACITY`` and the recent queue time stays below its limit
+(``LOAD_SHEDDING_TIERS``).  Low tiers get small shares, so slow AI requests
+can only ever hold part of the worker and token refreshes and medical reads
+always find a free thread.  Shed requests get a 503 with ``Retry-After``.
+
+Queue time is how long a request waited before the worker took it, from the
+``X-Request-Start`` header the proxy sets (nginx: ``t=${msec}``); without
+it only requests in flight count.  State is per worker process, like the
+memory backend of ``ratelimit``, and ``/health/ready/`` and
+``/health/live/`` report it to staff.
+"""
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+
+# share: admitted while requests in flight are below this fraction of
+# capacity (None: always); max_queue_ms: admitted while the recent queue
+# time is below this (None: always); retry_after: seconds, before jitter.
+DEFAULT_TIERS = {
+    'auth': {'share': None, 'max_queue_ms': None, 'retry_after': 1},
+    'read': {'share': 0.9, 'max_queue_ms': 2000, 'retry_after': 2},
+    'write': {'share': 0.75, 'max_queue_ms': 1000, 'retry_after': 5},
+    'ai': {'share': 0.5, 'max_queue_ms': 250, 'retry_after': 30},
+}
+
+# (path prefix, tier) in the order they are tried; tier None is never shed
+# nor counted.
+DEFAULT_ROUTES = [
+    ('/health/', None),
+    ('/token/', 'auth'),
+    ('/auth/', 'auth'),
+    ('/accounts/', 'auth'),
+    ('/api/ai-chat/', 'ai'),
+    ('/api/search/', 'ai'),
+]
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# Weight of the newest request in the moving averages.
+ALPHA = 0.1
+
+# Request start times further back than this are clock skew, not queueing.
+MAX_QUEUE_SECONDS = 3600
+
+
+def enabled():
+    return getattr(settings, 'LOAD_SHEDDING_ENABLED', True)
+
+
+def capacity():
+    return getattr(settings, 'LOAD_SHEDDING_CAPACITY', 8)
+
+
+def tiers():
+    return getattr(settings, 'LOAD_SHEDDING_TIERS', None) or DEFAULT_TIERS
+
+
+def classify(request):
+    """The request's tier, or None for requests that are never shed."""
+    for prefix, tier in getattr(settings, 'LOAD_SHEDDING_ROUTES', None) or DEFAULT_ROUTES:
+        if request.path.startswith(prefix):
+            return tier
+    return 'read' if request.method in SAFE_METHODS else 'write'
+
+
+def queue_ms(request, now=None):
+    """Milliseconds the request waited before this worker, if the proxy said when it arrived."""
+    header = request.META.get('HTTP_X_REQUEST_START', '')
+    try:
+        started = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    # Seconds (nginx), milliseconds (Heroku) or microseconds (Apache).
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    waited = (now or time.time()) - started
+    if not 0 <= waited < MAX_QUEUE_SECONDS:
+        return None
+    return waited * 1000
+
+
+class TierStats:
+    __slots__ = ('in_flight', 'admitted', 'shed', 'queue_ms', 'latency_ms')
+
+    def __init__(self):
+        self.in_flight = self.admitted = self.shed = 0
+        self.queue_ms = self.latency_ms = 0.0
+
+
+def _average(current, value):
+    return value if not current else current + ALPHA * (value - current)
+
+
+class Tracker:
+    """Requests in flight and moving averages of queue time and latency, per tier."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.in_flight = 0
+        self.queue_ms = 0.0
+        self.started = time.time()
+
+    def _stats(self, tier):
+        stats = self.stats.get(tier)
+        if stats is None:
+            stats = self.stats[tier] = TierStats()
+        return stats
+
+    def _admits(self, tier):
+        config = tiers().get(tier, {})
+        share = config.get('share')
+        if share is not None and self.in_flight >= share * capacity():
+            return False
+        max_queue_ms = config.get('max_queue_ms')
+        return max_queue_ms is None or self.queue_ms < max_queue_ms
+
+    def admit(self, tier, waited_ms=None):
+        """Start a request of ``tier``; returns its start time, or None if it is shed."""
+        with self._lock:
+            stats = self._stats(tier)
+            if waited_ms is not None:
+                # Shed requests count too, so the average falls again once
+                # the queue drains.
+                self.queue_ms = _average(self.queue_ms, waited_ms)
+                stats.queue_ms = _average(stats.queue_ms, waited_ms)
+            if enabled() and not self._admits(tier):
+                stats.shed += 1
+                return None
+            stats.admitted += 1
+            stats.in_flight += 1
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, tier, started):
+        with self._lock:
+            stats = self._stats(tier)
+            stats.in_flight -= 1
+            stats.latency_ms = _average(stats.latency_ms, (time.monotonic() - started) * 1000)
+            self.in_flight -= 1
+
+    def snapshot(self):
+        """The load state as reported by the health endpoints."""
+        with self._lock:
+            report = {
+                tier: {
+                    'accepting': self._admits(tier),
+                    'in_flight': stats.in_flight,
+                    'admitted': stats.admitted,
+                    'shed': stats.shed,
+                    'queue_ms': round(stats.queue_ms, 1),
+                    'latency_ms': round(stats.latency_ms, 1),
+                }
+                for tier, stats in ((tier, self._stats(tier)) for tier in tiers())
+            }
+            in_flight, waited_ms = self.in_flight, self.queue_ms
+        accepting = [tier for tier in report if report[tier]['accepting']]
+        if not enabled() or len(accepting) == len(report):
+            state = 'ok'
+        elif report.get('read', {}).get('accepting', True):
+            state = 'shedding'
+        else:
+            state = 'overloaded'
+        return {
+            'state': state,
+            'in_flight': in_flight,
+            'capacity': capacity(),
+            'queue_ms': round(waited_ms, 1),
+            'uptime': round(time.time() - self.started),
+            'tiers': report,
+        }
+
+
+tracker = Tracker()
+
+
+def retry_after(tier):
+    seconds = tiers().get(tier, {}).get('retry_after', 5)
+    # Jitter, so shed clients don't all come back at once.
+    return math.ceil(seconds * random.uniform(1, 1.5))
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from pages import partitions, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Create upcoming monthly Message partitions and move messages older "
+        "than the hot window into the compressed MessageArchive table."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int,
+                            help='Archive cutoff; defaults to MESSAGE_HOT_WINDOW_DAYS.')
+        parser.add_argument('--months-ahead', type=int,
+                            help='Partitions to create ahead of the current month.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--database', action='append', dest='databases',
+                            help='Only process this database (repeatable). Defaults to every shard.')
+
+    def handle(self, *args, **options):
+        cutoff = None
+        if options['older_than_days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+
+        for alias in options['databases'] or sharding.shard_aliases():
+            created = partitions.ensure_partitions(alias, options['months_ahead'])
+            if created:
+                self.stdout.write(f"{alias}: partitions up to {created[-1]} in place")
+            archived = partitions.archive_messages(alias, cutoff, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"{alias}: archived {archived} message(s)"))
@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import random
+import string
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pages import autocomplete
+
+# Syllables for made-up drug-like names: "tavorilam", "cefexazol", ...
+SYLLABLES = [
+    onset + vowel + coda
+    for onset in ['b', 'c', 'd', 'f', 'g', 'l', 'm', 'n', 'p', 'pr', 'r', 's', 't', 'tr', 'v', 'x', 'z']
+    for vowel in 'aeiou'
+    for coda in ['', 'l', 'n', 'r', 'x']
+]
+
+# Set before forking so worker processes share the index copy-on-write, as
+# forked server workers would.
+_index = None
+
+
+def _replay(args):
+    """
+    Send queries at a fixed rate.  A query sent late because the previous
+    ones overran counts its latency from when it was due, so queueing shows.
+    """
+    queries, rate = args
+    timings = []
+    start = time.perf_counter()
+    for position, query in enumerate(queries):
+        due = start + position / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+            # Don't count the sleep's own overshoot.
+            due = time.perf_counter()
+        autocomplete.suggest(query, index=_index)
+        timings.append((time.perf_counter() - due) * 1000)
+    return timings
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test medication autocomplete: worker processes send prefix, "
+        "typo and miss queries at a fixed rate, and the command fails if p99 "
+        "latency (queueing included) is over budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=20000)
+        parser.add_argument('--rate', type=float, default=500,
+                            help='Queries per second across all workers.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--synthetic', type=int, default=50000,
+                            help='Made-up names added to the index to simulate a large vocabulary.')
+        parser.add_argument('--p99-ms', type=float,
+                            help='Latency to stay under; defaults to AUTOCOMPLETE_BUDGET_MS.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        global _index
+        rng = random.Random(options['seed'])
+        target = options['p99_ms'] or getattr(settings, 'AUTOCOMPLETE_BUDGET_MS', 5)
+
+        started = time.perf_counter()
+        base = autocomplete.build()
+        weights, sources = dict(base.weights), dict(base.sources)
+        for _ in range(options['synthetic']):
+            name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+            weights[name] = weights.get(name, 0) + rng.randint(1, 50)
+            sources.setdefault(name, 'records')
+        _index = autocomplete.NameIndex(weights, sources)
+        self.stdout.write(f"Indexed {len(weights)} names in {time.perf_counter() - started:.1f}s")
+
+        names = list(weights)
+        queries = [self.make_query(rng, rng.choice(names)) for _ in range(options['queries'])]
+        workers = max(1, options['workers'])
+        jobs = [(queries[i::workers], options['rate'] / workers) for i in range(workers)]
+
+        started = time.perf_counter()
+        if workers == 1:
+            results = [_replay(jobs[0])]
+        else:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                results = pool.map(_replay, jobs)
+        elapsed = time.perf_counter() - started
+        timings = sorted(timing for result in results for timing in result)
+
+        def percentile(p):
+            return timings[min(len(timings) - 1, int(len(timings) * p / 100))]
+
+        self.stdout.write(
+            f"{len(timings)} queries from {workers} worker(s) at {len(timings) / elapsed:.0f}/s: "
+            f"p50 {percentile(50):.3f}ms  p95 {percentile(95):.3f}ms  "
+            f"p99 {percentile(99):.3f}ms  max {timings[-1]:.3f}ms"
+        )
+        if percentile(99) > target:
+            raise CommandError(f"p99 {percentile(99):.3f}ms is over the {target}ms budget")
+        self.stdout.write(self.style.SUCCESS(f"p99 within the {target}ms budget."))
+
+    def make_query(self, rng, name):
+        kind = rng.random()
+        if kind < 0.6:
+            return name[:rng.randint(1, min(8, len(name)))]
+        if kind < 0.85 and len(name) >= 5:
+            # One substitution, deletion or transposition.
+            i = rng.randrange(1, len(name) - 2)
+            edit = rng.choice(['sub', 'del', 'swap'])
+            if edit == 'sub':
+                return name[:i] + rng.choice(string.ascii_lowercase) + name[i + 1:]
+            if edit == 'del':
+                return name[:i] + name[i + 1:]
+            return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+        return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8)))
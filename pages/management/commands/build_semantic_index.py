@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pages import sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Embed every health problem, allergy and message for semantic search, "
+        "e.g. after first deploying it or changing SEMANTIC_EMBEDDER. New and "
+        "edited notes are indexed as they are saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', action='append', dest='shards',
+                            help='Only index this shard (repeatable).')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop the existing index first, e.g. vectors of a previous embedder.')
+
+    def handle(self, *args, **options):
+        from pages import semantic  # Keeps NumPy out of startup
+        from pages.models import NoteEmbedding
+
+        aliases = sharding.shard_aliases()
+        shards = options['shards'] or aliases
+        unknown = set(shards) - set(aliases)
+        if unknown:
+            raise CommandError(f"Unknown shard(s) {', '.join(sorted(unknown))}; use one of: {', '.join(aliases)}")
+
+        embedder = semantic.get_embedder()
+        total = 0
+        for alias in shards:
+            if options['rebuild']:
+                dropped, _ = NoteEmbedding.objects.using(alias).all().delete()
+            else:
+                dropped, _ = NoteEmbedding.objects.using(alias).exclude(embedder=embedder.name).delete()
+            if dropped:
+                self.stdout.write(f"{alias}: dropped {dropped} old vector(s)")
+
+            def progress(source, done, alias=alias):
+                self.stdout.write(f"{alias}: {done} note(s) embedded ({source})")
+
+            total += semantic.rebuild(alias, chunk_size=options['chunk_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} note(s) with {embedder.name}"))
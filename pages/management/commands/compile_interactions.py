@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from pages import interactions
+
+
+class Command(BaseCommand):
+    help = (
+        "Compile the drug interaction dataset into the memory-mapped index. "
+        "Run on deploy so workers don't each compile it on first use."
+    )
+
+    def handle(self, *args, **options):
+        dataset, index = interactions.index_paths()
+        names, pairs = interactions.compile_index(dataset, index)
+        self.stdout.write(self.style.SUCCESS(f"Compiled {names} names and {pairs} pairs into {index}."))
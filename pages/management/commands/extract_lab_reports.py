@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pages import labs, sharding
+from pages.models import LabReport
+
+
+class Command(BaseCommand):
+    help = (
+        "Read lab values from lab reports that have not been extracted since "
+        "their file was uploaded, or from all of them with --all (e.g. after "
+        "improving the parser). Files are parsed in LAB_EXTRACTION_WORKERS "
+        "processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Extract every report again.')
+        parser.add_argument('--status', action='append', dest='statuses',
+                            choices=['pending', 'done', 'no_text', 'failed'],
+                            help='Only reports with this extraction status (repeatable).')
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='Only this patient id (repeatable).')
+        parser.add_argument('--shard', action='append', dest='shards',
+                            help='Only this shard (repeatable).')
+        parser.add_argument('--chunk-size', type=int, default=50)
+
+    def handle(self, *args, **options):
+        aliases = sharding.shard_aliases()
+        shards = options['shards'] or aliases
+        unknown = set(shards) - set(aliases)
+        if unknown:
+            raise CommandError(f"Unknown shard(s) {', '.join(sorted(unknown))}; use one of: {', '.join(aliases)}")
+
+        reports = LabReport.objects.exclude(file='')
+        if options['statuses']:
+            reports = reports.filter(extraction_status__in=options['statuses'])
+        elif not options['all']:
+            reports = reports.filter(extraction_status='pending')
+        if options['users']:
+            reports = reports.filter(user_id__in=options['users'])
+
+        def progress(alias, done):
+            self.stdout.write(f"{alias}: {done} report(s)")
+
+        totals = {}
+        for alias in shards:
+            counts = labs.extract_all(alias, reports, chunk_size=options['chunk_size'], progress=progress)
+            for status, count in counts.items():
+                totals[status] = totals.get(status, 0) + count
+        summary = ', '.join(f"{count} {status}" for status, count in sorted(totals.items())) or 'nothing to do'
+        message = f"Lab reports extracted: {summary}"
+        self.stdout.write(self.style.WARNING(message) if totals.get('failed') else self.style.SUCCESS(message))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.utils.dateparse import parse_datetime
+
+from pages import insights
+
+
+class Command(BaseCommand):
+    help = (
+        "Build a health insight for every patient whose records changed since "
+        "the last run, meant to run nightly. An interrupted run is resumed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int,
+                            help='Concurrent LLM calls; defaults to INSIGHTS_CONCURRENCY.')
+        parser.add_argument('--chunk-size', type=int,
+                            help='Patients between progress saves; defaults to 4 per worker.')
+        parser.add_argument('--since', type=parse_datetime,
+                            help='Cover changes since this ISO time instead of since the last run.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Abandon an unfinished run and start a new one.')
+
+    def handle(self, *args, **options):
+        job = insights.start_or_resume(since=options['since'], restart=options['restart'])
+        if job.last_user_id:
+            self.stdout.write(f"Resuming run {job.pk} after patient {job.last_user_id}")
+        else:
+            self.stdout.write(f"Run {job.pk}: changes since {job.since or 'the beginning'}")
+
+        def progress(job, done, rate):
+            self.stdout.write(
+                f"{job.succeeded + job.failed}/{job.total} patients, {job.failed} failed, {rate:.1f}/s"
+            )
+
+        job = insights.run(
+            job, concurrency=options['concurrency'], chunk_size=options['chunk_size'], progress=progress
+        )
+        elapsed = (job.finished_at - job.started_at).total_seconds()
+        message = f"Run {job.pk}: {job.succeeded} insight(s) built, {job.failed} failed in {elapsed:.0f}s"
+        self.stdout.write(self.style.WARNING(message) if job.failed else self.style.SUCCESS(message))
@@ -0,0 +1,61 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pages import importer
+from pages.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Import allergies, medications, health problems, vaccinations or vitals "
+        "from a CSV file, FHIR JSON bundle or FHIR NDJSON file. Interrupted "
+        "imports can be continued with --resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?')
+        parser.add_argument('--format', choices=[choice for choice, _ in ImportJob.FORMAT_CHOICES])
+        parser.add_argument('--resource', choices=list(importer.RESOURCES),
+                            help='What each CSV row holds.')
+        parser.add_argument('--create-users', action='store_true')
+        parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE)
+        parser.add_argument('--resume', type=int, metavar='JOB_ID',
+                            help='Continue an earlier import from its checkpoint.')
+        parser.add_argument('--force', action='store_true',
+                            help='Resume a job still marked running, e.g. after a crash.')
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            job = importer.claim(options['resume'], force=options['force'])
+            if job is None:
+                raise CommandError("No such unfinished job, or it is still running (use --force).")
+        else:
+            path = options['path']
+            if not path or not os.path.exists(path):
+                raise CommandError("Give the path of an existing file to import.")
+            fmt = options['format'] or {'.csv': 'csv', '.ndjson': 'ndjson'}.get(
+                os.path.splitext(path)[1].lower(), 'fhir'
+            )
+            if fmt == 'csv' and not options['resource']:
+                raise CommandError("CSV imports need --resource.")
+            job = ImportJob.objects.create(
+                source_path=os.path.abspath(path),
+                format=fmt,
+                resource=options['resource'] or '',
+                create_users=options['create_users'],
+            )
+        self.stdout.write(f"Import job {job.pk}: {job.source_path or job.source.name}")
+
+        def progress(job):
+            self.stdout.write(
+                f"{job.rows_read} read, {job.rows_imported} imported, "
+                f"{job.rows_failed} failed, {job.rows_skipped} skipped ({job.progress}%)"
+            )
+
+        job = importer.Importer(job, options['batch_size'], progress).run()
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {job.rows_imported} imported, {job.rows_failed} failed."
+        ))
+        for error in job.errors[:10]:
+            self.stdout.write(f"  {error}")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pages import recalls, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Remind patients whose next vaccine dose is due within --days "
+        "(VACCINATION_RECALL_DAYS by default). A dose is recalled once per due "
+        "date, so running this again only reaches patients not reminded yet."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None)
+        parser.add_argument('--shard', action='append', dest='shards',
+                            help='Only this shard (repeatable).')
+        parser.add_argument('--chunk-size', type=int, default=recalls.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        aliases = sharding.shard_aliases()
+        shards = options['shards'] or aliases
+        unknown = set(shards) - set(aliases)
+        if unknown:
+            raise CommandError("Unknown shard(s): " + ", ".join(sorted(unknown)))
+
+        first, last = recalls.window(options['days'])
+        total = 0
+        for alias in shards:
+            def progress(using, notified):
+                self.stdout.write(f"{using}: {notified} patient(s) reminded")
+            total += recalls.notify_due(alias, first, last, options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Reminded {total} patient(s) of doses due {first} to {last}."
+        ))
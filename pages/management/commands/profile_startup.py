@@ -0,0 +1,105 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a worker does before it can serve: set Django up, load the WSGI
+# application and import every URLconf (and so every view module).
+BOOT = """
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.conf import settings
+from django.urls import get_resolver
+from django.utils.module_loading import import_string
+import_string(settings.WSGI_APPLICATION)
+get_resolver().url_patterns
+print(json.dumps({
+    'ms': (time.perf_counter() - start) * 1000,
+    'deferred_loaded': [name for name in %r if name in sys.modules],
+}))
+"""
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def parse_importtime(stderr):
+    """``{module: (self_ms, cumulative_ms)}`` from ``python -X importtime`` output."""
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            own, cumulative, _, name = match.groups()
+            modules[name] = (int(own) / 1000, int(cumulative) / 1000)
+    return modules
+
+
+class Command(BaseCommand):
+    help = (
+        "Boot the app in fresh interpreters as a worker would and report the "
+        "import time per module.  Fails if the median boot time is over "
+        "STARTUP_BUDGET_MS or a module in STARTUP_DEFERRED_MODULES was "
+        "imported at startup."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--top', type=int, default=20, help='Modules to list.')
+        parser.add_argument('--budget-ms', type=float,
+                            help='Boot time to stay under; defaults to STARTUP_BUDGET_MS, 0 to not check.')
+
+    def handle(self, *args, **options):
+        budget = options['budget_ms']
+        if budget is None:
+            budget = getattr(settings, 'STARTUP_BUDGET_MS', 0)
+        deferred = list(getattr(settings, 'STARTUP_DEFERRED_MODULES', []))
+
+        runs = [self.boot(deferred) for _ in range(max(1, options['runs']))]
+        runs.sort(key=lambda run: run[0]['ms'])
+        result, modules = runs[len(runs) // 2]
+        boot_ms = result['ms']
+
+        self.stdout.write(f"{'module':<60} {'self ms':>9} {'total ms':>9}")
+        by_total = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (own, cumulative) in by_total[:options['top']]:
+            self.stdout.write(f"{name:<60} {own:>9.1f} {cumulative:>9.1f}")
+
+        packages = defaultdict(float)
+        for name, (own, _) in modules.items():
+            packages[name.partition('.')[0]] += own
+        self.stdout.write('')
+        self.stdout.write(f"{'package':<60} {'ms':>9}")
+        for name, own in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:10]:
+            self.stdout.write(f"{name:<60} {own:>9.1f}")
+
+        timings = ', '.join(f"{run[0]['ms']:.0f}" for run in runs)
+        self.stdout.write('')
+        self.stdout.write(
+            f"Boot: {boot_ms:.0f}ms median of {len(runs)} runs ({timings}), {len(modules)} modules imported"
+        )
+
+        problems = []
+        if result['deferred_loaded']:
+            problems.append(f"imported at startup: {', '.join(result['deferred_loaded'])}")
+        if budget and boot_ms > budget:
+            problems.append(f"boot took {boot_ms:.0f}ms, budget is {budget:.0f}ms")
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write(self.style.SUCCESS('Startup is within budget'))
+
+    def boot(self, deferred):
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', BOOT % (deferred,)],
+            capture_output=True, text=True, env=os.environ.copy(),
+        )
+        if completed.returncode:
+            raise CommandError(f"Boot failed:\n{completed.stderr[-2000:]}")
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        return result, parse_importtime(completed.stderr)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from pages import deletion
+from pages.models import AccountDeletion
+
+
+class Command(BaseCommand):
+    help = (
+        "Finish purging deleted accounts: pending and failed deletions (and "
+        "with --force ones marked running, e.g. after a crash), then remove "
+        "the stored files of purged records."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, action='append', dest='jobs',
+                            help='Only this deletion id (repeatable).')
+        parser.add_argument('--force', action='store_true',
+                            help='Also take over deletions another worker seems to be running.')
+        parser.add_argument('--files-only', action='store_true',
+                            help='Only remove queued files from storage.')
+
+    def handle(self, *args, **options):
+        if not options['files_only']:
+            jobs = AccountDeletion.objects.exclude(status='done')
+            if options['jobs']:
+                jobs = jobs.filter(pk__in=options['jobs'])
+            for job_id in jobs.order_by('pk').values_list('pk', flat=True):
+                job = deletion.claim(job_id, force=options['force'])
+                if job is None:
+                    self.stdout.write(f"Deletion {job_id} is running elsewhere; use --force to take it over")
+                    continue
+                job = deletion.purge(job)
+                rows = sum(job.rows_deleted.values())
+                message = f"Deletion {job.pk} of user {job.user_id}: {job.status}, {rows} rows, {job.files_queued} files queued"
+                if job.status == 'failed':
+                    self.stdout.write(self.style.ERROR(f"{message}: {job.error}"))
+                else:
+                    self.stdout.write(self.style.SUCCESS(message))
+        removed, failed = deletion.purge_files()
+        message = f"Files removed: {removed}, failed: {failed}"
+        self.stdout.write(self.style.WARNING(message) if failed else self.style.SUCCESS(message))
@@ -0,0 +1,126 @@
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from pages import sharding, summaries
+from pages.models import Conversation, PatientShard
+
+
+class Command(BaseCommand):
+    help = (
+        "Move patients whose records are not on the shard chosen for them by "
+        "PATIENT_SHARDS, e.g. after adding a shard or when first enabling "
+        "sharding."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--migrate', action='store_true',
+                            help='Apply migrations on every shard first.')
+        parser.add_argument('--sync-users', action='store_true',
+                            help='Copy every user to every shard before moving data.')
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='Only consider this user id (repeatable).')
+        parser.add_argument('--to', dest='target',
+                            help='Move the given --user ids to this shard instead of the hashed one.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--report', action='store_true',
+                            help='Print patient and row counts per shard and exit.')
+
+    def handle(self, *args, **options):
+        aliases = sharding.shard_aliases()
+        if options['target'] and (not options['users'] or options['target'] not in aliases):
+            raise CommandError("--to needs --user and one of: " + ", ".join(aliases))
+
+        if options['report']:
+            return self.report(aliases)
+
+        if options['migrate']:
+            for alias in aliases:
+                self.stdout.write(f"Migrating {alias}")
+                call_command('migrate', database=alias, interactive=False, verbosity=0)
+
+        if options['sync_users']:
+            self.sync_users()
+
+        placements = dict(
+            PatientShard.objects.using(sharding.GLOBAL_DB).values_list('user_id', 'shard')
+        )
+        users = get_user_model().objects.using(sharding.GLOBAL_DB).order_by('pk')
+        if options['users']:
+            users = users.filter(pk__in=options['users'])
+
+        moved = 0
+        for user_id in users.values_list('pk', flat=True).iterator(chunk_size=2000):
+            # Patients without a placement predate sharding and live on default.
+            source = placements.get(user_id, sharding.GLOBAL_DB)
+            target = options['target'] or sharding.hashed_shard(user_id, aliases)
+            if source == target:
+                continue
+            self.stdout.write(f"user {user_id}: {source} -> {target}")
+            if not options['dry_run']:
+                self.move_patient(user_id, source, target, options['batch_size'])
+            moved += 1
+
+        sharding.forget_placements()
+        verb = "Would move" if options['dry_run'] else "Moved"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {moved} patient(s)."))
+
+    def sync_users(self):
+        users = get_user_model().objects.using(sharding.GLOBAL_DB).iterator(chunk_size=2000)
+        for count, user in enumerate(users, start=1):
+            sharding.replicate_user(user)
+            if count % 1000 == 0:
+                self.stdout.write(f"Synced {count} users")
+
+    def move_patient(self, user_id, source, target, batch_size):
+        models = sharding.sharded_models()
+        # Copy first, repoint the directory, then delete the source rows, so
+        # a failure part-way leaves the record readable where it was.
+        with transaction.atomic(using=target):
+            for model in models:
+                rows = (
+                    model._base_manager.using(source)
+                    .filter(**{sharding.user_lookup(model): user_id})
+                    .order_by('pk')
+                    .iterator(chunk_size=batch_size)
+                )
+                for row in rows:
+                    # raw=True keeps created_at/updated_at as they were.
+                    row.save_base(raw=True, force_insert=True, using=target)
+            sharding.reserve_id_range(target)
+
+        PatientShard.objects.using(sharding.GLOBAL_DB).update_or_create(
+            user_id=user_id,
+            defaults={'shard': target, 'moved_at': timezone.now()},
+        )
+        # Before the source rows go, so no worker keeps writing there.
+        sharding.forget_placements()
+
+        with transaction.atomic(using=source):
+            for model in reversed(models):
+                model._base_manager.using(source).filter(
+                    **{sharding.user_lookup(model): user_id}
+                ).delete()
+
+        # Deleting the source conversations dropped their doctor summaries.
+        for conversation in Conversation.objects.using(target).filter(patient_id=user_id):
+            summaries.add_pair(conversation, target)
+
+    def report(self, aliases):
+        patients = dict.fromkeys(aliases, 0)
+        for shard in PatientShard.objects.using(sharding.GLOBAL_DB).values_list('shard', flat=True).iterator():
+            patients[shard] = patients.get(shard, 0) + 1
+
+        def row_counts(alias):
+            return {
+                model._meta.model_name: model._base_manager.using(alias).count()
+                for model in sharding.sharded_models()
+            }
+
+        for alias, counts in zip(aliases, sharding.fan_out(row_counts, aliases)):
+            self.stdout.write(f"{alias}: {patients.get(alias, 0)} patients")
+            for model_name, count in counts.items():
+                self.stdout.write(f"  {model_name}: {count}")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pages import adherence, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Mark scheduled medication doses that nobody recorded as missed, once "
+        "ADHERENCE_GRACE_MINUTES have passed. Each run continues where the "
+        "last one stopped; run it every hour or so."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', action='append', dest='shards',
+                            help='Only this shard (repeatable).')
+        parser.add_argument('--chunk-size', type=int, default=adherence.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        aliases = sharding.shard_aliases()
+        shards = options['shards'] or aliases
+        unknown = set(shards) - set(aliases)
+        if unknown:
+            raise CommandError("Unknown shard(s): " + ", ".join(sorted(unknown)))
+
+        total = 0
+        for alias in shards:
+            def progress(using, marked):
+                self.stdout.write(f"{using}: {marked} missed dose(s)")
+            total += adherence.record_missed(alias, chunk_size=options['chunk_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Marked {total} dose(s) as missed."))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pages import alerts, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Check every vitals row against the alert rules, e.g. after changing "
+        "VITALS_ALERT_RULES. Rows are read in chunks, one shard at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', action='append', dest='shards',
+                            help='Only this shard (repeatable).')
+        parser.add_argument('--chunk-size', type=int, default=alerts.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        aliases = sharding.shard_aliases()
+        shards = options['shards'] or aliases
+        unknown = set(shards) - set(aliases)
+        if unknown:
+            raise CommandError("Unknown shard(s): " + ", ".join(sorted(unknown)))
+
+        total = 0
+        for alias in shards:
+            def progress(seen, alias=alias):
+                self.stdout.write(f"{alias}: {seen} rows")
+            total += alerts.reevaluate(alias, options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS(f"Checked {total} vitals row(s)."))
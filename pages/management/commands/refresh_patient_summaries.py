@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from pages import sharding, summaries
+from pages.models import Conversation, PatientSummary
+
+
+class Command(BaseCommand):
+    help = (
+        "Create missing doctor overview rows and recompute every summary. Run "
+        "nightly: allergies and medications become past as their dates go by "
+        "without any write that would refresh them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient', type=int, action='append', dest='patients')
+
+    def handle(self, *args, **options):
+        created = 0
+        for alias in sharding.shard_aliases():
+            conversations = Conversation.objects.using(alias).order_by('pk')
+            if options['patients']:
+                conversations = conversations.filter(patient_id__in=options['patients'])
+            for conversation in conversations.iterator(chunk_size=2000):
+                if not PatientSummary.objects.using(sharding.GLOBAL_DB).filter(
+                    doctor_id=conversation.doctor_id, patient_id=conversation.patient_id
+                ).exists():
+                    summaries.add_pair(conversation, alias)
+                    created += 1
+
+        patients = (
+            PatientSummary.objects.using(sharding.GLOBAL_DB)
+            .order_by('patient_id')
+            .values_list('patient_id', flat=True)
+            .distinct()
+        )
+        if options['patients']:
+            patients = patients.filter(patient_id__in=options['patients'])
+        refreshed = 0
+        for patient_id in patients.iterator(chunk_size=2000):
+            summaries.refresh(patient_id)
+            refreshed += 1
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {created} and refreshed summaries for {refreshed} patient(s)."
+        ))
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0006_pregnancy'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.CharField(db_index=True, max_length=50)),
+                ('placed_at', models.DateTimeField(auto_now_add=True)),
+                ('moved_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='patient_shard', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
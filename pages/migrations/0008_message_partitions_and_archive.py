@@ -0,0 +1,93 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def partition_messages(apps, schema_editor):
+    """Rebuild pages_message as a table range-partitioned by month on PostgreSQL."""
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    Message = apps.get_model('pages', 'Message')
+    table = Message._meta.db_table
+    conversation_table = apps.get_model('pages', 'Conversation')._meta.db_table
+    user_table = apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+        if cursor.fetchone():
+            return
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned")
+        cursor.execute(f"CREATE SEQUENCE {table}_partitioned_id_seq")
+        # The partition key has to be part of the primary key.
+        cursor.execute(f"""
+            CREATE TABLE {table} (
+                id bigint NOT NULL DEFAULT nextval('{table}_partitioned_id_seq'),
+                content text NOT NULL,
+                "timestamp" timestamp with time zone NOT NULL,
+                conversation_id bigint NOT NULL
+                    REFERENCES {conversation_table} (id) DEFERRABLE INITIALLY DEFERRED,
+                sender_id bigint NOT NULL
+                    REFERENCES {user_table} (id) DEFERRABLE INITIALLY DEFERRED,
+                PRIMARY KEY (id, "timestamp")
+            ) PARTITION BY RANGE ("timestamp")
+        """)
+        cursor.execute(f"ALTER SEQUENCE {table}_partitioned_id_seq OWNED BY {table}.id")
+        cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+        cursor.execute(f"""
+            SELECT DISTINCT date_trunc('month', "timestamp" AT TIME ZONE 'UTC')
+            FROM {table}_unpartitioned
+            UNION
+            SELECT date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => n)
+            FROM generate_series(0, 3) AS n
+        """)
+        for (month,) in cursor.fetchall():
+            following = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+            cursor.execute(f"""
+                CREATE TABLE {table}_p{month:%Y_%m} PARTITION OF {table}
+                FOR VALUES FROM ('{month:%Y-%m-%d} 00:00:00+00') TO ('{following:%Y-%m-%d} 00:00:00+00')
+            """)
+
+        cursor.execute(f"""
+            INSERT INTO {table} (id, content, "timestamp", conversation_id, sender_id)
+            SELECT id, content, "timestamp", conversation_id, sender_id
+            FROM {table}_unpartitioned
+        """)
+        # Run the deferred foreign key checks now; indexes can't be built
+        # on a table with pending trigger events.
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(
+            f"SELECT setval('{table}_partitioned_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+        )
+        cursor.execute(f"DROP TABLE {table}_unpartitioned")
+        cursor.execute(f'CREATE INDEX pages_messa_convers_8034e8_idx ON {table} (conversation_id, "timestamp")')
+        cursor.execute(f"CREATE INDEX {table}_sender_id_idx ON {table} (sender_id)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0007_patientshard'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('content_compressed', models.BinaryField()),
+                ('timestamp', models.DateTimeField()),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='pages.conversation')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['timestamp'],
+                'indexes': [models.Index(fields=['conversation', 'timestamp'], name='pages_messa_convers_ce9a06_idx')],
+            },
+        ),
+        migrations.RunPython(partition_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0008_message_partitions_and_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.FileField(blank=True, upload_to='imports/%Y/%m/%d/')),
+                ('source_path', models.CharField(blank=True, help_text='Local file used instead of an upload, e.g. by the import_records command', max_length=500)),
+                ('format', models.CharField(choices=[('csv', 'CSV'), ('fhir', 'FHIR JSON bundle'), ('ndjson', 'FHIR NDJSON')], max_length=10)),
+                ('resource', models.CharField(blank=True, choices=[('allergy', 'Allergy'), ('medication', 'Medication'), ('healthproblem', 'Health problem'), ('vaccination', 'Vaccination'), ('vitals', 'Vitals')], help_text='What each CSV row holds. FHIR resources carry their own type.', max_length=20)),
+                ('create_users', models.BooleanField(default=False, help_text="Create accounts for patient emails that don't exist yet")),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('total_bytes', models.PositiveBigIntegerField(default=0)),
+                ('bytes_done', models.PositiveBigIntegerField(default=0, help_text='Checkpoint: offset of the first record not yet committed')),
+                ('rows_read', models.PositiveBigIntegerField(default=0)),
+                ('rows_imported', models.PositiveBigIntegerField(default=0)),
+                ('rows_failed', models.PositiveBigIntegerField(default=0)),
+                ('rows_skipped', models.PositiveBigIntegerField(default=0)),
+                ('errors', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='import_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
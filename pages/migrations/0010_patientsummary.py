@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0009_importjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_email', models.EmailField(max_length=254)),
+                ('patient_name', models.CharField(blank=True, max_length=155)),
+                ('heart_rate', models.PositiveIntegerField(blank=True, null=True)),
+                ('blood_pressure', models.CharField(blank=True, max_length=7, null=True)),
+                ('blood_sugar_level', models.PositiveIntegerField(blank=True, null=True)),
+                ('oxygen_saturation', models.PositiveIntegerField(blank=True, null=True)),
+                ('respiratory_rate', models.PositiveIntegerField(blank=True, null=True)),
+                ('body_mass_index', models.FloatField(blank=True, null=True)),
+                ('vitals_updated_at', models.DateTimeField(blank=True, null=True)),
+                ('active_allergies', models.JSONField(blank=True, default=list)),
+                ('active_allergy_count', models.PositiveIntegerField(default=0)),
+                ('active_medications', models.JSONField(blank=True, default=list)),
+                ('active_medication_count', models.PositiveIntegerField(default=0)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patient_summaries', to=settings.AUTH_USER_MODEL)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='doctor_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['doctor', 'patient_name'], name='pages_patie_doctor__03bdf3_idx'), models.Index(fields=['doctor', 'last_message_at'], name='pages_patie_doctor__de44f5_idx'), models.Index(fields=['doctor', 'vitals_updated_at'], name='pages_patie_doctor__ddea4b_idx'), models.Index(fields=['doctor', 'oxygen_saturation'], name='pages_patie_doctor__fec02b_idx'), models.Index(fields=['doctor', 'active_allergy_count'], name='pages_patie_doctor__0ff33b_idx'), models.Index(fields=['doctor', 'active_medication_count'], name='pages_patie_doctor__2ad94a_idx')],
+                'unique_together': {('doctor', 'patient')},
+            },
+        ),
+    ]
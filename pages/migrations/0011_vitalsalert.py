@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0010_patientsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VitalsAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rule', models.CharField(max_length=50)),
+                ('severity', models.CharField(choices=[('warning', 'Warning'), ('critical', 'Critical')], max_length=10)),
+                ('message', models.CharField(max_length=255)),
+                ('value', models.CharField(help_text='Latest reading that broke the rule', max_length=20)),
+                ('occurrences', models.PositiveIntegerField(default=1)),
+                ('suppressed', models.BooleanField(default=False, help_text="Raised past the patient's alert rate limit, so not shown to the doctor")),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_seen_at', models.DateTimeField(auto_now_add=True)),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+                ('acknowledged_at', models.DateTimeField(blank=True, null=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vitals_alerts', to='pages.conversation')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['conversation', 'resolved_at'], name='pages_vital_convers_7752cc_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('resolved_at__isnull', True)), fields=('conversation', 'rule'), name='unique_open_vitals_alert')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:09
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0011_vitalsalert'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='allergy',
+            index=models.Index(condition=models.Q(('is_passed__isnull', True)), fields=['user', 'end_date'], name='allergy_auto_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='allergy',
+            index=models.Index(condition=models.Q(('is_passed__isnull', False)), fields=['user', 'is_passed'], name='allergy_manual_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medication',
+            index=models.Index(condition=models.Q(('is_passed__isnull', True)), fields=['user', 'end_date', 'start_date'], name='medication_auto_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medication',
+            index=models.Index(condition=models.Q(('is_passed__isnull', False)), fields=['user', 'is_passed'], name='medication_manual_status_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:29
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0012_allergy_medication_status_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actor_id', models.BigIntegerField(blank=True, null=True)),
+                ('patient_id', models.BigIntegerField(blank=True, null=True)),
+                ('action', models.CharField(choices=[('read', 'Read'), ('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('resource', models.CharField(blank=True, max_length=100)),
+                ('object_id', models.CharField(blank=True, max_length=64)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=255)),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('ip_address', models.GenericIPAddressField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['patient_id', 'timestamp'], name='pages_audit_patient_9dfadf_idx'), models.Index(fields=['actor_id', 'timestamp'], name='pages_audit_actor_i_51c48e_idx'), models.Index(fields=['timestamp'], name='pages_audit_timesta_b64edc_idx')],
+            },
+        ),
+    ]
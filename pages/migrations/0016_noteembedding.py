@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0015_health_insights'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('healthproblem', 'Health problem'), ('allergy', 'Allergy'), ('message', 'Message')], max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('embedder', models.CharField(max_length=50)),
+                ('vector', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='note_embeddings', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('source', 'object_id'), name='unique_note_embedding')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0016_noteembedding'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='labreport',
+            name='extracted_file',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='labreport',
+            name='extraction_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('no_text', 'No text found'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='LabResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('analyte', models.CharField(max_length=50)),
+                ('name', models.CharField(max_length=100)),
+                ('value', models.FloatField(blank=True, null=True)),
+                ('value_text', models.CharField(max_length=30)),
+                ('unit', models.CharField(blank=True, max_length=30)),
+                ('reference_low', models.FloatField(blank=True, null=True)),
+                ('reference_high', models.FloatField(blank=True, null=True)),
+                ('flag', models.CharField(blank=True, choices=[('low', 'Low'), ('normal', 'Normal'), ('high', 'High')], max_length=10)),
+                ('observed_on', models.DateField()),
+                ('report', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='pages.labreport')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lab_results', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['observed_on', 'id'],
+                'indexes': [models.Index(fields=['user', 'analyte', 'observed_on'], name='lab_result_trend_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0018_account_deletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=255)),
+                ('view', models.CharField(blank=True, db_index=True, max_length=200)),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('user_id', models.BigIntegerField(blank=True, null=True)),
+                ('trigger', models.CharField(choices=[('requested', 'Requested'), ('sampled', 'Sampled')], max_length=10)),
+                ('duration_ms', models.FloatField()),
+                ('interval_ms', models.FloatField()),
+                ('samples', models.PositiveIntegerField()),
+                ('stacks', models.TextField(blank=True)),
+                ('query_count', models.PositiveIntegerField(default=0)),
+                ('query_ms', models.FloatField(default=0)),
+                ('queries', models.JSONField(blank=True, default=list, help_text='The slowest queries: sql, ms and database')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0019_request_profiles'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VitalsBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('signal', models.CharField(choices=[('heart_rate', 'Heart rate'), ('oxygen_saturation', 'Oxygen saturation'), ('respiratory_rate', 'Respiratory rate')], max_length=20)),
+                ('device', models.CharField(blank=True, max_length=64)),
+                ('starts_at', models.DateTimeField()),
+                ('ends_at', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('offsets', models.BinaryField()),
+                ('values', models.BinaryField()),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('mean', models.FloatField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vitals_batches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'signal', 'ends_at'], name='vitals_batch_range_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'signal', 'device', 'starts_at'), name='unique_vitals_batch')],
+            },
+        ),
+    ]
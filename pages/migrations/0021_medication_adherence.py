@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0020_wearable_vitals'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoseEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scheduled_at', models.DateTimeField()),
+                ('taken', models.BooleanField()),
+                ('taken_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-scheduled_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserAdherence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doses_taken', models.PositiveIntegerField(default=0)),
+                ('doses_missed', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='medication2',
+            name='doses_checked_through',
+            field=models.DateTimeField(blank=True, help_text='Scheduled doses up to this time have been checked for misses', null=True),
+        ),
+        migrations.AddField(
+            model_name='medication2',
+            name='doses_missed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='medication2',
+            name='doses_taken',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='patientsummary',
+            name='adherence',
+            field=models.FloatField(blank=True, help_text='Percentage of doses taken', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='patientsummary',
+            index=models.Index(fields=['doctor', 'adherence'], name='pages_patie_doctor__a005b2_idx'),
+        ),
+        migrations.AddField(
+            model_name='doseevent',
+            name='medication',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dose_events', to='pages.medication2'),
+        ),
+        migrations.AddField(
+            model_name='useradherence',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='adherence', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='doseevent',
+            constraint=models.UniqueConstraint(fields=('medication', 'scheduled_at'), name='unique_dose_event'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0021_medication_adherence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VaccinationRecall',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due_date', models.DateField()),
+                ('notified_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='vaccination',
+            index=models.Index(condition=models.Q(('next_dose_date__isnull', False)), fields=['next_dose_date', 'id'], name='vaccination_due_idx'),
+        ),
+        migrations.AddField(
+            model_name='vaccinationrecall',
+            name='vaccination',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recalls', to='pages.vaccination'),
+        ),
+        migrations.AddConstraint(
+            model_name='vaccinationrecall',
+            constraint=models.UniqueConstraint(fields=('vaccination', 'due_date'), name='unique_vaccination_recall'),
+        ),
+    ]
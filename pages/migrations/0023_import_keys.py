@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0022_vaccination_recalls'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allergy',
+            name='import_key',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='healthproblem',
+            name='import_key',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='medication',
+            name='import_key',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='vaccination',
+            name='import_key',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True, unique=True),
+        ),
+    ]
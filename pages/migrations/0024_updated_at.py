@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def from_created_at(apps, schema_editor):
+    using = schema_editor.connection.alias
+    for name in ('Medication2', 'Pregnancy'):
+        model = apps.get_model('pages', name)
+        model.objects.using(using).update(updated_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0023_import_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medication2',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='pregnancy',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        # Existing rows haven't changed since they were created; don't send
+        # every patient to the next insights run.
+        migrations.RunPython(from_created_at, migrations.RunPython.noop),
+    ]
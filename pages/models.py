@@ -1,6 +1,10 @@
+import datetime
+import zlib
+
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator, MaxValueValidator, FileExtensionValidator
+from django.utils import timezone
 
 class UserFiles(models.Model):
     user = models.OneToOneField(
@@ -83,7 +87,63 @@ class BaseMedicalModel(models.Model):
     class Meta:
         abstract = True
 
-class Allergy(BaseMedicalModel):
+class ImportedModel(models.Model):
+    """Rows the bulk importer creates; see importer.py."""
+    # "<job id>:<byte offset>" of the record a row was imported from, so a
+    # batch replayed after a crash skips the rows it already stored.
+    import_key = models.CharField(max_length=40, unique=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+class _StatusQuerySet(models.QuerySet):
+    """
+    ``effective_is_passed`` in SQL: the manual ``is_passed`` override if set,
+    else the date rule of the subclass, its ``past_by_date(today)`` and
+    ``active_by_date(today)``.  Both sides are spelled out as plain
+    comparisons (no NOT) so they can use the partial indexes.
+    """
+
+    def _past(self):
+        today = timezone.now().date()
+        return models.Q(is_passed=True) | models.Q(is_passed__isnull=True) & self.past_by_date(today)
+
+    def _active(self):
+        today = timezone.now().date()
+        return models.Q(is_passed=False) | models.Q(is_passed__isnull=True) & self.active_by_date(today)
+
+    def active(self):
+        return self.filter(self._active())
+
+    def past(self):
+        return self.filter(self._past())
+
+    def with_status(self):
+        """Annotate ``status_is_passed``, read by the serializers' ``status``."""
+        return self.annotate(status_is_passed=models.Case(
+            models.When(self._past(), then=models.Value(True)),
+            default=models.Value(False),
+            output_field=models.BooleanField(),
+        ))
+
+class AllergyQuerySet(_StatusQuerySet):
+    def past_by_date(self, today):
+        return models.Q(end_date__lt=today)
+
+    def active_by_date(self, today):
+        return models.Q(end_date__isnull=True) | models.Q(end_date__gte=today)
+
+class MedicationQuerySet(_StatusQuerySet):
+    def past_by_date(self, today):
+        return models.Q(end_date__lt=today) | models.Q(start_date__gt=today)
+
+    def active_by_date(self, today):
+        return (
+            (models.Q(end_date__isnull=True) | models.Q(end_date__gte=today))
+            & (models.Q(start_date__isnull=True) | models.Q(start_date__lte=today))
+        )
+
+class Allergy(BaseMedicalModel, ImportedModel):
     title = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
     start_date = models.DateField(blank=True, null=True)
@@ -94,6 +154,17 @@ class Allergy(BaseMedicalModel):
         help_text="Manual override to mark as past. Leave empty for auto-calculation"
     )
 
+    objects = AllergyQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Rows left to the date rule, and manually overridden ones.
+            models.Index(fields=['user', 'end_date'], condition=models.Q(is_passed__isnull=True),
+                         name='allergy_auto_status_idx'),
+            models.Index(fields=['user', 'is_passed'], condition=models.Q(is_passed__isnull=False),
+                         name='allergy_manual_status_idx'),
+        ]
+
     @property
     def calculated_is_passed(self):
         """Auto-determine status based on end date"""
@@ -111,7 +182,7 @@ class Allergy(BaseMedicalModel):
         status = "Past" if self.effective_is_passed else "Current"
         return f"{status} Allergy: {self.title}"
 
-class Medication(BaseMedicalModel):
+class Medication(BaseMedicalModel, ImportedModel):
     name = models.CharField(max_length=100)
     dosage = models.CharField(max_length=50, blank=True, null=True)
     start_date = models.DateField(blank=True, null=True)
@@ -123,6 +194,8 @@ class Medication(BaseMedicalModel):
         help_text="Manual override to mark as past. Leave empty for auto-calculation"
     )
 
+    objects = MedicationQuerySet.as_manager()
+
     @property
     def calculated_is_passed(self):
         """Auto-determine status based on dates"""
@@ -150,8 +223,14 @@ class Medication(BaseMedicalModel):
                 name='end_after_start'
             )
         ]
+        indexes = [
+            models.Index(fields=['user', 'end_date', 'start_date'], condition=models.Q(is_passed__isnull=True),
+                         name='medication_auto_status_idx'),
+            models.Index(fields=['user', 'is_passed'], condition=models.Q(is_passed__isnull=False),
+                         name='medication_manual_status_idx'),
+        ]
 
-class HealthProblem(BaseMedicalModel):
+class HealthProblem(BaseMedicalModel, ImportedModel):
     title = models.CharField(max_length=100)
     diagnosis_date = models.DateField(blank=True, null=True)
     resolved = models.BooleanField(default=False)
@@ -171,6 +250,15 @@ class LabReport(BaseMedicalModel):
     )
     report_date = models.DateField()
     notes = models.TextField(blank=True, null=True)
+    # Set by the lab value extraction (see labs.py), which runs again
+    # whenever ``file`` no longer matches ``extracted_file``.
+    extraction_status = models.CharField(max_length=10, choices=[
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('no_text', 'No text found'),
+        ('failed', 'Failed'),
+    ], default='pending')
+    extracted_file = models.CharField(max_length=255, blank=True, default='')
 
     def __str__(self):
         return f"Lab Report - {self.report_date}"
@@ -190,7 +278,7 @@ class Imaging(BaseMedicalModel):
     def __str__(self):
         return f"Imaging - {self.imaging_type} ({self.imaging_date})"
 
-class Vaccination(BaseMedicalModel):
+class Vaccination(BaseMedicalModel, ImportedModel):
     name = models.CharField(max_length=100)
     date_administered = models.DateField()
     manufacturer = models.CharField(max_length=100, blank=True, null=True)
@@ -198,9 +286,45 @@ class Vaccination(BaseMedicalModel):
     next_dose_date = models.DateField(blank=True, null=True)
     notes = models.TextField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # Recall lists walk due doses in (next_dose_date, id) order.
+            models.Index(fields=['next_dose_date', 'id'], condition=models.Q(next_dose_date__isnull=False),
+                         name='vaccination_due_idx'),
+        ]
+
     def __str__(self):
         return f"{self.name} - {self.date_administered}"
 
+class VaccinationRecall(models.Model):
+    """
+    A patient reminded of a vaccination's next dose (see recalls.py).  One
+    per vaccination and due date, so a dose is only ever recalled once, and
+    again only if it is rescheduled.
+    """
+    vaccination = models.ForeignKey(Vaccination, on_delete=models.CASCADE, related_name='recalls')
+    due_date = models.DateField()
+    notified_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['vaccination', 'due_date'], name='unique_vaccination_recall'),
+        ]
+
+    def __str__(self):
+        return f"Recall of vaccination {self.vaccination_id} due {self.due_date}"
+
+class Medication2QuerySet(models.QuerySet):
+    def active_names(self):
+        """Names of the medications whose course has not ended yet."""
+        # Done here: SQLite can't add duration_days to created_at in SQL.
+        now = timezone.now()
+        return [
+            name
+            for name, created_at, days in self.values_list('name', 'created_at', 'duration_days')
+            if created_at + datetime.timedelta(days=days) >= now
+        ]
+
 class Medication2(models.Model):
     TIMING_CHOICES = [
         ('morning', 'Morning'),
@@ -232,6 +356,15 @@ class Medication2(models.Model):
         verbose_name='Administration Time'
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Kept by adherence.py as dose events come in; never count events for these.
+    doses_taken = models.PositiveIntegerField(default=0)
+    doses_missed = models.PositiveIntegerField(default=0)
+    doses_checked_through = models.DateTimeField(
+        null=True, blank=True, help_text="Scheduled doses up to this time have been checked for misses"
+    )
+
+    objects = Medication2QuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_at']
@@ -241,6 +374,12 @@ class Medication2(models.Model):
     def __str__(self):
         return f"{self.name} - {self.get_timing_display()}"
 
+    @property
+    def adherence(self):
+        """Percentage of doses taken so far, None before the first."""
+        doses = self.doses_taken + self.doses_missed
+        return round(100 * self.doses_taken / doses, 1) if doses else None
+
 class MedicationReminder(models.Model):
     medication = models.ForeignKey(
         Medication2,
@@ -264,6 +403,46 @@ class MedicationReminder(models.Model):
     def __str__(self):
         return f"{self.medication} at {self.reminder_time.strftime('%H:%M')}"
 
+class DoseEvent(models.Model):
+    """A scheduled dose of a ``Medication2`` that was taken or missed."""
+    medication = models.ForeignKey(
+        Medication2,
+        on_delete=models.CASCADE,
+        related_name='dose_events'
+    )
+    scheduled_at = models.DateTimeField()
+    taken = models.BooleanField()
+    taken_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-scheduled_at']
+        constraints = [
+            # Also the index for a medication's events by time.
+            models.UniqueConstraint(fields=['medication', 'scheduled_at'], name='unique_dose_event'),
+        ]
+
+    def __str__(self):
+        return f"{self.medication.name} at {self.scheduled_at:%Y-%m-%d %H:%M}: {'taken' if self.taken else 'missed'}"
+
+class UserAdherence(models.Model):
+    """A patient's doses taken and missed over all their medications, kept by adherence.py."""
+    user = models.OneToOneField(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='adherence'
+    )
+    doses_taken = models.PositiveIntegerField(default=0)
+    doses_missed = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Adherence of user {self.user_id}"
+
+    @property
+    def adherence(self):
+        doses = self.doses_taken + self.doses_missed
+        return round(100 * self.doses_taken / doses, 1) if doses else None
+
 class Conversation(models.Model):
     patient = models.ForeignKey(
         get_user_model(),
@@ -309,6 +488,45 @@ class Message(models.Model):
     def __str__(self):
         return f"Message from {self.sender} at {self.timestamp}"
 
+class MessageArchive(models.Model):
+    """Messages older than the hot window, with zlib-compressed content."""
+    id = models.BigIntegerField(primary_key=True)  # The original Message id
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='archived_messages'
+    )
+    sender = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='archived_messages'
+    )
+    content_compressed = models.BinaryField()
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp']),
+        ]
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(
+            id=message.id,
+            conversation_id=message.conversation_id,
+            sender_id=message.sender_id,
+            content_compressed=zlib.compress(message.content.encode()),
+            timestamp=message.timestamp,
+        )
+
+    @property
+    def content(self):
+        return zlib.decompress(self.content_compressed).decode()
+
+    def __str__(self):
+        return f"Archived message {self.id} at {self.timestamp}"
+
 class Pregnancy(models.Model):
     user = models.ForeignKey(
         get_user_model(),
@@ -318,6 +536,7 @@ class Pregnancy(models.Model):
     start_date = models.DateField()
     notes = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-start_date']
@@ -325,3 +544,499 @@ class Pregnancy(models.Model):
     def __str__(self):
         return f"{self.start_date} - {self.user.email}"
 
+
+class PatientShard(models.Model):
+    """Directory of which shard holds each patient's record (see sharding.py)."""
+    user = models.OneToOneField(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='patient_shard'
+    )
+    shard = models.CharField(max_length=50, db_index=True)
+    placed_at = models.DateTimeField(auto_now_add=True)
+    moved_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.user_id} on {self.shard}"
+
+class ImportJob(models.Model):
+    """A bulk import of clinic records, resumable from its byte checkpoint."""
+    FORMAT_CHOICES = [
+        ('csv', 'CSV'),
+        ('fhir', 'FHIR JSON bundle'),
+        ('ndjson', 'FHIR NDJSON'),
+    ]
+    RESOURCE_CHOICES = [
+        ('allergy', 'Allergy'),
+        ('medication', 'Medication'),
+        ('healthproblem', 'Health problem'),
+        ('vaccination', 'Vaccination'),
+        ('vitals', 'Vitals'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    source = models.FileField(upload_to='imports/%Y/%m/%d/', blank=True)
+    source_path = models.CharField(
+        max_length=500,
+        blank=True,
+        help_text="Local file used instead of an upload, e.g. by the import_records command"
+    )
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    resource = models.CharField(
+        max_length=20,
+        choices=RESOURCE_CHOICES,
+        blank=True,
+        help_text="What each CSV row holds. FHIR resources carry their own type."
+    )
+    create_users = models.BooleanField(
+        default=False,
+        help_text="Create accounts for patient emails that don't exist yet"
+    )
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    created_by = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='import_jobs'
+    )
+    total_bytes = models.PositiveBigIntegerField(default=0)
+    bytes_done = models.PositiveBigIntegerField(
+        default=0,
+        help_text="Checkpoint: offset of the first record not yet committed"
+    )
+    rows_read = models.PositiveBigIntegerField(default=0)
+    rows_imported = models.PositiveBigIntegerField(default=0)
+    rows_failed = models.PositiveBigIntegerField(default=0)
+    rows_skipped = models.PositiveBigIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    @property
+    def progress(self):
+        if not self.total_bytes:
+            return None
+        return round(100 * self.bytes_done / self.total_bytes, 1)
+
+    def open_source(self):
+        if self.source_path:
+            return open(self.source_path, 'rb')
+        return self.source.open('rb')
+
+    def __str__(self):
+        return f"Import {self.pk} ({self.get_format_display()}) - {self.status}"
+
+class PatientSummary(models.Model):
+    """
+    One row per doctor and patient with the patient's latest vitals, active
+    allergies and active medications, kept up to date from signals so a
+    doctor's overview is a single indexed query.
+    """
+    doctor = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='patient_summaries'
+    )
+    patient = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='doctor_summaries'
+    )
+    patient_email = models.EmailField()
+    patient_name = models.CharField(max_length=155, blank=True)
+    heart_rate = models.PositiveIntegerField(null=True, blank=True)
+    blood_pressure = models.CharField(max_length=7, null=True, blank=True)
+    blood_sugar_level = models.PositiveIntegerField(null=True, blank=True)
+    oxygen_saturation = models.PositiveIntegerField(null=True, blank=True)
+    respiratory_rate = models.PositiveIntegerField(null=True, blank=True)
+    body_mass_index = models.FloatField(null=True, blank=True)
+    vitals_updated_at = models.DateTimeField(null=True, blank=True)
+    active_allergies = models.JSONField(default=list, blank=True)
+    active_allergy_count = models.PositiveIntegerField(default=0)
+    active_medications = models.JSONField(default=list, blank=True)
+    active_medication_count = models.PositiveIntegerField(default=0)
+    adherence = models.FloatField(null=True, blank=True, help_text="Percentage of doses taken")
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['doctor', 'patient']
+        indexes = [
+            models.Index(fields=['doctor', 'patient_name']),
+            models.Index(fields=['doctor', 'last_message_at']),
+            models.Index(fields=['doctor', 'vitals_updated_at']),
+            models.Index(fields=['doctor', 'oxygen_saturation']),
+            models.Index(fields=['doctor', 'active_allergy_count']),
+            models.Index(fields=['doctor', 'active_medication_count']),
+            models.Index(fields=['doctor', 'adherence']),
+        ]
+
+    def __str__(self):
+        return f"{self.patient_email} for doctor {self.doctor_id}"
+
+class VitalsAlert(models.Model):
+    """
+    A vitals reading that broke an alert rule, delivered to one doctor
+    through their conversation with the patient.  While the rule keeps
+    firing the open alert is updated rather than duplicated.
+    """
+    SEVERITY_CHOICES = [
+        ('warning', 'Warning'),
+        ('critical', 'Critical'),
+    ]
+
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='vitals_alerts'
+    )
+    rule = models.CharField(max_length=50)
+    severity = models.CharField(max_length=10, choices=SEVERITY_CHOICES)
+    message = models.CharField(max_length=255)
+    value = models.CharField(max_length=20, help_text="Latest reading that broke the rule")
+    occurrences = models.PositiveIntegerField(default=1)
+    suppressed = models.BooleanField(
+        default=False,
+        help_text="Raised past the patient's alert rate limit, so not shown to the doctor"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_seen_at = models.DateTimeField(auto_now_add=True)
+    resolved_at = models.DateTimeField(null=True, blank=True)
+    acknowledged_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['conversation', 'resolved_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['conversation', 'rule'],
+                condition=models.Q(resolved_at__isnull=True),
+                name='unique_open_vitals_alert',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.rule} ({self.value}) in conversation {self.conversation_id}"
+
+class AuditEvent(models.Model):
+    """
+    One request that read or changed medical records.  Users are kept as
+    plain ids rather than foreign keys so the trail outlives the accounts.
+    """
+    ACTION_CHOICES = [
+        ('read', 'Read'),
+        ('create', 'Create'),
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+    ]
+
+    timestamp = models.DateTimeField(default=timezone.now)
+    actor_id = models.BigIntegerField(null=True, blank=True)
+    patient_id = models.BigIntegerField(null=True, blank=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    resource = models.CharField(max_length=100, blank=True)
+    object_id = models.CharField(max_length=64, blank=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=255)
+    status_code = models.PositiveSmallIntegerField()
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['patient_id', 'timestamp']),
+            models.Index(fields=['actor_id', 'timestamp']),
+            models.Index(fields=['timestamp']),
+        ]
+
+    def __str__(self):
+        return f"{self.actor_id} {self.action} {self.resource} {self.object_id} at {self.timestamp}"
+
+class AIChatSession(models.Model):
+    """
+    A patient's conversation with the AI assistant.  Turns up to
+    ``summarized_through`` are folded into ``summary``, so prompts carry the
+    summary plus the turns after it rather than the whole history.
+    """
+    user = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='ai_chat_sessions'
+    )
+    title = models.CharField(max_length=100, blank=True)
+    summary = models.TextField(blank=True)
+    summarized_through = models.BigIntegerField(
+        default=0,
+        help_text="Id of the last turn folded into the summary"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['user', 'updated_at']),
+        ]
+
+    def __str__(self):
+        return f"AI chat {self.pk}: {self.title}"
+
+class AIChatTurn(models.Model):
+    ROLE_CHOICES = [
+        ('user', 'User'),
+        ('assistant', 'Assistant'),
+    ]
+
+    session = models.ForeignKey(
+        AIChatSession,
+        on_delete=models.CASCADE,
+        related_name='turns'
+    )
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES)
+    content = models.TextField()
+    tokens = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.role} turn {self.pk} in AI chat {self.session_id}"
+
+class HealthInsight(models.Model):
+    """A patient's precomputed health overview, rebuilt by `manage.py generate_health_insights`."""
+    user = models.OneToOneField(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='health_insight'
+    )
+    content = models.TextField()
+    covers_until = models.DateTimeField(help_text="Record changes up to this time are reflected")
+    generated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Health insight for {self.user_id} ({self.covers_until})"
+
+class InsightRun(models.Model):
+    """
+    One pass of the insight job over patients whose records changed between
+    ``since`` and ``until``.  Patients are processed in id order and
+    ``last_user_id`` is saved as they finish, so an interrupted run resumes.
+    """
+    STATUS_CHOICES = [
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('abandoned', 'Abandoned'),
+    ]
+
+    since = models.DateTimeField(null=True, blank=True)
+    until = models.DateTimeField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='running')
+    last_user_id = models.BigIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"Insight run {self.pk} ({self.status})"
+
+class NoteEmbedding(models.Model):
+    """
+    The semantic search vector of one note-like record (a health problem, an
+    allergy or a message), stored as float16 bytes.  Kept on the patient's
+    shard next to the records it describes.
+    """
+    SOURCE_CHOICES = [
+        ('healthproblem', 'Health problem'),
+        ('allergy', 'Allergy'),
+        ('message', 'Message'),
+    ]
+
+    user = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='note_embeddings'
+    )
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    object_id = models.BigIntegerField()
+    embedder = models.CharField(max_length=50)
+    vector = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'object_id'], name='unique_note_embedding'),
+        ]
+
+    def __str__(self):
+        return f"Embedding of {self.source} {self.object_id}"
+
+class LabResult(models.Model):
+    """
+    One value read from a lab report, e.g. HbA1c 6.4 % (4.0-5.6).  ``analyte``
+    is the canonical code used for trends; ``name`` is as printed.
+    """
+    FLAG_CHOICES = [
+        ('low', 'Low'),
+        ('normal', 'Normal'),
+        ('high', 'High'),
+    ]
+
+    user = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='lab_results'
+    )
+    report = models.ForeignKey(LabReport, on_delete=models.CASCADE, related_name='results')
+    analyte = models.CharField(max_length=50)
+    name = models.CharField(max_length=100)
+    value = models.FloatField(null=True, blank=True)
+    value_text = models.CharField(max_length=30)
+    unit = models.CharField(max_length=30, blank=True)
+    reference_low = models.FloatField(null=True, blank=True)
+    reference_high = models.FloatField(null=True, blank=True)
+    flag = models.CharField(max_length=10, choices=FLAG_CHOICES, blank=True)
+    observed_on = models.DateField()
+
+    class Meta:
+        ordering = ['observed_on', 'id']
+        indexes = [
+            models.Index(fields=['user', 'analyte', 'observed_on'], name='lab_result_trend_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} {self.value_text} {self.unit}".strip()
+
+class AccountDeletion(models.Model):
+    """
+    A deleted account whose data is being purged in the background (see
+    deletion.py).  Keeps only the user's id, so it outlives the user row.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    user_id = models.BigIntegerField(db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    rows_deleted = models.JSONField(default=dict, blank=True, help_text="Rows purged so far per table")
+    files_queued = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    requested_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-requested_at']
+
+    def __str__(self):
+        return f"Deletion of user {self.user_id} ({self.status})"
+
+class DeletedFile(models.Model):
+    """A stored file whose record was purged, waiting to be removed from storage."""
+    field = models.CharField(max_length=100, help_text="The file field it belonged to, e.g. pages.labreport.file")
+    name = models.CharField(max_length=255)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['field', 'name'], name='unique_deleted_file'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+class RequestProfile(models.Model):
+    """
+    A sampled CPU profile of one request, with the SQL it ran (see
+    profiling.py).  ``stacks`` holds collapsed stacks, one
+    ``frame;frame;frame count`` line per distinct stack.
+    """
+    TRIGGER_CHOICES = [
+        ('requested', 'Requested'),
+        ('sampled', 'Sampled'),
+    ]
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=255)
+    view = models.CharField(max_length=200, blank=True, db_index=True)
+    status_code = models.PositiveSmallIntegerField()
+    user_id = models.BigIntegerField(null=True, blank=True)
+    trigger = models.CharField(max_length=10, choices=TRIGGER_CHOICES)
+    duration_ms = models.FloatField()
+    interval_ms = models.FloatField()
+    samples = models.PositiveIntegerField()
+    stacks = models.TextField(blank=True)
+    query_count = models.PositiveIntegerField(default=0)
+    query_ms = models.FloatField(default=0)
+    queries = models.JSONField(default=list, blank=True, help_text="The slowest queries: sql, ms and database")
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
+class VitalsBatch(models.Model):
+    """
+    A run of wearable samples of one signal, stored as arrays (see
+    wearables.py): ``offsets`` in milliseconds after ``starts_at`` as
+    little-endian uint32 and ``values`` as little-endian float16.
+    """
+    SIGNAL_CHOICES = [
+        ('heart_rate', 'Heart rate'),
+        ('oxygen_saturation', 'Oxygen saturation'),
+        ('respiratory_rate', 'Respiratory rate'),
+    ]
+
+    user = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name='vitals_batches'
+    )
+    signal = models.CharField(max_length=20, choices=SIGNAL_CHOICES)
+    device = models.CharField(max_length=64, blank=True)
+    starts_at = models.DateTimeField()
+    ends_at = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    offsets = models.BinaryField()
+    values = models.BinaryField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+    mean = models.FloatField()
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # A batch sent again (the client didn't see the acknowledgement)
+            # is stored once.
+            models.UniqueConstraint(fields=['user', 'signal', 'device', 'starts_at'], name='unique_vitals_batch'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'signal', 'ends_at'], name='vitals_batch_range_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_signal_display()} of user {self.user_id} from {self.starts_at:%Y-%m-%d %H:%M}"
@@ -0,0 +1,221 @@
+"""
+S3-compatible object storage for medical files.
+
+``S3Storage`` is a Django storage backend for any service speaking the S3
+API (AWS S3, MinIO, Ceph, ...), configured by ``OBJECT_STORAGE``.  Requests
+are signed with AWS Signature Version 4 using only the standard library.
+
+Besides the usual storage methods it issues presigned POST forms, so a
+client can upload a file straight to the bucket: the form's policy pins the
+object key and caps the size, and the app only checks the object with a
+``HEAD`` when the client finalizes the upload (see ``uploads``).
+"""
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import urllib.error
+import urllib.request
+from urllib.parse import quote, urlsplit
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.utils.deconstruct import deconstructible
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+TIMEOUT = 30
+
+
+class ObjectStorageError(Exception):
+    pass
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+def signing_key(secret_key, date, region, service='s3'):
+    key = _hmac(('AWS4' + secret_key).encode(), date)
+    key = _hmac(key, region)
+    key = _hmac(key, service)
+    return _hmac(key, 'aws4_request')
+
+
+def _query_string(params):
+    return '&'.join(
+        f"{quote(name, safe='-_.~')}={quote(str(value), safe='-_.~')}"
+        for name, value in sorted(params.items())
+    )
+
+
+@deconstructible
+class S3Storage(Storage):
+    def __init__(self, endpoint=None, bucket=None, region=None, access_key=None, secret_key=None,
+                 addressing=None):
+        config = getattr(settings, 'OBJECT_STORAGE', {})
+        self.endpoint = (endpoint or config.get('ENDPOINT') or '').rstrip('/')
+        self.bucket = bucket or config.get('BUCKET')
+        self.region = region or config.get('REGION') or 'us-east-1'
+        self.access_key = access_key or config.get('ACCESS_KEY')
+        self.secret_key = secret_key or config.get('SECRET_KEY')
+        # 'path' (endpoint/bucket/key) suits MinIO and most stand-ins;
+        # 'virtual' (bucket.endpoint/key) is what AWS prefers.
+        self.addressing = addressing or config.get('ADDRESSING') or 'path'
+        if not (self.endpoint and self.bucket and self.access_key and self.secret_key):
+            raise ImproperlyConfigured("OBJECT_STORAGE needs ENDPOINT, BUCKET, ACCESS_KEY and SECRET_KEY.")
+
+    # Addressing and signing
+
+    def _base_url(self):
+        if self.addressing == 'virtual':
+            parts = urlsplit(self.endpoint)
+            return f"{parts.scheme}://{self.bucket}.{parts.netloc}"
+        return f"{self.endpoint}/{self.bucket}"
+
+    def _object_url(self, name):
+        return f"{self._base_url()}/{quote(name, safe='/-_.~')}"
+
+    def _scope(self, now):
+        return f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+
+    def _signature(self, now, canonical_request):
+        string_to_sign = '\n'.join([
+            ALGORITHM,
+            f"{now:%Y%m%dT%H%M%SZ}",
+            self._scope(now),
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ])
+        key = signing_key(self.secret_key, f"{now:%Y%m%d}", self.region)
+        return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    def _signed_request(self, method, name, body=None, headers=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        url = self._object_url(name)
+        parts = urlsplit(url)
+        headers = {
+            **(headers or {}),
+            'host': parts.netloc,
+            'x-amz-content-sha256': UNSIGNED_PAYLOAD,
+            'x-amz-date': f"{now:%Y%m%dT%H%M%SZ}",
+        }
+        signed = sorted(header.lower() for header in headers)
+        lowered = {header.lower(): str(value).strip() for header, value in headers.items()}
+        canonical_request = '\n'.join([
+            method,
+            parts.path,
+            '',
+            ''.join(f"{header}:{lowered[header]}\n" for header in signed),
+            ';'.join(signed),
+            UNSIGNED_PAYLOAD,
+        ])
+        headers['Authorization'] = (
+            f"{ALGORITHM} Credential={self.access_key}/{self._scope(now)}, "
+            f"SignedHeaders={';'.join(signed)}, Signature={self._signature(now, canonical_request)}"
+        )
+        del headers['host']
+        request = urllib.request.Request(url, data=body, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                return 404, error.headers, b''
+            raise ObjectStorageError(f"{method} {name}: {error.code} {error.read()[:200]!r}") from error
+        except urllib.error.URLError as error:
+            raise ObjectStorageError(f"{method} {name}: {error.reason}") from error
+
+    def presigned_url(self, name, method='GET', expires=None):
+        """A URL anyone can use for ``method`` on the object until it expires."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expires = expires or getattr(settings, 'UPLOAD_URL_SECONDS', 900)
+        url = self._object_url(name)
+        parts = urlsplit(url)
+        params = {
+            'X-Amz-Algorithm': ALGORITHM,
+            'X-Amz-Credential': f"{self.access_key}/{self._scope(now)}",
+            'X-Amz-Date': f"{now:%Y%m%dT%H%M%SZ}",
+            'X-Amz-Expires': int(expires),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        canonical_request = '\n'.join([
+            method, parts.path, _query_string(params), f"host:{parts.netloc}\n", 'host', UNSIGNED_PAYLOAD,
+        ])
+        params['X-Amz-Signature'] = self._signature(now, canonical_request)
+        return f"{url}?{_query_string(params)}"
+
+    def presigned_post(self, name, max_bytes, content_type=None, expires=None):
+        """
+        ``{'url', 'fields'}`` of a form that uploads one file (the form's last
+        field, ``file``) to ``name``, at most ``max_bytes`` of it.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expires = expires or getattr(settings, 'UPLOAD_URL_SECONDS', 900)
+        fields = {
+            'key': name,
+            'x-amz-algorithm': ALGORITHM,
+            'x-amz-credential': f"{self.access_key}/{self._scope(now)}",
+            'x-amz-date': f"{now:%Y%m%dT%H%M%SZ}",
+        }
+        if content_type:
+            fields['Content-Type'] = content_type
+        policy = {
+            'expiration': (now + datetime.timedelta(seconds=expires)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'conditions': [
+                {'bucket': self.bucket},
+                ['content-length-range', 1, max_bytes],
+                *({field: value} for field, value in fields.items()),
+            ],
+        }
+        fields['policy'] = base64.b64encode(json.dumps(policy).encode()).decode()
+        key = signing_key(self.secret_key, f"{now:%Y%m%d}", self.region)
+        fields['x-amz-signature'] = hmac.new(key, fields['policy'].encode(), hashlib.sha256).hexdigest()
+        return {'url': self._base_url() + '/', 'fields': fields}
+
+    def head(self, name):
+        """``{'size', 'content_type', 'etag'}`` of the object, or None if it is missing."""
+        status, headers, _ = self._signed_request('HEAD', name)
+        if status == 404:
+            return None
+        return {
+            'size': int(headers.get('Content-Length', 0)),
+            'content_type': headers.get('Content-Type', ''),
+            'etag': headers.get('ETag', '').strip('"'),
+        }
+
+    # Storage API
+
+    def _open(self, name, mode='rb'):
+        status, _, body = self._signed_request('GET', name)
+        if status == 404:
+            raise FileNotFoundError(name)
+        return ContentFile(body, name=name)
+
+    def _save(self, name, content):
+        # Files sent through the app (the admin, the old multipart API) are
+        # read into memory once; direct uploads never come this way.
+        content.seek(0)
+        headers = {}
+        content_type = getattr(content, 'content_type', None)
+        if content_type:
+            headers['Content-Type'] = content_type
+        self._signed_request('PUT', name, body=content.read(), headers=headers)
+        return name
+
+    def delete(self, name):
+        self._signed_request('DELETE', name)
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def size(self, name):
+        found = self.head(name)
+        if found is None:
+            raise FileNotFoundError(name)
+        return found['size']
+
+    def url(self, name):
+        return self.presigned_url(name)
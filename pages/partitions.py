@@ -0,0 +1,149 @@
+"""
+Monthly range partitioning of ``Message`` on PostgreSQL, and archiving of
+old messages into the compressed ``MessageArchive`` table.
+
+Migration 0008 turns ``pages_message`` into a table partitioned by month on
+``timestamp`` (plus a default partition for anything out of range).  On other
+databases the table stays a plain table and archiving deletes rows in batches
+instead of dropping whole partitions.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import Message, MessageArchive
+
+TABLE = 'pages_message'
+
+
+def hot_window_start():
+    """Messages newer than this stay in the hot ``Message`` table."""
+    days = getattr(settings, 'MESSAGE_HOT_WINDOW_DAYS', 180)
+    return timezone.now() - timedelta(days=days)
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(month):
+    return f"{TABLE}_p{month:%Y_%m}"
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+            [TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def create_partition(cursor, month):
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {TABLE} "
+        f"FOR VALUES FROM (%s) TO (%s)",
+        [month, add_months(month, 1)],
+    )
+
+
+def ensure_partitions(using='default', months_ahead=None):
+    """Create this month's partition and the next ``months_ahead`` ones."""
+    connection = connections[using]
+    if not is_partitioned(connection):
+        return []
+    if months_ahead is None:
+        months_ahead = getattr(settings, 'MESSAGE_PARTITION_MONTHS_AHEAD', 3)
+    current = month_start(timezone.now())
+    months = [add_months(current, offset) for offset in range(months_ahead + 1)]
+    with connection.cursor() as cursor:
+        for month in months:
+            create_partition(cursor, month)
+    return [partition_name(month) for month in months]
+
+
+def monthly_partitions(connection):
+    """``(name, lower bound)`` for every monthly partition, oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(%s)",
+            [TABLE],
+        )
+        names = sorted(row[0] for row in cursor.fetchall())
+    prefix = f"{TABLE}_p"
+    return [
+        (name, datetime.strptime(name[len(prefix):], '%Y_%m').replace(tzinfo=dt_timezone.utc))
+        for name in names
+        if name.startswith(prefix)
+    ]
+
+
+def _archive_rows(messages, using, batch_size):
+    archived = 0
+    batch = []
+    for message in messages.iterator(chunk_size=batch_size):
+        batch.append(MessageArchive.from_message(message))
+        if len(batch) >= batch_size:
+            MessageArchive.objects.using(using).bulk_create(batch, ignore_conflicts=True)
+            archived += len(batch)
+            batch = []
+    if batch:
+        MessageArchive.objects.using(using).bulk_create(batch, ignore_conflicts=True)
+        archived += len(batch)
+    return archived
+
+
+def archive_messages(using='default', cutoff=None, batch_size=1000):
+    """
+    Move messages older than ``cutoff`` into ``MessageArchive``.
+
+    Monthly partitions entirely older than the cutoff are copied and then
+    dropped, which avoids a large DELETE; whatever is left (the default
+    partition, or the whole table off PostgreSQL) is moved in batches.
+    """
+    cutoff = cutoff or hot_window_start()
+    connection = connections[using]
+    archived = 0
+
+    if is_partitioned(connection):
+        for name, lower in monthly_partitions(connection):
+            upper = add_months(lower, 1)
+            if upper > cutoff:
+                break
+            with transaction.atomic(using=using):
+                archived += _archive_rows(
+                    Message.objects.using(using)
+                    .filter(timestamp__gte=lower, timestamp__lt=upper)
+                    .order_by('timestamp'),
+                    using,
+                    batch_size,
+                )
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
+
+    while True:
+        ids = list(
+            Message.objects.using(using)
+            .filter(timestamp__lt=cutoff)
+            .order_by('timestamp')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        with transaction.atomic(using=using):
+            archived += _archive_rows(
+                Message.objects.using(using).filter(id__in=ids), using, batch_size
+            )
+            Message.objects.using(using).filter(id__in=ids).delete()
+    return archived
@@ -0,0 +1,210 @@
+"""
+On-demand request profiling.
+
+A request is profiled when staff send ``X-Profile: 1`` (or ``?_profile=1``),
+or at random for ``PROFILING_SAMPLE_RATE`` of all requests.  While the view
+runs, a sampler thread records the request thread's stack every
+``PROFILING_INTERVAL_MS`` and a wrapper on every database connection times
+its queries.  The result is saved as a ``RequestProfile``: collapsed stacks
+(the input format of flamegraph.pl and speedscope), shown as a flame graph
+in the admin, and the SQL grouped by statement, slowest first.
+
+Requests that are not profiled only pay for the header check.
+"""
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .models import RequestProfile
+
+HEADER = 'HTTP_X_PROFILE'
+QUERY_FLAG = '_profile='
+
+# Paths are shown relative to the first of these they are under.
+ROOTS = sorted({str(Path(settings.BASE_DIR)), *sys.path}, key=len, reverse=True)
+
+
+def _interval():
+    return getattr(settings, 'PROFILING_INTERVAL_MS', 5) / 1000
+
+
+def requested(request):
+    return bool(request.META.get(HEADER)) or QUERY_FLAG in request.META.get('QUERY_STRING', '')
+
+
+def sampled():
+    rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def _short(filename):
+    for root in ROOTS:
+        if root and filename.startswith(root + '/'):
+            return filename[len(root) + 1:]
+    return filename
+
+
+def _label(code):
+    return f"{code.co_qualname} ({_short(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame, root):
+    """``frame``'s stack up to (not including) ``root``, outermost first, joined with ``;``."""
+    labels = []
+    while frame is not None and frame is not root:
+        # ';' separates frames in the collapsed format.
+        labels.append(_label(frame.f_code).replace(';', ','))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler(threading.Thread):
+    """Counts the stacks of thread ``thread_id`` below frame ``root`` every ``interval`` seconds."""
+
+    def __init__(self, thread_id, root, interval):
+        super().__init__(name='request-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame, self.root)] += 1
+                self.samples += 1
+            del frame
+
+    def finish(self):
+        self._done.set()
+        self.join()
+
+
+class QueryLog:
+    """An ``execute_wrapper`` timing every query, grouped by statement."""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            entry = self.statements.setdefault(sql, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+
+class Profile:
+    """Profiles the code run inside ``with``; the caller's frame is the root of the stacks."""
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.query_logs = [QueryLog(alias) for alias in connections]
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self._wrappers = ExitStack()
+        for log in self.query_logs:
+            self._wrappers.enter_context(connections[log.alias].execute_wrapper(log))
+        self.sampler = Sampler(threading.get_ident(), sys._getframe(1), _interval())
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sampler.finish()
+        self._wrappers.close()
+        self.duration_ms = (time.perf_counter() - self.started) * 1000
+        return False
+
+    def queries(self):
+        """``(count, ms, slowest statements)``."""
+        statements = [
+            {'sql': sql, 'count': count, 'ms': round(ms, 2), 'database': log.alias}
+            for log in self.query_logs
+            for sql, (count, ms) in log.statements.items()
+        ]
+        statements.sort(key=lambda statement: statement['ms'], reverse=True)
+        keep = getattr(settings, 'PROFILING_MAX_QUERIES', 50)
+        return (
+            sum(statement['count'] for statement in statements),
+            sum(statement['ms'] for statement in statements),
+            statements[:keep],
+        )
+
+    def save(self, request, response):
+        count, ms, statements = self.queries()
+        user = getattr(request, 'user', None)
+        profile = RequestProfile.objects.create(
+            method=request.method,
+            path=request.path[:255],
+            view=view_name(request),
+            status_code=response.status_code,
+            user_id=user.pk if user is not None and user.is_authenticated else None,
+            trigger=self.trigger,
+            duration_ms=self.duration_ms,
+            interval_ms=self.sampler.interval * 1000,
+            samples=self.sampler.samples,
+            stacks='\n'.join(f"{stack} {n}" for stack, n in self.sampler.stacks.most_common() if stack),
+            query_count=count,
+            query_ms=ms,
+            queries=statements,
+        )
+        days = getattr(settings, 'PROFILING_RETENTION_DAYS', 7)
+        RequestProfile.objects.filter(created_at__lt=timezone.now() - timedelta(days=days)).delete()
+        return profile
+
+
+def view_name(request):
+    """``ConversationViewSet.list`` style name of the view that handled ``request``."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return ''
+    view = getattr(match.func, 'cls', None) or getattr(match.func, 'view_class', None)
+    if view is None:
+        return match.view_name[:200]
+    action = (getattr(match.func, 'actions', None) or {}).get(request.method.lower(), request.method.lower())
+    return f"{view.__name__}.{action}"[:200]
+
+
+def is_staff(request):
+    """Whether ``request`` comes from staff, by any of the API's authentication classes."""
+    drf_request = Request(request)
+    for authentication in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            result = authentication().authenticate(drf_request)
+        except Exception:
+            continue
+        if result is not None:
+            return result[0].is_staff
+    return getattr(request, 'user', None) is not None and request.user.is_staff
+
+
+def tree(stacks):
+    """Collapsed stacks as nested ``{frame: [count, children]}``."""
+    root = {}
+    for line in stacks.splitlines():
+        stack, _, count = line.rpartition(' ')
+        node = root
+        for frame in stack.split(';'):
+            entry = node.setdefault(frame, [0, {}])
+            entry[0] += int(count)
+            node = entry[1]
+    return root
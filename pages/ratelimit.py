@@ -0,0 +1,219 @@
+"""
+Per-user, per-endpoint rate limits: a token bucket that allows short bursts
+plus a daily quota, for each scope in ``RATE_LIMITS``.
+
+Bucket state lives in this process by default (``RATE_LIMIT_BACKEND =
+'memory'``), which limits each worker on its own.  With ``'cache'`` it lives
+in the Django cache named by ``RATE_LIMIT_CACHE`` and is shared by every
+worker using that cache, which should then be Redis, Memcached or similar.
+
+Views opt in with ``RateLimitMixin`` and a ``rate_limit_scope``.  Refused
+requests get a 429 with ``Retry-After``; every limited response carries the
+remaining allowance in ``X-RateLimit-*`` headers, and ``/api/rate-limits/``
+reports it without using any.
+"""
+import math
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+# rate: sustained rate, burst: bucket size, daily: requests per UTC day.
+DEFAULT_LIMITS = {
+    'ai-chat': {'rate': '6/min', 'burst': 3, 'daily': 50},
+    'messages': {'rate': '30/min', 'burst': 20, 'daily': 2000},
+}
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+DAY = 86400
+
+# The memory backend forgets idle buckets once it holds this many.
+MAX_MEMORY_KEYS = 100000
+
+
+class Limit(NamedTuple):
+    capacity: float
+    refill: float  # Tokens per second
+    daily: Optional[int]
+
+
+class Usage(NamedTuple):
+    allowed: bool
+    tokens: float
+    capacity: float
+    daily_used: int
+    daily_limit: Optional[int]
+    retry_after: float  # Seconds until a request would be allowed, 0 if it is
+    daily_reset: float  # Epoch seconds at which the daily quota starts over
+
+    def as_dict(self):
+        return {
+            'allowed': self.allowed,
+            'remaining': math.floor(self.tokens),
+            'limit': int(self.capacity),
+            'daily_used': self.daily_used,
+            'daily_limit': self.daily_limit,
+            'retry_after': math.ceil(self.retry_after),
+            'daily_reset': int(self.daily_reset),
+        }
+
+
+def parse_limit(config):
+    count, _, period = config['rate'].partition('/')
+    return Limit(float(config.get('burst', count)), int(count) / PERIODS[period], config.get('daily'))
+
+
+def limits():
+    configured = getattr(settings, 'RATE_LIMITS', None) or DEFAULT_LIMITS
+    return {scope: parse_limit(config) for scope, config in configured.items()}
+
+
+def _apply(state, limit, now, consume):
+    """Refill, check and (if ``consume``) charge a bucket; returns the new state and the usage."""
+    day = int(now // DAY)
+    tokens, stamp, state_day, used = state or (limit.capacity, now, day, 0)
+    tokens = min(limit.capacity, tokens + (now - stamp) * limit.refill)
+    if state_day != day:
+        used = 0
+    daily_reset = (day + 1) * DAY
+    if limit.daily is not None and used >= limit.daily:
+        retry_after = daily_reset - now
+    elif tokens < 1:
+        retry_after = (1 - tokens) / limit.refill
+    else:
+        retry_after = 0.0
+    allowed = retry_after == 0
+    if allowed and consume:
+        tokens -= 1
+        used += 1
+    usage = Usage(allowed, tokens, limit.capacity, used, limit.daily, retry_after, daily_reset)
+    return (tokens, now, day, used), usage
+
+
+class MemoryBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+
+    def apply(self, key, limit, consume=True):
+        now = time.time()
+        with self.lock:
+            state, usage = _apply(self.states.get(key), limit, now, consume)
+            if consume:
+                if len(self.states) >= MAX_MEMORY_KEYS:
+                    self._forget_idle(now)
+                self.states[key] = state
+        return usage
+
+    def _forget_idle(self, now):
+        # Buckets untouched since yesterday are full and have a fresh quota,
+        # the same as no state at all.
+        today = int(now // DAY)
+        self.states = {key: state for key, state in self.states.items() if state[2] == today}
+
+
+class CacheBackend:
+    LOCK_ATTEMPTS = 50
+    LOCK_WAIT = 0.002
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def apply(self, key, limit, consume=True):
+        if not consume:
+            return _apply(self.cache.get(key), limit, time.time(), consume)[1]
+        # The cache API has no compare-and-set, so a short-lived lock key
+        # serializes updates to one bucket across workers.  If it can't be
+        # had, go ahead: at worst one extra request slips through.
+        lock = f'{key}:lock'
+        locked = False
+        for _ in range(self.LOCK_ATTEMPTS):
+            locked = self.cache.add(lock, 1, timeout=2)
+            if locked:
+                break
+            time.sleep(self.LOCK_WAIT)
+        try:
+            now = time.time()
+            state, usage = _apply(self.cache.get(key), limit, now, consume)
+            refill_time = (limit.capacity - state[0]) / limit.refill
+            self.cache.set(key, state, timeout=math.ceil(max(usage.daily_reset - now, refill_time)))
+        finally:
+            if locked:
+                self.cache.delete(lock)
+        return usage
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if getattr(settings, 'RATE_LIMIT_BACKEND', 'memory') == 'cache':
+                    _backend = CacheBackend(getattr(settings, 'RATE_LIMIT_CACHE', 'default'))
+                else:
+                    _backend = MemoryBackend()
+    return _backend
+
+
+def bucket_key(scope, ident):
+    return f'ratelimit:{scope}:{ident}'
+
+
+def take(scope, ident):
+    """Charge one request to ``ident`` in ``scope``; ``Usage.allowed`` says if it may proceed."""
+    return get_backend().apply(bucket_key(scope, ident), limits()[scope])
+
+
+def usage(ident):
+    """Current usage of every scope, without charging anything."""
+    return {
+        scope: get_backend().apply(bucket_key(scope, ident), limit, consume=False)
+        for scope, limit in limits().items()
+    }
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Charges the view's ``rate_limit_scope`` for ``rate_limited_methods``."""
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'rate_limit_scope', None)
+        if scope is None or request.method not in getattr(view, 'rate_limited_methods', ('POST',)):
+            return True
+        self.usage = take(scope, request_ident(request, self))
+        view.rate_limit_usage = self.usage
+        return self.usage.allowed
+
+    def wait(self):
+        return self.usage.retry_after
+
+
+def request_ident(request, throttle=None):
+    if request.user and request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f'ip:{(throttle or BaseThrottle()).get_ident(request)}'
+
+
+class RateLimitMixin:
+    """Rate-limits a view by ``rate_limit_scope`` and reports usage in headers."""
+    throttle_classes = [TokenBucketThrottle]
+    rate_limit_scope = None
+    rate_limited_methods = ('POST',)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        current = getattr(self, 'rate_limit_usage', None)
+        if current is not None:
+            response['X-RateLimit-Limit'] = str(int(current.capacity))
+            response['X-RateLimit-Remaining'] = str(math.floor(current.tokens))
+            if current.daily_limit is not None:
+                response['X-RateLimit-Daily-Limit'] = str(current.daily_limit)
+                response['X-RateLimit-Daily-Remaining'] = str(max(0, current.daily_limit - current.daily_used))
+                response['X-RateLimit-Daily-Reset'] = str(int(current.daily_reset))
+        return response
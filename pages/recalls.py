@@ -0,0 +1,142 @@
+"""
+Vaccination recall: patients whose next dose is coming up.
+
+Due doses are found through ``vaccination_due_idx`` on
+``(next_dose_date, id)``, never by scanning vaccinations.  ``page()`` serves
+the clinic-wide list a page at a time: every shard returns its next rows
+after the cursor in that order, and the pages are merged.  The cursor is
+the last row's ``(next_dose_date, id)``; ids are unique across shards.
+
+``notify_due()`` walks the due doses in chunks and records a
+``VaccinationRecall`` per dose and due date before notifying anyone, so a
+run that repeats or overlaps another never notifies twice.  Patients see
+their recalls in the app; with ``VACCINATION_RECALL_EMAIL`` they are also
+emailed.
+"""
+import base64
+import datetime
+import heapq
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import send_mass_mail
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q, Subquery
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from . import sharding
+from .models import Vaccination, VaccinationRecall
+
+CHUNK_SIZE = 1000
+
+
+def window(days=None, today=None):
+    """``(first, last)`` due date of doses due in the next ``days`` days."""
+    days = getattr(settings, 'VACCINATION_RECALL_DAYS', 14) if days is None else days
+    today = today or timezone.localdate()
+    return today, today + datetime.timedelta(days=days)
+
+
+def due(first, last):
+    """Vaccinations with a next dose between two dates, in recall order."""
+    return Vaccination.objects.filter(next_dose_date__gte=first, next_dose_date__lte=last).order_by('next_dose_date', 'id')
+
+
+def _after(queryset, cursor):
+    if cursor is None:
+        return queryset
+    due_date, pk = cursor
+    return queryset.filter(Q(next_dose_date__gt=due_date) | Q(next_dose_date=due_date, id__gt=pk))
+
+
+def encode_cursor(vaccination):
+    return base64.urlsafe_b64encode(f"{vaccination.next_dose_date.isoformat()}|{vaccination.pk}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        due_date, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.date.fromisoformat(due_date), int(pk)
+    except (ValueError, UnicodeError):
+        raise ValidationError({'cursor': ["Invalid cursor."]})
+
+
+def page(first, last, cursor=None, size=100, notified=None):
+    """
+    ``(vaccinations, next cursor or None)`` of the clinic-wide recall list.
+    Each vaccination carries ``notified_at``; ``notified`` True or False
+    keeps only doses already recalled or not.
+    """
+    recalled = VaccinationRecall.objects.filter(vaccination=OuterRef('pk'), due_date=OuterRef('next_dose_date'))
+    queryset = _after(due(first, last), cursor).annotate(
+        notified_at=Subquery(recalled.values('notified_at')[:1])
+    )
+    if notified is not None:
+        queryset = queryset.filter(notified_at__isnull=not notified)
+
+    shard_rows = sharding.fan_out(lambda alias: list(queryset.using(alias)[:size + 1]))
+    merged = list(heapq.merge(*shard_rows, key=lambda row: (row.next_dose_date, row.pk)))
+    rows = merged[:size]
+    next_cursor = encode_cursor(rows[-1]) if len(merged) > size else None
+
+    users = get_user_model().objects.using(sharding.GLOBAL_DB).in_bulk({row.user_id for row in rows})
+    for row in rows:
+        row.patient = users.get(row.user_id)
+    return rows, next_cursor
+
+
+def _send(recalls, vaccinations, users):
+    messages = []
+    for recall in recalls:
+        vaccination = vaccinations[recall.vaccination_id]
+        user = users.get(vaccination.user_id)
+        if user is None or not user.is_active:
+            continue
+        messages.append((
+            f"Your next {vaccination.name} dose is due",
+            f"Your next dose of {vaccination.name} is due on {recall.due_date:%B %d, %Y}. "
+            "Please book an appointment with your clinic.",
+            None,
+            [user.email],
+        ))
+    if messages:
+        send_mass_mail(messages, fail_silently=False)
+
+
+def notify_due(using, first, last, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Recall every dose on shard ``using`` due between ``first`` and ``last``
+    that hasn't been recalled for that date yet.  Returns the number of
+    patients notified.
+    """
+    recalled = VaccinationRecall.objects.using(using).filter(
+        vaccination=OuterRef('pk'), due_date=OuterRef('next_dose_date')
+    )
+    candidates = due(first, last).using(using).filter(~Exists(recalled)).only('id', 'user_id', 'name', 'next_dose_date')
+    notified = 0
+    cursor = None
+    while True:
+        chunk = list(_after(candidates, cursor)[:chunk_size])
+        if not chunk:
+            break
+        cursor = (chunk[-1].next_dose_date, chunk[-1].pk)
+        # One timestamp per chunk and run tells this run's claims apart
+        # from those of another run at the same time.
+        claimed_at = timezone.now()
+        with transaction.atomic(using=using):
+            VaccinationRecall.objects.using(using).bulk_create(
+                [VaccinationRecall(vaccination=row, due_date=row.next_dose_date, notified_at=claimed_at) for row in chunk],
+                ignore_conflicts=True,
+            )
+            claims = list(VaccinationRecall.objects.using(using).filter(
+                vaccination__in=chunk, notified_at=claimed_at
+            ))
+            if getattr(settings, 'VACCINATION_RECALL_EMAIL', False) and claims:
+                users = get_user_model().objects.using(sharding.GLOBAL_DB).in_bulk({row.user_id for row in chunk})
+                # A failed send rolls the claims back, so the next run tries again.
+                _send(claims, {row.pk: row for row in chunk}, users)
+        notified += len(claims)
+        if progress:
+            progress(using, notified)
+    return notified
@@ -0,0 +1,301 @@
+"""
+Semantic search over a patient's notes: health problems, allergies and
+messages.
+
+Each record is embedded when saved, by ``SEMANTIC_EMBEDDER``, into a unit
+vector stored as a ``NoteEmbedding``.  The default ``HashingEmbedder`` needs
+no model or network: the medical concepts of ``pages/data/medical_synonyms.txt``
+and hashed words and character trigrams make up a fixed number of
+dimensions, so "high BP" and "hypertension" share the concept's dimension.
+
+A search loads the patient's vectors into one float32 matrix (kept per
+worker for ``SEMANTIC_CACHE_SECONDS`` and dropped when the patient's notes
+change) and scores them all with a single matrix-vector product.
+"""
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import sharding
+from .models import Allergy, HealthProblem, Message, MessageArchive, NoteEmbedding
+
+SYNONYMS = Path(__file__).resolve().parent / 'data' / 'medical_synonyms.txt'
+
+WORD = re.compile(r"[a-z0-9']+")
+WORD_WEIGHT = 1.0
+TRIGRAM_WEIGHT = 0.3
+CONCEPT_WEIGHT = 3.0
+
+# Patients whose matrices each worker keeps.
+MAX_CACHED_USERS = 256
+
+
+@lru_cache(maxsize=None)
+def concepts():
+    """``(regex over every synonym phrase, {phrase: concept number})``."""
+    numbers = {}
+    phrases = {}
+    with open(SYNONYMS, encoding='utf-8') as lines:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            concept, _, listed = line.partition(':')
+            number = numbers.setdefault(concept.strip(), len(numbers))
+            for phrase in listed.split(','):
+                phrases[phrase.strip()] = number
+    # Longest first, so "high blood pressure" wins over "blood pressure".
+    alternatives = sorted(phrases, key=len, reverse=True)
+    pattern = re.compile(r"(?<![a-z0-9'])(?:" + "|".join(map(re.escape, alternatives)) + r")(?![a-z0-9'])")
+    return pattern, phrases
+
+
+class HashingEmbedder:
+    """
+    Each synonym concept gets a dimension of its own, so concepts never
+    collide; words and character trigrams are hashed into the rest.
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or getattr(settings, 'SEMANTIC_DIMENSIONS', 512)
+        self.name = f'hashing-v1-{self.dimensions}'
+        self.concept_count = max(concepts()[1].values(), default=-1) + 1
+        if self.dimensions < self.concept_count * 2:
+            raise ImproperlyConfigured(
+                f"SEMANTIC_DIMENSIONS must be at least {self.concept_count * 2} for the synonym table."
+            )
+
+    def features(self, text):
+        """``(column, weight)`` pairs of ``text``."""
+        text = " ".join(WORD.findall(text.lower()))
+        pattern, phrases = concepts()
+        features = [(phrases[match], CONCEPT_WEIGHT) for match in pattern.findall(text)]
+        hashed = []
+        for word in text.split():
+            hashed.append((f'w:{word}', WORD_WEIGHT))
+            padded = f' {word} '
+            hashed.extend((f't:{padded[i:i + 3]}', TRIGRAM_WEIGHT) for i in range(len(padded) - 2))
+        buckets = self.dimensions - self.concept_count
+        for feature, weight in hashed:
+            digest = zlib.crc32(feature.encode())
+            # The sign bit keeps colliding features from always adding up.
+            features.append((self.concept_count + digest % buckets, weight if digest & 0x80000000 else -weight))
+        return features
+
+    def embed(self, texts):
+        """An ``(len(texts), dimensions)`` float32 matrix of unit rows."""
+        rows, columns, values = [], [], []
+        for row, text in enumerate(texts):
+            for column, weight in self.features(text):
+                rows.append(row)
+                columns.append(column)
+                values.append(weight)
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(matrix, (rows, columns), values)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+
+@lru_cache(maxsize=None)
+def get_embedder():
+    return import_string(getattr(settings, 'SEMANTIC_EMBEDDER', 'pages.semantic.HashingEmbedder'))()
+
+
+# The text embedded for each kind of note.
+def _problem_text(problem):
+    return " ".join(filter(None, [problem.title, problem.description]))
+
+
+def _allergy_text(allergy):
+    return " ".join(filter(None, [allergy.title, allergy.description]))
+
+
+SOURCES = {
+    'healthproblem': (HealthProblem, _problem_text),
+    'allergy': (Allergy, _allergy_text),
+    'message': (Message, lambda message: message.content),
+}
+
+
+def _version_key(user_id):
+    return f'semantic:version:{user_id}'
+
+
+def _changed(user_id):
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), 1, timeout=None)
+
+
+def upsert(source, records, user_ids, using):
+    """Embed and store ``records`` of ``source``; ``user_ids`` are their patients."""
+    if not records:
+        return
+    embedder = get_embedder()
+    text = SOURCES[source][1]
+    vectors = embedder.embed([text(record) for record in records]).astype(np.float16)
+    NoteEmbedding.objects.using(using).bulk_create(
+        [
+            NoteEmbedding(user_id=user_id, source=source, object_id=record.pk,
+                          embedder=embedder.name, vector=vector.tobytes())
+            for record, user_id, vector in zip(records, user_ids, vectors)
+        ],
+        update_conflicts=True, unique_fields=['source', 'object_id'],
+        update_fields=['user', 'embedder', 'vector', 'updated_at'],
+    )
+    for user_id in set(user_ids):
+        _changed(user_id)
+
+
+def record_saved(source, record, using):
+    if source == 'message':
+        user_id = record.conversation.patient_id
+    else:
+        user_id = record.user_id
+    upsert(source, [record], [user_id], using)
+
+
+class _UserIndex:
+    __slots__ = ('version', 'loaded_at', 'sources', 'object_ids', 'matrix')
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def user_index(user_id, using):
+    """The patient's vectors as one matrix, from this worker's cache if current."""
+    version = cache.get(_version_key(user_id), 0)
+    max_age = getattr(settings, 'SEMANTIC_CACHE_SECONDS', 60)
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is not None and index.version == version and time.monotonic() - index.loaded_at < max_age:
+            _indexes.move_to_end(user_id)
+            return index
+
+    embedder = get_embedder()
+    rows = list(
+        NoteEmbedding.objects.using(using)
+        .filter(user_id=user_id, embedder=embedder.name)
+        .values_list('source', 'object_id', 'vector')
+    )
+    index = _UserIndex()
+    index.version = version
+    index.loaded_at = time.monotonic()
+    index.sources = np.array([row[0] for row in rows], dtype=object)
+    index.object_ids = np.array([row[1] for row in rows], dtype=np.int64)
+    if rows:
+        index.matrix = np.frombuffer(
+            b''.join(bytes(row[2]) for row in rows), dtype=np.float16
+        ).reshape(len(rows), embedder.dimensions).astype(np.float32)
+    else:
+        index.matrix = np.zeros((0, embedder.dimensions), dtype=np.float32)
+    with _indexes_lock:
+        _indexes[user_id] = index
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > MAX_CACHED_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _resolve(source, object_ids, using):
+    """Current text of each record that still exists, by id."""
+    model, text = SOURCES[source]
+    found = {record.pk: text(record) for record in model.objects.using(using).filter(pk__in=object_ids)}
+    if source == 'message':
+        # Old messages live on in the archive under the same id.
+        missing = [object_id for object_id in object_ids if object_id not in found]
+        if missing:
+            found.update(
+                (message.pk, message.content)
+                for message in MessageArchive.objects.using(using).filter(pk__in=missing)
+            )
+    return found
+
+
+def search(user_id, query, k=10, sources=None, using=None):
+    """The patient's ``k`` notes closest to ``query``, best first."""
+    using = using or sharding.shard_for_user(user_id)
+    index = user_index(user_id, using)
+    if not len(index.object_ids) or not query.strip():
+        return []
+    scores = index.matrix @ get_embedder().embed([query])[0]
+    if sources:
+        scores = np.where(np.isin(index.sources, list(sources)), scores, -np.inf)
+
+    # Room for hits whose records were deleted since they were embedded.
+    wanted = min(len(scores), k * 2)
+    top = np.argpartition(-scores, wanted - 1)[:wanted]
+    top = top[np.argsort(-scores[top])]
+    top = top[np.isfinite(scores[top]) & (scores[top] > 0)]
+
+    texts = {}
+    for source in set(index.sources[top]):
+        ids = [int(object_id) for object_id in index.object_ids[top][index.sources[top] == source]]
+        texts[source] = _resolve(source, ids, using)
+    results = []
+    stale = []
+    for position in top:
+        source, object_id = index.sources[position], int(index.object_ids[position])
+        if object_id not in texts[source]:
+            stale.append((source, object_id))
+            continue
+        if len(results) < k:
+            results.append({
+                'type': source,
+                'id': object_id,
+                'score': round(float(scores[position]), 4),
+                'text': texts[source][object_id][:300],
+            })
+    if stale:
+        for source, object_id in stale:
+            NoteEmbedding.objects.using(using).filter(source=source, object_id=object_id).delete()
+        _changed(user_id)
+    return results
+
+
+def rebuild(using, chunk_size=1000, progress=None):
+    """Embed every note on shard ``using``; returns how many."""
+    done = 0
+    for source, (model, _) in SOURCES.items():
+        queryset = model.objects.using(using).order_by('pk')
+        if source == 'message':
+            queryset = queryset.select_related('conversation')
+        last_pk = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            if source == 'message':
+                user_ids = [record.conversation.patient_id for record in chunk]
+            else:
+                user_ids = [record.user_id for record in chunk]
+            upsert(source, chunk, user_ids, using)
+            done += len(chunk)
+            if progress:
+                progress(source, done)
+    # Archived messages keep the ids they had as messages.
+    archive = MessageArchive.objects.using(using).select_related('conversation').order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(archive.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        upsert('message', chunk, [record.conversation.patient_id for record in chunk], using)
+        done += len(chunk)
+        if progress:
+            progress('message archive', done)
+    return done
@@ -1,8 +1,10 @@
 from rest_framework import serializers
 from rest_framework.validators import ValidationError
-from .models import Allergy, HealthProblem, Medication, LabReport, Imaging, Vaccination, UserFiles, Medication2, MedicationReminder, Conversation, Message, Pregnancy
+from .models import Allergy, HealthProblem, Medication, LabReport, Imaging, Vaccination, UserFiles, Medication2, MedicationReminder, Conversation, Message, MessageArchive, Pregnancy, ImportJob, PatientSummary, VitalsAlert, AuditEvent, AIChatSession, AIChatTurn, HealthInsight, LabResult, AccountDeletion, DoseEvent, UserAdherence, VaccinationRecall
 import re
 
+from . import adherence
+
 class UserFilesSerializer(serializers.ModelSerializer):
     body_mass_index = serializers.SerializerMethodField()
     body_surface_area = serializers.SerializerMethodField()
@@ -40,10 +42,21 @@ class UserFilesSerializer(serializers.ModelSerializer):
         return data
 
 
-class AllergySerializer(serializers.ModelSerializer):
+class StatusSerializerMixin(serializers.Serializer):
+    """``status`` is 'active' or 'past', from ``with_status()`` when annotated."""
+    status = serializers.SerializerMethodField()
+
+    def get_status(self, obj):
+        passed = getattr(obj, 'status_is_passed', None)
+        if passed is None:
+            passed = obj.effective_is_passed
+        return 'past' if passed else 'active'
+
+
+class AllergySerializer(StatusSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Allergy
-        fields = '__all__'
+        exclude = ('import_key',)
         read_only_fields = ('user', 'created_at', 'updated_at')
 
     def validate(self, data):
@@ -55,20 +68,20 @@ class AllergySerializer(serializers.ModelSerializer):
 class HealthProblemSerializer(serializers.ModelSerializer):
     class Meta:
         model = HealthProblem
-        fields = '__all__'
+        exclude = ('import_key',)
         read_only_fields = ('user', 'created_at', 'updated_at')
 
-class MedicationSerializer(serializers.ModelSerializer):
+class MedicationSerializer(StatusSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Medication
-        fields = '__all__'
+        exclude = ('import_key',)
         read_only_fields = ('user', 'created_at', 'updated_at')
 
 class LabReportSerializer(serializers.ModelSerializer):
     class Meta:
         model = LabReport
         fields = '__all__'
-        read_only_fields = ('user', 'created_at', 'updated_at')
+        read_only_fields = ('user', 'created_at', 'updated_at', 'extraction_status', 'extracted_file')
         extra_kwargs = {
             'file': {'required': True}
         }
@@ -82,12 +95,43 @@ class ImagingSerializer(serializers.ModelSerializer):
             'file': {'required': True}
         }
 
+# For records whose file was uploaded straight to object storage: the file
+# is set from the finalized upload, not sent.
+
+class LabReportUploadSerializer(LabReportSerializer):
+    class Meta(LabReportSerializer.Meta):
+        read_only_fields = LabReportSerializer.Meta.read_only_fields + ('file',)
+        extra_kwargs = {}
+
+class ImagingUploadSerializer(ImagingSerializer):
+    class Meta(ImagingSerializer.Meta):
+        read_only_fields = ImagingSerializer.Meta.read_only_fields + ('file',)
+        extra_kwargs = {}
+
 class VaccinationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Vaccination
-        fields = '__all__'
+        exclude = ('import_key',)
         read_only_fields = ('user', 'created_at', 'updated_at')
 
+class VaccinationRecallSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source='vaccination.name', read_only=True)
+
+    class Meta:
+        model = VaccinationRecall
+        fields = ['id', 'vaccination', 'name', 'due_date', 'notified_at']
+        read_only_fields = fields
+
+class DueVaccinationSerializer(serializers.ModelSerializer):
+    """A row of the clinic-wide recall list."""
+    patient_email = serializers.EmailField(source='patient.email', default=None, read_only=True)
+    notified_at = serializers.DateTimeField(read_only=True)
+
+    class Meta:
+        model = Vaccination
+        fields = ['id', 'user', 'patient_email', 'name', 'date_administered', 'next_dose_date', 'notified_at']
+        read_only_fields = fields
+
 class MedicationReminderSerializer(serializers.ModelSerializer):
     class Meta:
         model = MedicationReminder
@@ -96,11 +140,42 @@ class MedicationReminderSerializer(serializers.ModelSerializer):
 
 class Medication2Serializer(serializers.ModelSerializer):
     reminders = MedicationReminderSerializer(many=True, read_only=True)
+    adherence = serializers.FloatField(read_only=True)
     
     class Meta:
         model = Medication2
         fields = '__all__'
-        read_only_fields = ('user', 'created_at')
+        read_only_fields = ('user', 'created_at', 'doses_taken', 'doses_missed', 'doses_checked_through')
+
+class DoseEventSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DoseEvent
+        fields = ['id', 'medication', 'scheduled_at', 'taken', 'taken_at']
+        # Posting a dose again changes it instead of failing.
+        validators = []
+
+    def validate_medication(self, medication):
+        if medication.user_id != self.context['request'].user.pk:
+            raise ValidationError("Unknown medication.")
+        return medication
+
+    def validate(self, attrs):
+        if not adherence.is_scheduled(attrs['medication'], attrs['scheduled_at']):
+            raise ValidationError({'scheduled_at': ["Not a scheduled dose of this medication."]})
+        if attrs.get('taken_at') and not attrs['taken']:
+            raise ValidationError({'taken_at': ["Only taken doses have a time taken."]})
+        return attrs
+
+    def create(self, validated_data):
+        event, _ = adherence.record(**validated_data)
+        return event
+
+class UserAdherenceSerializer(serializers.ModelSerializer):
+    adherence = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = UserAdherence
+        fields = ['doses_taken', 'doses_missed', 'adherence', 'updated_at']
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -108,6 +183,14 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'sender', 'content', 'timestamp']
         read_only_fields = ['sender', 'timestamp']
 
+class ArchivedMessageSerializer(serializers.ModelSerializer):
+    content = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = MessageArchive
+        fields = ['id', 'sender', 'content', 'timestamp']
+        read_only_fields = fields
+
 class ConversationSerializer(serializers.ModelSerializer):
     messages = MessageSerializer(many=True, read_only=True)
     patient = serializers.StringRelatedField()
@@ -127,3 +210,84 @@ class PregnancySerializer(serializers.ModelSerializer):
             'start_date': {'required': True},
         }
 
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    progress = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+        fields = [
+            'id', 'source', 'format', 'resource', 'create_users', 'status', 'progress',
+            'total_bytes', 'bytes_done', 'rows_read', 'rows_imported', 'rows_failed',
+            'rows_skipped', 'errors', 'created_at', 'updated_at',
+        ]
+        read_only_fields = [
+            'status', 'total_bytes', 'bytes_done', 'rows_read', 'rows_imported',
+            'rows_failed', 'rows_skipped', 'errors', 'created_at', 'updated_at',
+        ]
+        extra_kwargs = {
+            'source': {'required': True, 'write_only': True},
+        }
+
+    def validate(self, data):
+        if data.get('format') == 'csv' and not data.get('resource'):
+            raise serializers.ValidationError("CSV imports need a resource")
+        return data
+
+class VitalsAlertSerializer(serializers.ModelSerializer):
+    patient = serializers.IntegerField(source='conversation.patient_id', read_only=True)
+
+    class Meta:
+        model = VitalsAlert
+        exclude = ['suppressed']
+        read_only_fields = [field.name for field in VitalsAlert._meta.fields]
+
+class PatientSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PatientSummary
+        exclude = ['doctor']
+        read_only_fields = [field.name for field in PatientSummary._meta.fields]
+
+class AuditEventSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AuditEvent
+        fields = '__all__'
+        read_only_fields = [field.name for field in AuditEvent._meta.fields]
+
+class AccountDeletionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AccountDeletion
+        fields = '__all__'
+        read_only_fields = [field.name for field in AccountDeletion._meta.fields]
+
+class AIChatTurnSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AIChatTurn
+        fields = ['id', 'role', 'content', 'created_at']
+        read_only_fields = fields
+
+class AIChatSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AIChatSession
+        fields = ['id', 'title', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+class AIChatSessionDetailSerializer(AIChatSessionSerializer):
+    turns = AIChatTurnSerializer(many=True, read_only=True)
+
+    class Meta(AIChatSessionSerializer.Meta):
+        fields = AIChatSessionSerializer.Meta.fields + ['summary', 'turns']
+        read_only_fields = fields
+
+class LabResultSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = LabResult
+        fields = ['id', 'report', 'analyte', 'name', 'value', 'value_text', 'unit',
+                  'reference_low', 'reference_high', 'flag', 'observed_on']
+        read_only_fields = fields
+
+class HealthInsightSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = HealthInsight
+        fields = ['content', 'covers_until', 'generated_at']
+        read_only_fields = fields
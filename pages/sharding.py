@@ -0,0 +1,319 @@
+"""
+Horizontal sharding of patient data.
+
+Every row in the ``pages`` app belongs to exactly one patient, so a patient's
+whole record lives on a single shard chosen from ``user_id``.  ``CustomUser``
+and the auth tables stay global on ``default``.  Every database carries the
+full schema and every shard keeps a reference copy of the users table, so
+patient and doctor foreign keys hold; routing alone decides where rows live.
+
+Placement is recorded in ``PatientShard`` (on ``default``) the first time a
+patient is seen, using rendezvous hashing over ``PATIENT_SHARDS`` so that
+adding a shard only moves the patients that hash onto it.  The
+``rebalance_shards`` management command moves existing patients to match.
+Workers cache placements under a version kept in the shared cache, which a
+move bumps, so every worker routes a moved patient to the new shard.
+
+Queries that give the router an instance (``obj.save()``, related managers)
+find the right shard by themselves.  Everything else, such as
+``Allergy.objects.filter(...)`` or ``objects.create(...)``, goes to the shard
+pinned for the current request by ``PatientShardMixin``, or to the one set
+with ``pinned_to()`` in scripts and jobs.
+"""
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import IntegrityError, connections, models
+
+GLOBAL_DB = 'default'
+
+# Shard used for sharded models when a query gives the router no instance to
+# go by, e.g. ``Allergy.objects.filter(...)`` while serving a patient.
+_pinned_shard = ContextVar('pinned_shard', default=None)
+
+# Each shard allocates primary keys from its own range, so ids stay unique
+# across shards and rows keep their ids when a patient is moved.
+ID_RANGE = 10 ** 12
+
+# Bumped in the shared cache when patients move; each process caches
+# placements under the version it last saw.
+PLACEMENTS_VERSION_KEY = 'pages:sharding:placements:version'
+
+# Models whose rows belong to one patient, with the attribute path that
+# leads from an instance to that patient's id.
+SHARDED_MODELS = {
+    'pages.userfiles': 'user_id',
+    'pages.allergy': 'user_id',
+    'pages.medication': 'user_id',
+    'pages.healthproblem': 'user_id',
+    'pages.labreport': 'user_id',
+    'pages.imaging': 'user_id',
+    'pages.vaccination': 'user_id',
+    'pages.vaccinationrecall': 'vaccination.user_id',
+    'pages.medication2': 'user_id',
+    'pages.medicationreminder': 'medication.user_id',
+    'pages.doseevent': 'medication.user_id',
+    'pages.useradherence': 'user_id',
+    'pages.conversation': 'patient_id',
+    'pages.message': 'conversation.patient_id',
+    'pages.messagearchive': 'conversation.patient_id',
+    'pages.vitalsalert': 'conversation.patient_id',
+    'pages.pregnancy': 'user_id',
+    'pages.aichatsession': 'user_id',
+    'pages.aichatturn': 'session.user_id',
+    'pages.healthinsight': 'user_id',
+    'pages.noteembedding': 'user_id',
+    'pages.labresult': 'user_id',
+    'pages.vitalsbatch': 'user_id',
+}
+
+
+def sharded_models():
+    """Sharded models in dependency order, parents before children."""
+    return [apps.get_model(label) for label in SHARDED_MODELS]
+
+
+def shard_aliases():
+    return list(getattr(settings, 'PATIENT_SHARDS', None) or [GLOBAL_DB])
+
+
+def is_sharded():
+    return shard_aliases() != [GLOBAL_DB]
+
+
+def is_sharded_model(model):
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+def hashed_shard(user_id, aliases=None):
+    """Rendezvous (highest random weight) placement for ``user_id``."""
+    aliases = aliases or shard_aliases()
+    return max(aliases, key=lambda alias: zlib.crc32(f"{alias}:{user_id}".encode()))
+
+
+def _placements_version():
+    version = cache.get(PLACEMENTS_VERSION_KEY)
+    if version is None:
+        # Never a version seen before, in case the key was evicted.
+        cache.add(PLACEMENTS_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(PLACEMENTS_VERSION_KEY)
+    return version
+
+
+@lru_cache(maxsize=65536)
+def _cached_shard(user_id, version):
+    from .models import PatientShard
+
+    shard = (
+        PatientShard.objects.using(GLOBAL_DB)
+        .filter(user_id=user_id)
+        .values_list('shard', flat=True)
+        .first()
+    )
+    if shard is None:
+        try:
+            shard = PatientShard.objects.using(GLOBAL_DB).create(
+                user_id=user_id, shard=hashed_shard(user_id)
+            ).shard
+        except IntegrityError:
+            # Another worker placed this patient first.
+            shard = PatientShard.objects.using(GLOBAL_DB).get(user_id=user_id).shard
+    return shard
+
+
+def shard_for_user(user):
+    """Return the database alias holding ``user``'s medical record."""
+    user_id = getattr(user, 'pk', user)
+    if user_id is None or not is_sharded():
+        return GLOBAL_DB
+    # Keyed by the shared version, so a move seen by one process is seen by all.
+    return _cached_shard(user_id, _placements_version())
+
+
+def pin(alias):
+    """Pin unhinted queries to ``alias``; returns a token for ``unpin``."""
+    return _pinned_shard.set(alias)
+
+
+def unpin(token):
+    _pinned_shard.reset(token)
+
+
+@contextmanager
+def pinned_to(alias):
+    token = pin(alias)
+    try:
+        yield alias
+    finally:
+        unpin(token)
+
+
+def forget_placements():
+    """Drop cached placements in every process, e.g. after patients have been moved."""
+    try:
+        cache.incr(PLACEMENTS_VERSION_KEY)
+    except ValueError:
+        # No version yet, so nothing has been cached under one.
+        pass
+    _cached_shard.cache_clear()
+
+
+def user_lookup(model):
+    """ORM lookup from ``model`` to its patient's id, e.g. ``medication__user_id``."""
+    return SHARDED_MODELS[model._meta.label_lower].replace('.', '__')
+
+
+def user_id_for_instance(instance):
+    path = SHARDED_MODELS.get(instance._meta.label_lower)
+    if path is None:
+        return None
+    value = instance
+    *relations, attname = path.split('.')
+    for name in relations:
+        # Only follow relations that are already loaded; fetching them here
+        # would ask the router for a database again.
+        field = value._meta.get_field(name)
+        if not field.is_cached(value):
+            return None
+        value = getattr(value, name)
+    return getattr(value, attname)
+
+
+def fan_out(func, aliases=None):
+    """Call ``func(alias)`` on every shard in parallel and return the results."""
+    aliases = aliases or shard_aliases()
+    if len(aliases) == 1:
+        return [func(aliases[0])]
+
+    def run(alias):
+        try:
+            return func(alias)
+        finally:
+            # Connections are per thread; don't leak one per call.
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=len(aliases)) as pool:
+        return list(pool.map(run, aliases))
+
+
+def fan_out_queryset(queryset, aliases=None):
+    """Evaluate ``queryset`` on every shard and return the concatenated rows."""
+    rows = []
+    for chunk in fan_out(lambda alias: list(queryset.using(alias)), aliases):
+        rows.extend(chunk)
+    return rows
+
+
+def count_across_shards(queryset, aliases=None):
+    return sum(fan_out(lambda alias: queryset.using(alias).count(), aliases))
+
+
+def aggregate_across_shards(queryset, **aggregates):
+    """
+    Run an aggregate on every shard and combine the partial results.
+
+    Only additive aggregates (``Count``, ``Sum``) combine correctly this way.
+    """
+    totals = {}
+    for partial in fan_out(lambda alias: queryset.using(alias).aggregate(**aggregates)):
+        for key, value in partial.items():
+            totals[key] = (totals.get(key) or 0) + (value or 0)
+    return totals
+
+
+def reserve_id_range(alias):
+    """Point ``alias``'s id sequences for sharded tables into its own range."""
+    aliases = shard_aliases()
+    if not is_sharded() or alias not in aliases:
+        return
+    low = (aliases.index(alias) + 1) * ID_RANGE
+    high = low + ID_RANGE
+    connection = connections[alias]
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    with connection.cursor() as cursor:
+        for model in sharded_models():
+            if not isinstance(model._meta.pk, models.AutoField):
+                continue
+            table = model._meta.db_table
+            cursor.execute(
+                f"SELECT MAX(id) FROM {connection.ops.quote_name(table)} WHERE id >= %s AND id < %s",
+                [low, high],
+            )
+            value = max(low, cursor.fetchone()[0] or 0)
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", [table, value])
+            else:
+                # Explicit ids inserted by a move also bump sqlite_sequence,
+                # so it is reset from the rows in this shard's own range.
+                # SQLite still numbers past the table's largest id, so once
+                # a patient from a later shard moves in, new ids follow
+                # theirs; SQLite shards are for local development only.
+                cursor.execute("DELETE FROM sqlite_sequence WHERE name = %s", [table])
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, value])
+
+
+def replicate_user(user):
+    """Copy ``user`` to every shard so patient rows can reference it."""
+    UserModel = get_user_model()
+    fields = {
+        field.attname: getattr(user, field.attname)
+        for field in UserModel._meta.concrete_fields
+        if not field.primary_key
+    }
+    for alias in shard_aliases():
+        if alias != GLOBAL_DB:
+            UserModel.objects.using(alias).update_or_create(pk=user.pk, defaults=fields)
+
+
+def remove_user_replicas(user_id):
+    """Delete a user's reference copies, cascading to their sharded rows."""
+    UserModel = get_user_model()
+    for alias in shard_aliases():
+        if alias != GLOBAL_DB:
+            UserModel.objects.using(alias).filter(pk=user_id).delete()
+
+
+class PatientShardRouter:
+    """
+    Routes sharded ``pages`` models to the patient's shard and everything
+    else to ``default``.
+    """
+
+    def _shard_for_hints(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is None:
+            return _pinned_shard.get()
+        if is_sharded_model(type(instance)) and instance._state.db:
+            return instance._state.db
+        if isinstance(instance, get_user_model()):
+            return shard_for_user(instance)
+        if is_sharded_model(type(instance)):
+            user_id = user_id_for_instance(instance)
+            if user_id is not None:
+                return shard_for_user(user_id)
+        return _pinned_shard.get()
+
+    def db_for_read(self, model, **hints):
+        if not is_sharded_model(model):
+            return GLOBAL_DB
+        return self._shard_for_hints(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        if not is_sharded_model(model):
+            return GLOBAL_DB
+        return self._shard_for_hints(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        UserModel = get_user_model()
+        if isinstance(obj1, UserModel) or isinstance(obj2, UserModel):
+            return True
+        return obj1._state.db == obj2._state.db
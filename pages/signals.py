@@ -0,0 +1,119 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import adherence, alerts, autocomplete, labs, sharding, summaries
+from .models import Allergy, Conversation, HealthProblem, LabReport, Medication, Medication2, Message, UserFiles
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def replicate_user_to_shards(sender, instance, using, update_fields=None, **kwargs):
+    if using != sharding.GLOBAL_DB or not sharding.is_sharded():
+        return
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        # Logins don't change anything the shards rely on.
+        return
+    sharding.replicate_user(instance)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def remove_user_from_shards(sender, instance, using, **kwargs):
+    if using != sharding.GLOBAL_DB or not sharding.is_sharded():
+        return
+    # Deleting the reference copy cascades to the patient's sharded rows.
+    sharding.remove_user_replicas(instance.pk)
+    sharding.forget_placements()
+
+
+@receiver(post_migrate)
+def reserve_shard_id_range(sender, using, **kwargs):
+    if sender.name == 'pages':
+        sharding.reserve_id_range(using)
+
+
+# Doctor overview summaries (see summaries.py).  Raw saves come from
+# fixtures and shard moves, which don't change what a patient's record says.
+
+def _refresh_summary(parts):
+    def handler(sender, instance, using, raw=False, **kwargs):
+        if not raw:
+            summaries.refresh(instance.user_id, parts, using)
+    return handler
+
+
+for model, part in [
+    (UserFiles, 'vitals'),
+    (Allergy, 'allergies'),
+    (Medication, 'medications'),
+    (Medication2, 'medications'),
+]:
+    handler = _refresh_summary((part,))
+    post_save.connect(handler, sender=model, weak=False, dispatch_uid=f'summary-{model.__name__}-save')
+    post_delete.connect(handler, sender=model, weak=False, dispatch_uid=f'summary-{model.__name__}-delete')
+
+
+@receiver(post_save, sender=UserFiles)
+@receiver(post_delete, sender=UserFiles)
+def mark_population_analytics_stale(sender, instance, raw=False, **kwargs):
+    if not raw:
+        from . import analytics  # Keeps NumPy out of startup
+        analytics.mark_stale()
+
+
+@receiver(post_save, sender=UserFiles)
+def check_vitals_alerts(sender, instance, using, raw=False, **kwargs):
+    if not raw:
+        alerts.vitals_saved(instance, using)
+
+
+@receiver(post_save, sender=Medication)
+@receiver(post_save, sender=Medication2)
+def index_medication_name(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        autocomplete.name_used(instance.name)
+
+
+@receiver(post_save, sender=Message)
+def summarize_message(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        summaries.message_sent(instance)
+
+
+# Semantic search index (see semantic.py).  Deleted notes drop out of the
+# index the first time a search turns them up.
+
+@receiver(post_save, sender=HealthProblem)
+@receiver(post_save, sender=Allergy)
+@receiver(post_save, sender=Message)
+def index_note(sender, instance, using, raw=False, **kwargs):
+    if not raw:
+        from . import semantic  # Keeps NumPy out of startup
+        semantic.record_saved(sender._meta.model_name, instance, using)
+
+
+@receiver(pre_delete, sender=Medication2)
+def drop_medication_adherence(sender, instance, using, **kwargs):
+    adherence.medication_deleted(instance, using)
+
+
+@receiver(post_save, sender=LabReport)
+def extract_lab_values(sender, instance, using, raw=False, **kwargs):
+    if not raw:
+        labs.report_saved(instance, using)
+
+
+@receiver(post_save, sender=Conversation)
+def summarize_conversation(sender, instance, created, using, raw=False, **kwargs):
+    if created and not raw:
+        summaries.add_pair(instance, using)
+
+
+@receiver(post_delete, sender=Conversation)
+def drop_conversation_summary(sender, instance, **kwargs):
+    summaries.remove_pair(instance)
+
+
+@receiver(post_save, sender='accounts.Profile')
+def summarize_profile(sender, instance, raw=False, **kwargs):
+    if not raw:
+        summaries.refresh(instance.user_id, ('profile',))
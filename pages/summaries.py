@@ -0,0 +1,121 @@
+"""
+Maintenance of ``PatientSummary``, the denormalized doctor overview.
+
+Each change to a patient's record refreshes only the part of the summary it
+affects, for every doctor row of that patient.  Records live on the patient's
+shard; summaries always live on ``default``.
+"""
+from django.contrib.auth import get_user_model
+
+from . import sharding
+from .models import Allergy, Conversation, Medication, Medication2, Message, PatientSummary, UserAdherence, UserFiles
+
+PARTS = ('profile', 'vitals', 'allergies', 'medications', 'adherence', 'messages')
+
+
+def _summaries(patient_id):
+    return PatientSummary.objects.using(sharding.GLOBAL_DB).filter(patient_id=patient_id)
+
+
+def _profile_fields(patient_id):
+    user = get_user_model().objects.using(sharding.GLOBAL_DB).select_related('profile').get(pk=patient_id)
+    profile = getattr(user, 'profile', None)
+    name = (profile.full_name if profile else None) or f"{user.first_name} {user.last_name}".strip()
+    return {'patient_email': user.email, 'patient_name': name}
+
+
+def _vitals_fields(patient_id, using):
+    vitals = UserFiles.objects.using(using).filter(user_id=patient_id).first()
+    if vitals is None:
+        return dict.fromkeys([
+            'heart_rate', 'blood_pressure', 'blood_sugar_level', 'oxygen_saturation',
+            'respiratory_rate', 'body_mass_index', 'vitals_updated_at',
+        ])
+    return {
+        'heart_rate': vitals.heart_rate,
+        'blood_pressure': vitals.blood_pressure,
+        'blood_sugar_level': vitals.blood_sugar_level,
+        'oxygen_saturation': vitals.oxygen_saturation,
+        'respiratory_rate': vitals.respiratory_rate,
+        'body_mass_index': vitals.body_mass_index,
+        'vitals_updated_at': vitals.updated_at,
+    }
+
+
+def _allergy_fields(patient_id, using):
+    titles = list(
+        Allergy.objects.using(using).filter(user_id=patient_id).active().values_list('title', flat=True)
+    )
+    return {'active_allergies': titles, 'active_allergy_count': len(titles)}
+
+
+def _medication_fields(patient_id, using):
+    names = list(
+        Medication.objects.using(using).filter(user_id=patient_id).active().values_list('name', flat=True)
+    )
+    names += Medication2.objects.using(using).filter(user_id=patient_id).active_names()
+    return {'active_medications': names, 'active_medication_count': len(names)}
+
+
+def _adherence_fields(patient_id, using):
+    totals = UserAdherence.objects.using(using).filter(user_id=patient_id).first()
+    return {'adherence': totals.adherence if totals else None}
+
+
+FIELDS = {
+    'profile': lambda patient_id, using: _profile_fields(patient_id),
+    'vitals': _vitals_fields,
+    'allergies': _allergy_fields,
+    'medications': _medication_fields,
+    'adherence': _adherence_fields,
+}
+
+
+def refresh(patient_id, parts=PARTS, using=None):
+    """Recompute ``parts`` of every summary row for ``patient_id``."""
+    summaries = _summaries(patient_id)
+    if not summaries.exists():
+        return
+    using = using or sharding.shard_for_user(patient_id)
+    fields = {}
+    for part in parts:
+        if part in FIELDS:
+            fields.update(FIELDS[part](patient_id, using))
+    if fields:
+        summaries.update(**fields)
+    if 'messages' in parts:
+        refresh_last_messages(patient_id, using)
+
+
+def refresh_last_messages(patient_id, using):
+    for conversation in Conversation.objects.using(using).filter(patient_id=patient_id):
+        last = (
+            Message.objects.using(using)
+            .filter(conversation=conversation)
+            .order_by('-timestamp')
+            .values_list('timestamp', flat=True)
+            .first()
+        )
+        _summaries(patient_id).filter(doctor_id=conversation.doctor_id).update(last_message_at=last)
+
+
+def message_sent(message):
+    conversation = message.conversation
+    _summaries(conversation.patient_id).filter(doctor_id=conversation.doctor_id).update(
+        last_message_at=message.timestamp
+    )
+
+
+def add_pair(conversation, using):
+    """Create the summary row for a new doctor and patient pair."""
+    _, created = PatientSummary.objects.using(sharding.GLOBAL_DB).get_or_create(
+        doctor_id=conversation.doctor_id,
+        patient_id=conversation.patient_id,
+        defaults=_profile_fields(conversation.patient_id),
+    )
+    if created:
+        refresh(conversation.patient_id, using=using)
+
+
+def remove_pair(conversation):
+    _summaries(conversation.patient_id).filter(doctor_id=conversation.doctor_id).delete()
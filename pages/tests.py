@@ -1,3 +1,1070 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.core.management import call_command
+from django.db import DatabaseError, connections
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import aichat, audit, deletion, importer, insights, loadshed, interactions, sharding, summaries
+from .models import (
+    AccountDeletion, AIChatSession, AuditEvent, AIChatTurn, Allergy, Conversation, DeletedFile, DoseEvent, HealthInsight,
+    ImportJob, Imaging, InsightRun, LabReport, Medication, Medication2, Message, MessageArchive, PatientShard, PatientSummary,
+    UserFiles, VitalsAlert,
+)
+
+
+class FakeObjectStorage(Storage):
+    """In-memory stand-in for ``objectstore.S3Storage``'s direct upload API."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def presigned_post(self, name, max_bytes, content_type=None, expires=None):
+        fields = {'key': name}
+        if content_type:
+            fields['Content-Type'] = content_type
+        return {'url': 'https://objects.test/medical/', 'fields': fields}
+
+    def put(self, name, data, content_type):
+        """What the client's POST of the presigned form does."""
+        self.objects[name] = (data, content_type)
+
+    def head(self, name):
+        if name not in self.objects:
+            return None
+        data, content_type = self.objects[name]
+        return {'size': len(data), 'content_type': content_type, 'etag': ''}
+
+    def exists(self, name):
+        return name in self.objects
+
+    def delete(self, name):
+        self.objects.pop(name, None)
+
+    def url(self, name):
+        return f"https://objects.test/medical/{name}"
+
+
+@override_settings(
+    UPLOAD_MAX_BYTES=1000, UPLOAD_URL_SECONDS=60, LAB_EXTRACTION_IN_BACKGROUND=True, AUDIT_ENABLED=False,
+)
+class DirectUploadTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.storage = FakeObjectStorage()
+        for model in (LabReport, Imaging):
+            patcher = mock.patch.object(model._meta.get_field('file'), 'storage', self.storage)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = get_user_model().objects.create_user(email='patient@example.com', password='pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def reports(self):
+        return LabReport.objects.using(sharding.shard_for_user(self.user)).filter(user=self.user)
+
+    def start(self, filename='report.pdf', **data):
+        return self.client.post(reverse('direct-upload'), {'type': 'labreport', 'filename': filename, **data})
+
+    def finalize(self, token):
+        return self.client.post(reverse('finalize-upload'), {'token': token, 'report_date': '2024-05-01'})
+
+    def test_start_pins_the_key_and_content_type(self):
+        response = self.start(size=10)
+        self.assertEqual(response.status_code, 201)
+        fields = response.data['fields']
+        self.assertEqual(fields['key'], response.data['key'])
+        self.assertTrue(fields['key'].startswith('lab_reports/'))
+        self.assertTrue(fields['key'].endswith('report.pdf'))
+        self.assertEqual(fields['Content-Type'], 'application/pdf')
+        self.assertEqual(response.data['max_bytes'], 1000)
+
+    def test_start_rejects_bad_files(self):
+        self.assertEqual(self.start(filename='report.exe').status_code, 400)
+        self.assertEqual(self.start(content_type='image/png').status_code, 400)
+        self.assertEqual(self.start(size=1001).status_code, 400)
+
+    def test_finalize_creates_the_record_once(self):
+        upload = self.start().data
+        self.storage.put(upload['key'], b'%PDF-1.4', 'application/pdf')
+
+        response = self.finalize(upload['token'])
+        self.assertEqual(response.status_code, 201)
+        report = self.reports().get()
+        self.assertEqual(report.file.name, upload['key'])
+
+        again = self.finalize(upload['token'])
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.data['id'], report.pk)
+        self.assertEqual(self.reports().count(), 1)
+
+    def test_finalize_before_upload(self):
+        upload = self.start().data
+        self.assertEqual(self.finalize(upload['token']).status_code, 400)
+
+    def test_expired_token(self):
+        upload = self.start().data
+        self.storage.put(upload['key'], b'%PDF-1.4', 'application/pdf')
+        # The token is good for twice UPLOAD_URL_SECONDS.
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + 121):
+            response = self.finalize(upload['token'])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('expired', response.data['token'][0])
+        self.assertFalse(self.reports().exists())
+
+    def test_token_is_for_its_user_only(self):
+        upload = self.start().data
+        self.storage.put(upload['key'], b'%PDF-1.4', 'application/pdf')
+        other = get_user_model().objects.create_user(email='other@example.com', password='pw')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.finalize(upload['token']).status_code, 400)
+        self.assertEqual(self.finalize('not-a-token').status_code, 400)
+
+    def test_oversize_object_is_deleted(self):
+        upload = self.start().data
+        self.storage.put(upload['key'], b'x' * 1001, 'application/pdf')
+        self.assertEqual(self.finalize(upload['token']).status_code, 400)
+        self.assertNotIn(upload['key'], self.storage.objects)
+        self.assertFalse(self.reports().exists())
+
+    def test_wrong_content_type_is_deleted(self):
+        upload = self.start().data
+        self.storage.put(upload['key'], b'<html>', 'text/html')
+        self.assertEqual(self.finalize(upload['token']).status_code, 400)
+        self.assertNotIn(upload['key'], self.storage.objects)
+        self.assertFalse(self.reports().exists())
+
+
+@override_settings(
+    AI_CHAT_LLM='pages.aichat.StubLLM', AI_CHAT_RECENT_TOKENS=100, AI_CHAT_SUMMARY_TOKENS=50,
+    AI_CHAT_SUMMARIZE_IN_BACKGROUND=False, RATE_LIMITS={'ai-chat': {'rate': '100/min'}}, AUDIT_ENABLED=False,
+)
+class AIChatTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='patient@example.com', password='pw')
+        self.alias = sharding.shard_for_user(self.user)
+        self.session = AIChatSession.objects.using(self.alias).create(user=self.user)
+        self.llm = aichat.StubLLM()
+        # get_llm() keeps the client it built.
+        aichat.get_llm.cache_clear()
+        self.addCleanup(aichat.get_llm.cache_clear)
+
+    def ask(self, question):
+        with sharding.pinned_to(self.alias):
+            return aichat.ask(self.session, question, self.llm)
+
+    def questions_asked(self):
+        return [prompt for prompt in self.llm.prompts if not prompt.startswith(aichat.SUMMARY_INSTRUCTIONS)]
+
+    def recent_tokens(self):
+        with sharding.pinned_to(self.alias):
+            return sum(turn.tokens for turn in aichat.unsummarized(self.session))
+
+    def test_prompt_carries_the_recent_turns(self):
+        self.assertEqual(self.ask("Why do I get headaches?"), "Stub answer to: Why do I get headaches?")
+        self.ask("Should I see someone?")
+        prompt = self.questions_asked()[-1]
+        self.assertIn("- No health data recorded", prompt)
+        self.assertIn("Patient: Why do I get headaches?\nDoctor: Stub answer to: Why do I get headaches?", prompt)
+        self.assertIn("Patient Question: Should I see someone?", prompt)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.title, "Why do I get headaches?")
+        self.assertEqual(self.session.summarized_through, 0)
+
+    def test_old_turns_are_folded_into_the_summary(self):
+        for number in range(12):
+            self.ask(f"Question {number}: is it normal that my knee hurts after running?")
+            self.assertLessEqual(self.recent_tokens(), 100)
+
+        self.session.refresh_from_db()
+        self.assertTrue(self.session.summary.startswith("Summary of"))
+        self.assertGreater(self.session.summarized_through, 0)
+        summaries = [prompt for prompt in self.llm.prompts if prompt.startswith(aichat.SUMMARY_INSTRUCTIONS)]
+        self.assertGreater(len(summaries), 1)
+        # Each fold builds on the summary before it.
+        self.assertIn("Summary so far:\n(none)", summaries[0])
+        self.assertIn("Summary so far:\nSummary of", summaries[-1])
+
+        prompt = self.questions_asked()[-1]
+        self.assertIn(f"(summary):\n{self.session.summary}", prompt)
+        self.assertNotIn("Question 0:", prompt)
+        # Recent turns never start with an answer.
+        self.assertIn("Recent conversation:\nPatient:", prompt)
+
+    def test_prompt_stays_within_budget_when_folding_lags(self):
+        with override_settings(AI_CHAT_SUMMARIZE_IN_BACKGROUND=True), \
+                mock.patch.object(aichat, '_summarize_in_background'):
+            for number in range(12):
+                self.ask(f"Question {number}: is it normal that my knee hurts after running?")
+        self.assertGreater(self.recent_tokens(), 100)
+
+        prompt = self.questions_asked()[-1]
+        history = prompt.split("Recent conversation:\n", 1)[1].split("\nPatient Question:", 1)[0]
+        self.assertLessEqual(aichat.estimate_tokens(history), 100)
+        self.assertTrue(history.startswith("Patient: "))
+        self.assertIn("Patient: Question 10:", history)
+        self.assertNotIn("Question 0:", prompt)
+
+    def test_summary_is_cut_to_its_budget(self):
+        class Rambling(aichat.StubLLM):
+            def generate(self, prompt):
+                return "word " * 1000
+
+        self.llm = Rambling()
+        for number in range(6):
+            self.ask(f"Question {number}: is it normal that my knee hurts after running?")
+        self.session.refresh_from_db()
+        self.assertEqual(len(self.session.summary), 50 * aichat.CHARS_PER_TOKEN)
+
+    def test_only_the_first_of_two_concurrent_folds_is_kept(self):
+        with override_settings(AI_CHAT_RECENT_TOKENS=10000):
+            for number in range(4):
+                self.ask(f"Question {number}")
+        stale = AIChatSession.objects.using(self.alias).get(pk=self.session.pk)
+        with override_settings(AI_CHAT_RECENT_TOKENS=20), sharding.pinned_to(self.alias):
+            self.assertTrue(aichat.summarize(self.session, self.llm))
+            self.assertFalse(aichat.summarize(stale, self.llm))
+
+    def test_view(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(reverse('ai-chat'), {'prompt': "Hello"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['response'], "Stub answer to: Hello")
+        response = client.post(reverse('ai-chat'), {'prompt': "Again", 'session': response.data['session']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.post(reverse('ai-chat'), {'prompt': "Hi", 'session': 'abc'}).status_code, 400)
+
+        aichat.get_llm.cache_clear()
+        with override_settings(AI_CHAT_LLM='pages.aichat.GeminiLLM', GEMINI_API_KEY=''):
+            response = client.post(reverse('ai-chat'), {'prompt': "Hello"})
+        self.assertEqual(response.status_code, 503)
+
+
+class Interrupted(Exception):
+    pass
+
+
+@override_settings(INSIGHTS_LLM='pages.aichat.StubLLM', INSIGHTS_MAX_ATTEMPTS=2, INSIGHTS_BACKOFF_SECONDS=0)
+class InsightsTests(TransactionTestCase):
+    # Patients are fetched and prompted from worker threads.
+    databases = '__all__'
+
+    def setUp(self):
+        self.users = []
+        for number in range(5):
+            user = get_user_model().objects.create_user(email=f'patient{number}@example.com', password='pw')
+            with sharding.pinned_to(sharding.shard_for_user(user)):
+                Allergy.objects.create(user=user, title=f"Allergen {number}")
+            self.users.append(user)
+
+    def insights(self):
+        found = {}
+        for rows in sharding.fan_out(lambda alias: list(HealthInsight.objects.using(alias).all())):
+            found.update((insight.user_id, insight.content) for insight in rows)
+        return found
+
+    def test_interrupted_run_resumes_where_it_stopped(self):
+        def interrupt(job, done, rate):
+            raise Interrupted
+
+        job = insights.start_or_resume()
+        with self.assertRaises(Interrupted):
+            insights.run(job, concurrency=1, chunk_size=2, progress=interrupt)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'running')
+        self.assertEqual((job.total, job.succeeded), (5, 2))
+        self.assertEqual(sorted(self.insights()), sorted(user.pk for user in self.users[:2]))
+
+        resumed = insights.start_or_resume()
+        self.assertEqual(resumed.pk, job.pk)
+        provider = aichat.StubLLM()
+        insights.run(resumed, concurrency=2, chunk_size=2, provider=provider)
+        self.assertEqual(len(provider.prompts), 3)
+        resumed.refresh_from_db()
+        self.assertEqual((resumed.status, resumed.succeeded, resumed.failed), ('done', 5, 0))
+        self.assertEqual(sorted(self.insights()), sorted(user.pk for user in self.users))
+
+        # Nothing changed since, so the next run has nobody to do.
+        self.assertEqual(insights.run(insights.start_or_resume()).total, 0)
+
+    def test_failed_patients_are_retried_by_the_next_run(self):
+        class Flaky(aichat.StubLLM):
+            def generate(self, prompt):
+                if "Allergen 3" in prompt:
+                    raise RuntimeError("model overloaded")
+                return super().generate(prompt)
+
+        job = insights.run(insights.start_or_resume(), provider=Flaky())
+        failed = self.users[3].pk
+        self.assertEqual((job.status, job.succeeded, job.failed), ('done', 4, 1))
+        self.assertEqual(job.errors, [{'user': failed, 'error': "model overloaded"}])
+        self.assertNotIn(failed, self.insights())
+
+        # A run with failures doesn't count as a starting point.
+        retry = insights.start_or_resume()
+        self.assertEqual(retry.since, job.since)
+        retry = insights.run(retry)
+        self.assertEqual((retry.total, retry.failed), (5, 0))
+        self.assertIn(failed, self.insights())
+        self.assertEqual(insights.start_or_resume().since, retry.until)
+        self.assertEqual(InsightRun.objects.filter(status='done').count(), 2)
+
+
+@skipUnless(len(sharding.shard_aliases()) >= 2, "needs two PATIENT_SHARDS, e.g. WIKAYA_SQLITE_SHARDS=2")
+@override_settings(AUDIT_ENABLED=False)
+class ShardingTests(TransactionTestCase):
+    # fan_out() queries the shards from worker threads.
+    databases = '__all__'
+
+    def setUp(self):
+        self.aliases = sharding.shard_aliases()
+        self.by_shard = {}
+        for number in range(50):
+            user = get_user_model().objects.create_user(email=f'user{number}@example.com', password='pw')
+            self.by_shard.setdefault(sharding.shard_for_user(user), user)
+            if len(self.by_shard) == 2:
+                break
+        else:
+            self.fail("50 users all hashed onto one shard")
+        (self.home, self.patient), (self.away, self.doctor) = list(self.by_shard.items())[:2]
+        self.addCleanup(sharding.forget_placements)
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def assert_in_range(self, pk, alias):
+        low = (self.aliases.index(alias) + 1) * sharding.ID_RANGE
+        self.assertTrue(low <= pk < low + sharding.ID_RANGE, f"{pk} is not in {alias}'s id range")
+
+    def test_records_go_to_the_patients_shard(self):
+        response = self.client_for(self.patient).post(reverse('allergy-list'), {'title': "Pollen"})
+        self.assertEqual(response.status_code, 201)
+        self.assert_in_range(response.data['id'], self.home)
+        self.assertTrue(Allergy.objects.using(self.home).filter(user=self.patient).exists())
+        self.assertFalse(Allergy.objects.using(self.away).filter(user=self.patient).exists())
+
+        # Every shard has the users table for the foreign keys.
+        for alias in self.aliases:
+            self.assertTrue(get_user_model().objects.using(alias).filter(pk=self.doctor.pk).exists())
+
+        listed = self.client_for(self.patient).get(reverse('allergy-list')).data
+        self.assertEqual([row['title'] for row in listed], ["Pollen"])
+        self.assertEqual(self.client_for(self.doctor).get(reverse('allergy-list')).data, [])
+
+    def test_moves_reach_placements_cached_by_other_workers(self):
+        self.assertEqual(sharding.shard_for_user(self.patient), self.home)
+        # What rebalance_shards does from another process: this one's cache
+        # only learns of it through the shared version.
+        PatientShard.objects.filter(user=self.patient).update(shard=self.away)
+        self.assertEqual(sharding.shard_for_user(self.patient), self.home)
+        cache.incr(sharding.PLACEMENTS_VERSION_KEY)
+        self.assertEqual(sharding.shard_for_user(self.patient), self.away)
+
+    def test_fan_out(self):
+        for user in (self.patient, self.doctor):
+            with sharding.pinned_to(sharding.shard_for_user(user)):
+                Allergy.objects.create(user=user, title=f"Allergy of {user.pk}")
+
+        self.assertEqual(sharding.fan_out(lambda alias: alias), self.aliases)
+        rows = sharding.fan_out_queryset(Allergy.objects.order_by('pk'))
+        self.assertEqual({row._state.db for row in rows}, {self.home, self.away})
+        self.assertEqual(sorted(row.user_id for row in rows), sorted([self.patient.pk, self.doctor.pk]))
+        self.assertEqual(sharding.count_across_shards(Allergy.objects.all()), 2)
+
+    def test_rebalance_moves_a_patient_and_back(self):
+        with sharding.pinned_to(self.home):
+            allergy = Allergy.objects.create(user=self.patient, title="Pollen")
+            conversation = Conversation.objects.create(patient=self.patient, doctor=self.doctor)
+            Message.objects.create(conversation=conversation, sender=self.doctor, content="Hello")
+
+        call_command('rebalance_shards', user=[self.patient.pk], target=self.away, stdout=StringIO())
+        self.assertEqual(sharding.shard_for_user(self.patient), self.away)
+        moved = Allergy.objects.using(self.away).get(user=self.patient)
+        self.assertEqual((moved.pk, moved.created_at), (allergy.pk, allergy.created_at))
+        self.assertEqual(Message.objects.using(self.away).get(conversation_id=conversation.pk).content, "Hello")
+        self.assertFalse(Allergy.objects.using(self.home).filter(user=self.patient).exists())
+        self.assertFalse(Conversation.objects.using(self.home).exists())
+
+        with sharding.pinned_to(self.away):
+            dust = Allergy.objects.create(user=self.patient, title="Dust")
+        # SQLite numbers past the moved-in ids; see reserve_id_range().
+        if connections[self.away].vendor == 'postgresql':
+            self.assert_in_range(dust.pk, self.away)
+
+        out = StringIO()
+        call_command('rebalance_shards', stdout=out)
+        self.assertIn("Moved 1 patient(s).", out.getvalue())
+        self.assertEqual(sharding.shard_for_user(self.patient), self.home)
+        self.assertEqual(Allergy.objects.using(self.home).filter(user=self.patient).count(), 2)
+
+    def test_doctor_posts_to_a_conversation_on_another_shard(self):
+        with sharding.pinned_to(self.home):
+            conversation = Conversation.objects.create(patient=self.patient, doctor=self.doctor)
+        url = reverse('message-list', kwargs={'conversation_id': conversation.pk})
+
+        response = self.client_for(self.doctor).post(url, {'content': "How are you feeling?"})
+        self.assertEqual(response.status_code, 201)
+        message = Message.objects.using(self.home).get(pk=response.data['id'])
+        self.assertEqual((message.sender_id, message.content), (self.doctor.pk, "How are you feeling?"))
+        self.assertFalse(Message.objects.using(self.away).exists())
+
+        listed = self.client_for(self.patient).get(url).data['results']
+        self.assertEqual([row['content'] for row in listed], ["How are you feeling?"])
+
+        stranger = get_user_model().objects.create_user(email='stranger@example.com', password='pw')
+        self.assertEqual(self.client_for(stranger).post(url, {'content': "Hi"}).status_code, 404)
+
+
+@override_settings(AUDIT_ENABLED=False)
+class RecordExportTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.user = get_user_model().objects.create_user(email='patient@example.com', password='pw')
+        with sharding.pinned_to(sharding.shard_for_user(self.user)):
+            self.allergy = Allergy.objects.create(user=self.user, title="Pollen")
+            self.report = LabReport.objects.create(
+                user=self.user, report_date='2024-05-01', file=ContentFile(b'%PDF-1.4', name='report.pdf'),
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def export(self, **params):
+        response = self.client.get(reverse('record-export'), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_json_bundle(self):
+        bundle = json.loads(self.export())
+        self.assertEqual(bundle['resourceType'], 'Bundle')
+        self.assertEqual(bundle['subject']['reference'], f"Patient/{self.user.pk}")
+        resources = {entry['resource']['id']: entry['resource'] for entry in bundle['entry']}
+        self.assertEqual(set(resources), {f"allergy-{self.allergy.pk}", f"labreport-{self.report.pk}"})
+        allergy = resources[f"allergy-{self.allergy.pk}"]
+        self.assertEqual((allergy['resourceType'], allergy['title']), ('AllergyIntolerance', "Pollen"))
+
+    def test_zip_holds_the_bundle_and_files(self):
+        archive = zipfile.ZipFile(BytesIO(self.export(files='1')))
+        self.assertEqual(len(json.loads(archive.read('bundle.json'))['entry']), 2)
+        self.assertEqual(archive.read(f"files/{self.report.file.name}"), b'%PDF-1.4')
+
+    def test_missing_files_are_skipped(self):
+        self.report.file.storage.delete(self.report.file.name)
+        archive = zipfile.ZipFile(BytesIO(self.export(files='1')))
+        self.assertEqual(archive.namelist(), ['bundle.json'])
+
+    def test_other_patients_are_for_staff_only(self):
+        other = get_user_model().objects.create_user(email='other@example.com', password='pw')
+        self.client.force_authenticate(other)
+        self.assertEqual(json.loads(self.export(user=self.user.pk))['entry'], [])
+
+        other.is_staff = True
+        other.save()
+        self.assertEqual(len(json.loads(self.export(user=self.user.pk))['entry']), 2)
+        self.assertEqual(self.client.get(reverse('record-export'), {'user': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('record-export'), {'user': '999999'}).status_code, 404)
+
+
+@override_settings(ACCOUNT_PURGE_IN_BACKGROUND=False, AUDIT_ENABLED=False)
+class AccountDeletionTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+        User = get_user_model()
+        self.user = User.objects.create_user(email='patient@example.com', password='pw')
+        self.doctor = User.objects.create_user(email='doctor@example.com', password='pw')
+        with sharding.pinned_to(sharding.shard_for_user(self.user)):
+            Allergy.objects.create(user=self.user, title="Pollen")
+            medication = Medication2.objects.create(
+                user=self.user, name="Aspirin", dosage=1, duration_days=10, timing='morning',
+            )
+            DoseEvent.objects.create(medication=medication, scheduled_at=timezone.now(), taken=True)
+            conversation = Conversation.objects.create(patient=self.user, doctor=self.doctor)
+            Message.objects.create(conversation=conversation, sender=self.doctor, content="Hello")
+            session = AIChatSession.objects.create(user=self.user)
+            AIChatTurn.objects.create(session=session, role='user', content="Hi", tokens=1)
+            self.report = LabReport.objects.create(
+                user=self.user, report_date='2024-05-01', file=ContentFile(b'%PDF-1.4', name='report.pdf'),
+            )
+        with sharding.pinned_to(sharding.shard_for_user(self.doctor)):
+            Allergy.objects.create(user=self.doctor, title="Dust")
+
+    def test_plan_deletes_children_before_parents(self):
+        steps = deletion.plan()
+        actions = [action for _, action, _ in steps]
+        self.assertEqual(actions, sorted(actions, key=lambda action: action != 'set_null'))
+        order = [model for model, action, _ in steps if action == 'delete']
+        for child, parent in [
+            (Message, Conversation), (DoseEvent, Medication2), (AIChatTurn, AIChatSession),
+        ]:
+            self.assertLess(order.index(child), order.index(parent))
+        self.assertNotIn(get_user_model(), order)
+        # Routing needs the placement until the user row itself goes.
+        self.assertNotIn(PatientShard, order)
+
+    def test_request_revokes_tokens_at_once(self):
+        from rest_framework.authtoken.models import Token
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        refresh = RefreshToken.for_user(self.user)
+        Token.objects.create(user=self.user)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch.object(deletion, 'purge') as purge:
+            self.assertEqual(client.delete(reverse('delete-account')).status_code, 202)
+        purge.assert_not_called()
+
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertEqual(self.user.email, f"deleted-{self.user.pk}@deleted.invalid")
+        self.assertFalse(Token.objects.filter(user=self.user).exists())
+        self.assertTrue(BlacklistedToken.objects.filter(token__jti=refresh['jti']).exists())
+
+    def test_purge_leaves_nothing_on_any_shard(self):
+        user_id = self.user.pk
+        report_file = self.report.file.name
+        job = deletion.request_deletion(self.user)
+        job = deletion.purge(deletion.claim(job.pk))
+        self.assertEqual(job.status, 'done', job.error)
+
+        for model, action, paths in deletion.plan():
+            if action != 'delete':
+                continue
+            lookup = Q()
+            for path in paths:
+                lookup |= Q(**{path: user_id})
+            for alias in deletion._aliases(model):
+                self.assertFalse(model._base_manager.using(alias).filter(lookup).exists(), f"{model} on {alias}")
+        for alias in connections:
+            self.assertFalse(get_user_model().objects.using(alias).filter(pk=user_id).exists(), alias)
+        self.assertFalse(PatientShard.objects.filter(user_id=user_id).exists())
+        self.assertEqual(job.rows_deleted['pages.message'], 1)
+        self.assertTrue(DeletedFile.objects.filter(name=report_file).exists())
+
+        # Other patients keep their records.
+        with sharding.pinned_to(sharding.shard_for_user(self.doctor)):
+            self.assertTrue(Allergy.objects.filter(user=self.doctor).exists())
+
+        self.assertEqual(deletion.purge_files(), (1, 0))
+        self.assertFalse(self.report.file.storage.exists(report_file))
+
+    def test_admin_list_checks_the_user_filter(self):
+        AccountDeletion.objects.create(user_id=self.user.pk)
+        admin = get_user_model().objects.create_user(email='admin@example.com', password='pw', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+        url = reverse('accountdeletion-list')
+        self.assertEqual(len(client.get(url, {'user': self.user.pk}).data), 1)
+        self.assertEqual(client.get(url, {'user': 'abc'}).status_code, 400)
+
+
+class ActiveMedicationTests(TestCase):
+    databases = '__all__'
+
+    def test_summary_and_interaction_check_agree(self):
+        User = get_user_model()
+        patient = User.objects.create_user(email='patient@example.com', password='pw')
+        doctor = User.objects.create_user(email='doctor@example.com', password='pw')
+        alias = sharding.shard_for_user(patient)
+        with sharding.pinned_to(alias):
+            Conversation.objects.create(patient=patient, doctor=doctor)
+            for name, days in [("Amoxicillin", 7), ("Ibuprofen", 3)]:
+                Medication2.objects.create(user=patient, name=name, dosage=1, duration_days=days, timing='morning')
+            # Ibuprofen's course ended last week.
+            Medication2.objects.filter(name="Ibuprofen").update(created_at=timezone.now() - timedelta(days=10))
+        summaries.refresh(patient.pk, ['medications'])
+
+        medications, _ = interactions.patient_record(patient)
+        self.assertEqual(medications, ["Amoxicillin"])
+        summary = PatientSummary.objects.get(patient=patient, doctor=doctor)
+        self.assertEqual(summary.active_medications, ["Amoxicillin"])
+
+
+@override_settings(AUDIT_ENABLED=False, MESSAGE_HOT_WINDOW_DAYS=30)
+class MessageListTests(TransactionTestCase):
+    # Conversations are found with fan_out(), from worker threads.
+    databases = '__all__'
+
+    def setUp(self):
+        User = get_user_model()
+        self.patient = User.objects.create_user(email='patient@example.com', password='pw')
+        self.doctor = User.objects.create_user(email='doctor@example.com', password='pw')
+        self.alias = sharding.shard_for_user(self.patient)
+        with sharding.pinned_to(self.alias):
+            self.conversation = Conversation.objects.create(patient=self.patient, doctor=self.doctor)
+            for number in range(5):
+                Message.objects.create(conversation=self.conversation, sender=self.doctor, content=f"Message {number}")
+        self.url = reverse('message-list', kwargs={'conversation_id': self.conversation.pk})
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def read_all(self, client, limit):
+        contents, params = [], {'limit': limit}
+        while True:
+            response = client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            contents += [row['content'] for row in response.data['results']]
+            if response.data['next_cursor'] is None:
+                return contents
+            params['cursor'] = response.data['next_cursor']
+
+    def test_patient_and_doctor_page_through_newest_first(self):
+        expected = [f"Message {number}" for number in reversed(range(5))]
+        for user in (self.patient, self.doctor):
+            self.assertEqual(self.read_all(self.client_for(user), limit=2), expected)
+
+    def test_strangers_and_bad_cursors(self):
+        stranger = get_user_model().objects.create_user(email='stranger@example.com', password='pw')
+        self.assertEqual(self.client_for(stranger).get(self.url).status_code, 404)
+        client = self.client_for(self.patient)
+        self.assertEqual(client.get(self.url, {'cursor': 'not a cursor'}).status_code, 400)
+        self.assertEqual(client.get(self.url, {'limit': 'ten'}).status_code, 400)
+
+    def test_pages_fall_through_to_the_archive(self):
+        long_ago = timezone.now() - timedelta(days=90)
+        with sharding.pinned_to(self.alias):
+            Conversation.objects.filter(pk=self.conversation.pk).update(created_at=long_ago)
+            for number, message in enumerate(Message.objects.filter(content__in=["Message 0", "Message 1"])):
+                Message.objects.filter(pk=message.pk).update(timestamp=long_ago + timedelta(minutes=number))
+        call_command('archive_messages', stdout=StringIO())
+        self.assertEqual(MessageArchive.objects.using(self.alias).count(), 2)
+
+        expected = [f"Message {number}" for number in reversed(range(5))]
+        self.assertEqual(self.read_all(self.client_for(self.doctor), limit=2), expected)
+        self.assertEqual(self.read_all(self.client_for(self.patient), limit=50), expected)
+
+    def test_young_conversations_skip_the_archive(self):
+        with mock.patch.object(MessageArchive.objects, 'using', side_effect=AssertionError("archive queried")):
+            self.assertEqual(len(self.read_all(self.client_for(self.patient), limit=50)), 5)
+
+
+class ImporterTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.patient = get_user_model().objects.create_user(email='Patient@example.com', password='pw')
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, self.path)
+        with os.fdopen(handle, 'w') as source:
+            source.write("patient_email,title\n")
+            for title in ("Pollen", "Dust", "Latex"):
+                source.write(f"patient@EXAMPLE.com,{title}\n")
+            source.write("new@example.com,Nuts\n")
+
+    def allergies(self, user):
+        return Allergy.objects.using(sharding.shard_for_user(user)).filter(user=user)
+
+    def test_emails_match_whatever_their_case(self):
+        job = ImportJob.objects.create(format='csv', resource='allergy', source_path=self.path, create_users=True)
+        importer.Importer(job, batch_size=2).run()
+        self.assertEqual((job.rows_imported, job.rows_failed), (4, 0))
+        self.assertEqual(self.allergies(self.patient).count(), 3)
+        self.assertEqual(get_user_model().objects.filter(email__iexact='patient@example.com').count(), 1)
+        self.assertEqual(self.allergies(get_user_model().objects.get(email='new@example.com')).count(), 1)
+
+    def test_replayed_rows_are_not_counted_again(self):
+        job = ImportJob.objects.create(format='csv', resource='allergy', source_path=self.path)
+        importer.Importer(job, batch_size=2).run()
+        self.assertEqual((job.rows_imported, job.rows_failed), (3, 1))
+
+        # As if the job had died before saving its checkpoint.
+        job.bytes_done = 0
+        importer.Importer(job, batch_size=2).run()
+        self.assertEqual(job.rows_imported, 3)
+        self.assertEqual(self.allergies(self.patient).count(), 3)
+
+
+@override_settings(AUDIT_ENABLED=False)
+class StatusFilterTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='patient@example.com', password='pw')
+        today = timezone.now().date()
+        yesterday, tomorrow = today - timedelta(days=1), today + timedelta(days=1)
+        with sharding.pinned_to(sharding.shard_for_user(self.user)):
+            for title, fields in [
+                ("ongoing", {}),
+                ("ends today", {'end_date': today}),
+                ("ended", {'end_date': yesterday}),
+                ("marked past", {'is_passed': True}),
+                ("marked active", {'is_passed': False, 'end_date': yesterday}),
+            ]:
+                Allergy.objects.create(user=self.user, title=title, **fields)
+            for name, fields in [
+                ("current", {'start_date': yesterday}),
+                ("not started", {'start_date': tomorrow}),
+                ("finished", {'start_date': yesterday - timedelta(days=9), 'end_date': yesterday}),
+                ("stopped early", {'start_date': yesterday, 'end_date': tomorrow, 'is_passed': True}),
+            ]:
+                Medication.objects.create(user=self.user, name=name, **fields)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def listed(self, url_name, field, **params):
+        response = self.client.get(reverse(url_name), params)
+        self.assertEqual(response.status_code, 200)
+        return {row[field]: row['status'] for row in response.data}
+
+    def test_allergies(self):
+        everything = self.listed('allergy-list', 'title')
+        self.assertEqual(everything, {
+            "ongoing": 'active', "ends today": 'active', "ended": 'past',
+            "marked past": 'past', "marked active": 'active',
+        })
+        self.assertEqual(set(self.listed('allergy-list', 'title', status='active')),
+                         {"ongoing", "ends today", "marked active"})
+        self.assertEqual(set(self.listed('allergy-list', 'title', status='past')), {"ended", "marked past"})
+
+    def test_medications(self):
+        self.assertEqual(self.listed('medication-list', 'name'), {
+            "current": 'active', "not started": 'past', "finished": 'past', "stopped early": 'past',
+        })
+        self.assertEqual(set(self.listed('medication-list', 'name', status='active')), {"current"})
+
+    def test_queryset_agrees_with_the_model(self):
+        with sharding.pinned_to(sharding.shard_for_user(self.user)):
+            for model in (Allergy, Medication):
+                past = set(model.objects.filter(user=self.user).past().values_list('pk', flat=True))
+                for obj in model.objects.filter(user=self.user):
+                    self.assertEqual(obj.pk in past, obj.effective_is_passed, obj)
+
+    def test_invalid_status(self):
+        for value in ('done', 'ACTIVE'):
+            response = self.client.get(reverse('allergy-list'), {'status': value})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('status', response.data)
+
+
+@override_settings(AUDIT_ENABLED=False)
+class InteractionIndexTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.dataset = os.path.join(directory, 'interactions.json')
+        self.index = os.path.join(directory, 'interactions.idx')
+        shutil.copy(interactions.DEFAULT_DATASET, self.dataset)
+        paths = override_settings(INTERACTIONS_DATASET=self.dataset, INTERACTIONS_INDEX=self.index)
+        paths.enable()
+        self.addCleanup(paths.disable)
+        interactions.reload()
+        self.addCleanup(interactions.reload)
+
+    def findings(self, drugs, medications=(), allergies=()):
+        return interactions.check(drugs, medications, allergies)[0]
+
+    def test_compiled_on_first_use_and_readable_by_all(self):
+        self.assertFalse(os.path.exists(self.index))
+        interactions.get_index()
+        self.assertEqual(os.stat(self.index).st_mode & 0o777, 0o644)
+
+    def test_drug_interactions(self):
+        [finding] = self.findings(["Warfarin"], medications=["Aspirin 81mg"])
+        self.assertEqual(
+            (finding['type'], finding['severity'], finding['description']),
+            ('interaction', 'major', "Increased risk of bleeding."),
+        )
+        [finding] = self.findings(["ibuprofen", "naproxen"])
+        self.assertEqual((finding['type'], finding['severity']), ('duplicate', 'moderate'))
+        self.assertEqual(self.findings(["acetaminophen", "metformin"]), [])
+
+    def test_allergies(self):
+        [finding] = self.findings(["Amoxicillin clavulanate"], allergies=["Penicillin allergy"])
+        self.assertEqual((finding['type'], finding['severity']), ('allergy', 'contraindicated'))
+        [finding] = self.findings(["cefalexin"], allergies=["penicillin"])
+        self.assertEqual((finding['type'], finding['severity']), ('cross_reactivity', 'minor'))
+
+    def test_worst_first_and_unrecognized(self):
+        findings, unrecognized = interactions.check(
+            ["warfarin", "amoxicillin", "Frobnicil"], medications=["aspirin"], allergies=["penicillin"],
+        )
+        self.assertEqual([finding['severity'] for finding in findings], ['contraindicated', 'major'])
+        self.assertEqual(unrecognized, ["Frobnicil"])
+        self.assertEqual(interactions.resolve("Tylenol"), interactions.resolve("acetaminophen"))
+
+    def test_rebuilt_when_the_dataset_changes(self):
+        interactions.get_index()
+        with open(self.dataset) as source:
+            data = json.load(source)
+        data['drugs'].append('examplamab')
+        data['interactions'].append(['examplamab', 'warfarin', 'contraindicated', "Never together."])
+        with open(self.dataset, 'w') as out:
+            json.dump(data, out)
+        later = os.stat(self.index).st_mtime + 10
+        os.utime(self.dataset, (later, later))
+
+        interactions.reload()
+        [finding] = self.findings(["examplamab"], medications=["warfarin"])
+        self.assertEqual((finding['severity'], finding['description']), ('contraindicated', "Never together."))
+
+    def test_check_endpoint_uses_the_patients_record(self):
+        user = get_user_model().objects.create_user(email='patient@example.com', password='pw')
+        with sharding.pinned_to(sharding.shard_for_user(user)):
+            Medication.objects.create(user=user, name="Warfarin")
+            Allergy.objects.create(user=user, title="Penicillin")
+        client = APIClient()
+        client.force_authenticate(user)
+        url = reverse('interaction-check')
+
+        response = client.get(url, {'drug': ["aspirin", "amoxicillin"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(finding['with'], finding['severity']) for finding in response.data['interactions']],
+            [("Penicillin", 'contraindicated'), ("Warfarin", 'major')],
+        )
+        response = client.get(url, {'drug': "aspirin", 'record': '0'})
+        self.assertEqual(response.data['interactions'], [])
+        self.assertEqual(client.get(url).status_code, 400)
+
+
+@override_settings(AUDIT_ENABLED=True, AUDIT_FLUSH_SECONDS=0.05)
+class AuditTrailTests(TransactionTestCase):
+    # Events are written by the writer thread.
+    databases = '__all__'
+
+    def setUp(self):
+        audit._writer = None
+        self.addCleanup(setattr, audit, '_writer', None)
+        self.addCleanup(audit.flush)
+        User = get_user_model()
+        self.patient = User.objects.create_user(email='patient@example.com', password='pw')
+        self.doctor = User.objects.create_user(email='doctor@example.com', password='pw')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def events(self):
+        audit.flush()
+        return list(AuditEvent.objects.order_by('pk'))
+
+    def event(self, action, resource, actor, patient, object_id, status_code):
+        return {
+            'action': action, 'resource': resource, 'actor_id': actor.pk, 'patient_id': patient.pk,
+            'object_id': str(object_id), 'status_code': status_code,
+        }
+
+    def summary(self, event):
+        return {field: getattr(event, field) for field in (
+            'action', 'resource', 'actor_id', 'patient_id', 'object_id', 'status_code',
+        )}
+
+    def test_record_reads_and_writes(self):
+        client = self.client_for(self.patient)
+        created = client.post(reverse('allergy-list'), {'title': "Pollen"}).data['id']
+        client.get(reverse('allergy-detail', args=[created]))
+        client.delete(reverse('allergy-detail', args=[created]))
+        client.get(reverse('liveness'))
+
+        self.assertEqual([self.summary(event) for event in self.events()], [
+            self.event('create', 'allergy-list', self.patient, self.patient, created, 201),
+            self.event('read', 'allergy-detail', self.patient, self.patient, created, 200),
+            self.event('delete', 'allergy-detail', self.patient, self.patient, created, 204),
+        ])
+
+    def test_doctors_are_recorded_against_the_patient(self):
+        with sharding.pinned_to(sharding.shard_for_user(self.patient)):
+            conversation = Conversation.objects.create(patient=self.patient, doctor=self.doctor)
+        url = reverse('message-list', kwargs={'conversation_id': conversation.pk})
+        created = self.client_for(self.doctor).post(url, {'content': "Hello"}).data['id']
+
+        [event] = self.events()
+        self.assertEqual(self.summary(event), self.event('create', 'message-list', self.doctor, self.patient, created, 201))
+
+        log = self.client_for(self.patient).get(reverse('record-access-log')).data['results']
+        self.assertEqual([(row['actor_id'], row['action']) for row in log], [(self.doctor.pk, 'create')])
+
+    def test_disabled(self):
+        with override_settings(AUDIT_ENABLED=False):
+            self.client_for(self.patient).get(reverse('allergy-list'))
+        self.assertEqual(self.events(), [])
+
+    def test_full_queue_writes_inline(self):
+        writer = audit.AuditWriter(batch_size=10, flush_seconds=60, max_queued=1, block_seconds=0)
+        event = dict(action='read', method='GET', path='/api/', status_code=200, patient_id=self.patient.pk)
+        with mock.patch.object(writer, '_ensure_started'):
+            writer.submit(AuditEvent(**event))
+            writer.submit(AuditEvent(**event))
+        self.assertEqual((writer.overflowed, AuditEvent.objects.count()), (1, 1))
+        writer.flush()
+        self.assertEqual(AuditEvent.objects.count(), 2)
+
+    def test_events_are_logged_when_the_database_refuses_them(self):
+        writer = audit.AuditWriter(batch_size=10, flush_seconds=60, max_queued=10, block_seconds=0)
+        event = AuditEvent(action='read', method='GET', path='/api/', status_code=200, patient_id=self.patient.pk)
+        with mock.patch.object(AuditEvent.objects, 'using', side_effect=DatabaseError("down")), \
+                mock.patch.object(audit.time, 'sleep'), self.assertLogs('pages.audit', 'ERROR') as logs:
+            writer.write([event])
+        self.assertIn(f"patient={self.patient.pk} status=200", logs.output[-1])
+
+
+@override_settings(AUDIT_ENABLED=False, LOAD_SHEDDING_ENABLED=True, LOAD_SHEDDING_CAPACITY=4)
+class LoadSheddingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.tracker = loadshed.Tracker()
+        patcher = mock.patch.object(loadshed, 'tracker', self.tracker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def busy(self, requests):
+        for _ in range(requests):
+            self.tracker.admit('read')
+
+    def test_tier_over_its_share_is_shed(self):
+        # Two of four threads busy: the AI tier's half is taken, reads still fit.
+        self.busy(2)
+        response = self.client.post('/api/ai-chat/')
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(30 <= int(response['Retry-After']) <= 45)
+        self.assertEqual(self.client.get(reverse('allergy-list')).status_code, 401)
+        self.assertEqual(self.tracker.snapshot()['tiers']['ai']['shed'], 1)
+        self.assertEqual(self.tracker.in_flight, 2)
+
+    def test_slow_queue_sheds_low_tiers(self):
+        waited = {'HTTP_X_REQUEST_START': f"t={time.time() - 0.5:.3f}"}
+        self.assertEqual(self.client.post('/api/ai-chat/', **waited).status_code, 503)
+        self.assertEqual(self.client.get(reverse('allergy-list'), **waited).status_code, 401)
+
+    def test_auth_is_never_shed(self):
+        self.busy(4)
+        waited = {'HTTP_X_REQUEST_START': f"t={time.time() - 60:.3f}"}
+        for path in ('/api/ai-chat/', reverse('allergy-list')):
+            self.assertEqual(self.client.get(path, **waited).status_code, 503)
+        response = self.client.post(reverse('token_obtain_pair'), {'email': 'nobody@example.com', 'password': 'pw'}, **waited)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.client.get(reverse('liveness')).status_code, 200)
+        self.assertEqual(self.tracker.snapshot()['state'], 'overloaded')
+        self.assertEqual(self.tracker.in_flight, 4)
+
+    def test_disabled(self):
+        self.busy(4)
+        with override_settings(LOAD_SHEDDING_ENABLED=False):
+            self.assertNotEqual(self.client.post('/api/ai-chat/').status_code, 503)
+
+
+@override_settings(AUDIT_ENABLED=False, VITALS_ALERT_RATE_LIMIT=5)
+class VitalsAlertTests(TransactionTestCase):
+    # The doctors' alert list fans out over the shards.
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        User = get_user_model()
+        self.patient = User.objects.create_user(email='patient@example.com', password='pw')
+        self.doctors = [User.objects.create_user(email=f'doctor{n}@example.com', password='pw') for n in range(2)]
+        self.shard = sharding.shard_for_user(self.patient)
+        with sharding.pinned_to(self.shard):
+            for doctor in self.doctors:
+                Conversation.objects.create(patient=self.patient, doctor=doctor)
+            self.vitals = UserFiles.objects.create(user=self.patient)
+
+    def record(self, **readings):
+        for field, value in readings.items():
+            setattr(self.vitals, field, value)
+        with sharding.pinned_to(self.shard):
+            self.vitals.save()
+
+    def alerts(self, **filters):
+        return VitalsAlert.objects.using(self.shard).filter(**filters).order_by('conversation__doctor_id', 'rule')
+
+    def listed(self, doctor, **params):
+        client = APIClient()
+        client.force_authenticate(doctor)
+        return [alert['rule'] for alert in client.get(reverse('vitalsalert-list'), params).data]
+
+    def test_alerts_are_raised_refreshed_and_resolved(self):
+        self.record(oxygen_saturation=88)
+        self.assertEqual(
+            [(alert.conversation.doctor_id, alert.rule, alert.severity, alert.value) for alert in self.alerts()],
+            [(doctor.pk, 'spo2_low', 'critical', '88') for doctor in self.doctors],
+        )
+
+        self.record(oxygen_saturation=85)
+        self.assertEqual([(alert.value, alert.occurrences) for alert in self.alerts()], [('85', 2)] * 2)
+        self.assertEqual(self.listed(self.doctors[0]), ['spo2_low'])
+
+        self.record(oxygen_saturation=97)
+        self.assertFalse(self.alerts(resolved_at__isnull=True).exists())
+        self.assertEqual(self.listed(self.doctors[0]), [])
+        self.assertEqual(self.listed(self.doctors[0], all=1), ['spo2_low'])
+
+    def test_blood_pressure_rules_share_one_alert(self):
+        self.record(blood_pressure='200/130')
+        self.assertEqual([(alert.rule, alert.value) for alert in self.alerts()], [('bp_crisis', '200/130')] * 2)
+        self.record(blood_pressure='150/125')
+        self.assertEqual([(alert.value, alert.occurrences) for alert in self.alerts()], [('150/125', 2)] * 2)
+        self.record(blood_pressure='garbled')
+        self.assertFalse(self.alerts(resolved_at__isnull=True).exists())
+
+    @override_settings(VITALS_ALERT_RATE_LIMIT=1)
+    def test_alerts_past_the_rate_limit_are_held_until_the_next_window(self):
+        self.record(oxygen_saturation=85, blood_pressure='200/130')
+        self.assertEqual(
+            [(alert.rule, alert.suppressed) for alert in self.alerts(conversation__doctor=self.doctors[0])],
+            [('bp_crisis', True), ('spo2_low', False)],
+        )
+        self.assertEqual(self.listed(self.doctors[0]), ['spo2_low'])
+
+        # Still firing in the same window: refreshed, still held back.
+        self.record(oxygen_saturation=84)
+        self.assertEqual(self.listed(self.doctors[0]), ['spo2_low'])
+
+        cache.clear()  # The window ends
+        self.record(oxygen_saturation=83)
+        self.assertEqual(sorted(self.listed(self.doctors[0])), ['bp_crisis', 'spo2_low'])
+        self.assertFalse(self.alerts(suppressed=True).exists())
+        self.assertEqual(self.alerts().count(), 4)
+
+    def test_acknowledge(self):
+        self.record(blood_sugar_level=40)
+        alert = self.alerts(conversation__doctor=self.doctors[0]).get()
+        client = APIClient()
+        client.force_authenticate(self.doctors[1])
+        url = reverse('vitalsalert-acknowledge', args=[alert.pk])
+        self.assertEqual(client.post(url).status_code, 404)
+        client.force_authenticate(self.doctors[0])
+        self.assertEqual(client.post(url).status_code, 200)
+        alert.refresh_from_db()
+        self.assertIsNotNone(alert.acknowledged_at)
@@ -0,0 +1,123 @@
+"""
+Direct uploads of lab reports and imaging to object storage.
+
+``start()`` picks the object key a file will have and returns a presigned
+form for it, so the client sends the bytes straight to the bucket, plus a
+signed token naming the patient, the kind of record, the key and the
+content type the form requires.  ``finalize()`` checks the token and that
+the object arrived within the size limit and with that content type, after
+which the view creates the record pointing at it.  The app
+never handles the file's bytes.
+
+This needs a storage with ``presigned_post()`` and ``head()`` as
+``objectstore.S3Storage`` has; with local file storage, files still go
+through the regular multipart endpoints.
+"""
+import os
+import secrets
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.base import ContentFile
+from rest_framework.exceptions import ValidationError
+
+from .models import Imaging, LabReport
+
+KINDS = {
+    'labreport': LabReport,
+    'imaging': Imaging,
+}
+
+SALT = 'pages.uploads'
+
+# Content types by the extensions the models accept.
+CONTENT_TYPES = {
+    '.pdf': 'application/pdf',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.dicom': 'application/dicom',
+}
+
+
+def _max_bytes():
+    return getattr(settings, 'UPLOAD_MAX_BYTES', 100 * 1024 * 1024)
+
+
+def _expires():
+    return getattr(settings, 'UPLOAD_URL_SECONDS', 900)
+
+
+def supported(model):
+    storage = model._meta.get_field('file').storage
+    return hasattr(storage, 'presigned_post') and hasattr(storage, 'head')
+
+
+def object_name(model, filename):
+    """A fresh key under the field's ``upload_to`` that fits its ``max_length``."""
+    field = model._meta.get_field('file')
+    name = field.generate_filename(None, os.path.basename(filename))
+    directory, base = os.path.split(name)
+    prefix = f"{directory}/{secrets.token_hex(8)}-"
+    stem, extension = os.path.splitext(base)
+    return prefix + stem[:max(1, field.max_length - len(prefix) - len(extension))] + extension
+
+
+def start(user, kind, filename, content_type='', size=None):
+    """The presigned form and finalize token for uploading ``filename``."""
+    model = KINDS.get(kind)
+    if model is None:
+        raise ValidationError({'type': [f"Use one of: {', '.join(KINDS)}."]})
+    if not supported(model):
+        raise ValidationError({'type': ["Direct uploads need object storage (OBJECT_STORAGE)."]})
+    if not filename:
+        raise ValidationError({'filename': ["This field is required."]})
+    field = model._meta.get_field('file')
+    for validator in field.validators:
+        try:
+            validator(ContentFile(b'', name=filename))
+        except DjangoValidationError as exc:
+            raise ValidationError({'filename': exc.messages})
+    extension = os.path.splitext(filename)[1].lower()
+    expected = CONTENT_TYPES[extension]
+    if content_type and content_type != expected:
+        raise ValidationError({'content_type': [f"A {extension} file must be sent as {expected}."]})
+    limit = _max_bytes()
+    if size is not None and not 0 < size <= limit:
+        raise ValidationError({'size': [f"Files must be between 1 byte and {limit} bytes."]})
+
+    name = object_name(model, filename)
+    # The form only accepts the file with this content type.
+    form = field.storage.presigned_post(name, limit, content_type=expected, expires=_expires())
+    token = signing.dumps(
+        {'user': user.pk, 'type': kind, 'key': name, 'content_type': expected}, salt=SALT, compress=True
+    )
+    return {**form, 'key': name, 'token': token, 'max_bytes': limit, 'expires_in': _expires()}
+
+
+def finalize(user, token):
+    """``(model, key)`` of an upload that arrived; raises ValidationError otherwise."""
+    try:
+        # Uploads may be slow, so the token outlives the form by as much again.
+        claim = signing.loads(token or '', salt=SALT, max_age=_expires() * 2)
+    except signing.SignatureExpired:
+        raise ValidationError({'token': ["This upload has expired; start a new one."]})
+    except signing.BadSignature:
+        raise ValidationError({'token': ["Invalid upload token."]})
+    if claim['user'] != user.pk:
+        raise ValidationError({'token': ["Invalid upload token."]})
+
+    model = KINDS[claim['type']]
+    storage = model._meta.get_field('file').storage
+    found = storage.head(claim['key'])
+    if found is None:
+        raise ValidationError({'token': ["The file has not been uploaded yet."]})
+    if found['size'] > _max_bytes():
+        storage.delete(claim['key'])
+        raise ValidationError({'token': [f"Files must be at most {_max_bytes()} bytes."]})
+    expected = claim.get('content_type')
+    if expected and found['content_type'].partition(';')[0].strip().lower() != expected:
+        storage.delete(claim['key'])
+        raise ValidationError({'token': [f"The file must be sent as {expected}."]})
+    return model, claim['key']
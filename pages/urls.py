@@ -7,15 +7,47 @@ router.register(r'allergies', AllergyViewSet, basename='allergy')
 router.register(r'health-problems', HealthProblemViewSet, basename='healthproblem')
 router.register(r'medications', MedicationViewSet, basename='medication')
 router.register(r'lab-reports', LabReportViewSet, basename='labreport')
+router.register(r'lab-results', LabResultViewSet, basename='labresult')
 router.register(r'imaging', ImagingViewSet, basename='imaging')
 router.register(r'vaccinations', VaccinationViewSet, basename='vaccination')
+router.register(r'vaccination-recalls', VaccinationRecallViewSet, basename='vaccinationrecall')
 router.register(r'user-files', UserFilesViewSet, basename='userfiles')
-router.register(r'medications2', MedicationViewSet, basename='medication2')
+router.register(r'medications2', Medication2ViewSet, basename='medication2')
 router.register(r'medication-reminders', MedicationReminderViewSet, basename='medicationreminder')
+router.register(r'dose-events', DoseEventViewSet, basename='doseevent')
 router.register(r'conversation', ConversationViewSet, basename='conversation')
+router.register(r'conversation/(?P<conversation_id>\d+)/messages', MessageViewSet, basename='message')
 router.register(r'pregnancies', PregnancyViewSet, basename='pregnancy')
+router.register(r'ai-chat-sessions', AIChatSessionViewSet, basename='aichatsession')
+
+admin_router = DefaultRouter()
+admin_router.register(r'imports', ImportJobViewSet, basename='importjob')
+admin_router.register(r'audit', AuditEventViewSet, basename='auditevent')
+admin_router.register(r'account-deletions', AccountDeletionViewSet, basename='accountdeletion')
+
+doctor_router = DefaultRouter()
+doctor_router.register(r'alerts', VitalsAlertViewSet, basename='vitalsalert')
 
 urlpatterns = [
+    path('health/live/', Liveness.as_view(), name='liveness'),
+    path('health/ready/', Readiness.as_view(), name='readiness'),
+    path('api/files/uploads/', DirectUpload.as_view(), name='direct-upload'),
+    path('api/files/uploads/finalize/', FinalizeUpload.as_view(), name='finalize-upload'),
     path('api/files/', include(router.urls)),
     path('api/ai-chat/', AIChat.as_view(), name='ai-chat'),
+    path('api/health-insight/', HealthInsightView.as_view(), name='health-insight'),
+    path('api/vitals/stream/', WearableVitals.as_view(), name='wearable-vitals'),
+    path('api/adherence/', AdherenceView.as_view(), name='adherence'),
+    path('api/search/', SemanticSearch.as_view(), name='semantic-search'),
+    path('api/rate-limits/', RateLimitUsage.as_view(), name='rate-limits'),
+    path('api/export/', RecordExport.as_view(), name='record-export'),
+    path('api/interactions/check/', InteractionCheck.as_view(), name='interaction-check'),
+    path('api/medications/autocomplete/', MedicationAutocomplete.as_view(), name='medication-autocomplete'),
+    path('api/account/', DeleteAccount.as_view(), name='delete-account'),
+    path('api/audit/', RecordAccessLog.as_view(), name='record-access-log'),
+    path('api/admin/', include(admin_router.urls)),
+    path('api/admin/vaccination-recalls/', VaccinationRecallList.as_view(), name='vaccination-recalls'),
+    path('api/admin/analytics/population/', PopulationAnalytics.as_view(), name='population-analytics'),
+    path('api/doctor/patients/', DoctorPatientList.as_view(), name='doctor-patients'),
+    path('api/doctor/', include(doctor_router.urls)),
 ]
\ No newline at end of file
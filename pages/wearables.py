@@ -0,0 +1,314 @@
+"""
+Wearable vitals streams: heart rate, oxygen saturation and respiratory rate.
+
+Devices send samples in columns, one payload per sync::
+
+    {"device": "watch-1", "start": "2026-10-18T08:00:00Z",
+     "signals": {"heart_rate": {"t": [0, 1000, 2000], "v": [72, 74, 73]},
+                 "oxygen_saturation": {"interval": 60000, "v": [97, 98]}}}
+
+``t`` are milliseconds after ``start`` (``interval`` spaces them evenly).
+``validate()`` checks each column with NumPy in one go and drops samples
+outside what a sensor can report; each signal is then one ``VitalsBatch``
+row holding its samples as arrays.
+
+Rows are not written by the request.  A per-process writer thread collects
+the batches of concurrent requests for up to ``WEARABLE_FLUSH_MS`` (or
+``WEARABLE_FLUSH_SAMPLES`` samples) and inserts them per shard with one
+``bulk_create`` in one transaction.  Each request waits for the commit of
+its batches before it is acknowledged, so an acknowledged sample is stored;
+a retried payload is stored once.  After the commit, the newest sample of
+each signal becomes the patient's current vitals in ``UserFiles``, which
+runs the alert rules and refreshes doctors' patient lists.
+"""
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from . import alerts, analytics, sharding, summaries
+from .models import UserFiles, VitalsBatch
+
+logger = logging.getLogger(__name__)
+
+# What a sensor can report, inclusive; anything else is an artefact.
+SIGNALS = {
+    'heart_rate': (20, 250),
+    'oxygen_saturation': (50, 100),
+    'respiratory_rate': (4, 60),
+}
+
+MAX_SAMPLES = 10000
+MAX_SPAN_MS = 24 * 60 * 60 * 1000
+
+OFFSET_DTYPE = np.dtype('<u4')
+VALUE_DTYPE = np.dtype('<f2')
+
+
+def _start(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Epoch milliseconds.
+        try:
+            return datetime.datetime.fromtimestamp(value / 1000, tz=datetime.timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise ValidationError({'start': ["Epoch milliseconds out of range."]})
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None or timezone.is_naive(parsed):
+        raise ValidationError({'start': ["Give an ISO 8601 time with a UTC offset, or epoch milliseconds."]})
+    return parsed
+
+
+def _column(series, key, dtype):
+    try:
+        column = np.asarray(series[key], dtype=dtype)
+    except (TypeError, ValueError, OverflowError):
+        raise ValidationError({key: ["Must be a list of numbers."]})
+    if column.ndim != 1:
+        raise ValidationError({key: ["Must be a flat list of numbers."]})
+    return column
+
+
+def _offsets(name, series, size):
+    if 't' in series:
+        offsets = _column(series, 't', np.int64)
+        if offsets.size != size:
+            raise ValidationError({name: ["'t' and 'v' must have the same length."]})
+        if size and (offsets[0] < 0 or np.any(np.diff(offsets) < 0)):
+            raise ValidationError({name: ["'t' must be ascending milliseconds after start."]})
+        return offsets
+    interval = series.get('interval')
+    if not isinstance(interval, int) or isinstance(interval, bool) or interval <= 0:
+        raise ValidationError({name: ["Give 't' or a positive 'interval' in milliseconds."]})
+    return np.arange(size, dtype=np.int64) * interval
+
+
+def validate(user, payload):
+    """``(unsaved VitalsBatch rows, samples dropped)`` for one payload."""
+    if not isinstance(payload, dict):
+        raise ValidationError({'non_field_errors': ["Expected an object."]})
+    start = _start(payload.get('start'))
+    device = str(payload.get('device') or '')[:64]
+    signals = payload.get('signals')
+    if not isinstance(signals, dict) or not signals:
+        raise ValidationError({'signals': ["Give at least one signal."]})
+    unknown = set(signals) - set(SIGNALS)
+    if unknown:
+        raise ValidationError({'signals': [f"Unknown: {', '.join(sorted(unknown))}. Use {', '.join(SIGNALS)}."]})
+
+    batches = []
+    dropped = 0
+    for name, series in signals.items():
+        if not isinstance(series, dict) or 'v' not in series:
+            raise ValidationError({name: ["Give the samples as 'v'."]})
+        values = _column(series, 'v', np.float64)
+        if values.size > MAX_SAMPLES:
+            raise ValidationError({name: [f"At most {MAX_SAMPLES} samples per signal and payload."]})
+        offsets = _offsets(name, series, values.size)
+        if values.size and offsets[-1] - offsets[0] > MAX_SPAN_MS:
+            raise ValidationError({name: ["A payload may span at most 24 hours."]})
+
+        low, high = SIGNALS[name]
+        plausible = np.isfinite(values) & (values >= low) & (values <= high)
+        dropped += int(values.size - np.count_nonzero(plausible))
+        values, offsets = values[plausible], offsets[plausible]
+        if not values.size:
+            continue
+        first = int(offsets[0])
+        starts_at = start + datetime.timedelta(milliseconds=first)
+        offsets = offsets - first
+        batches.append(VitalsBatch(
+            user=user,
+            signal=name,
+            device=device,
+            starts_at=starts_at,
+            ends_at=starts_at + datetime.timedelta(milliseconds=int(offsets[-1])),
+            count=int(values.size),
+            offsets=offsets.astype(OFFSET_DTYPE).tobytes(),
+            values=values.astype(VALUE_DTYPE).tobytes(),
+            minimum=float(values.min()),
+            maximum=float(values.max()),
+            mean=float(values.mean()),
+        ))
+    return batches, dropped
+
+
+def _aware(moment):
+    return timezone.make_aware(moment, datetime.timezone.utc) if timezone.is_naive(moment) else moment
+
+
+def _epoch_ms(moment):
+    return round(_aware(moment).timestamp() * 1000)
+
+
+def samples(batch):
+    """``(epoch milliseconds, values)`` of a stored batch as NumPy arrays."""
+    offsets = np.frombuffer(bytes(batch.offsets), dtype=OFFSET_DTYPE)
+    return _epoch_ms(batch.starts_at) + offsets.astype(np.int64), np.frombuffer(bytes(batch.values), dtype=VALUE_DTYPE)
+
+
+def series(user, signal, since, until, max_batches=500):
+    """``(epoch milliseconds, values)`` lists of ``user``'s ``signal`` samples between two times."""
+    since, until = _aware(since), _aware(until)
+    batches = VitalsBatch.objects.using(sharding.shard_for_user(user)).filter(
+        user=user, signal=signal, ends_at__gte=since, starts_at__lte=until
+    ).order_by('starts_at')[:max_batches]
+    low, high = _epoch_ms(since), _epoch_ms(until)
+    times, values = [], []
+    for batch in batches:
+        batch_times, batch_values = samples(batch)
+        within = (batch_times >= low) & (batch_times <= high)
+        times.extend(batch_times[within].tolist())
+        values.extend(batch_values[within].tolist())
+    return times, values
+
+
+def update_current_vitals(alias, batches):
+    """Make the newest sample of each signal the patients' current vitals."""
+    newest = {}
+    for batch in batches:
+        latest = newest.setdefault(batch.user_id, {'at': batch.ends_at, 'values': {}})
+        latest['at'] = max(latest['at'], batch.ends_at)
+        value = float(np.frombuffer(bytes(batch.values), dtype=VALUE_DTYPE)[-1])
+        previous = latest['values'].get(batch.signal)
+        if previous is None or batch.ends_at >= previous[0]:
+            latest['values'][batch.signal] = (batch.ends_at, round(value))
+
+    changed = []
+    for user_id, latest in newest.items():
+        # Only samples newer than the last change: a device syncing
+        # yesterday's data doesn't overwrite a reading taken since.
+        fields = {signal: value for signal, (at, value) in latest['values'].items()}
+        if UserFiles.objects.using(alias).filter(user_id=user_id, updated_at__lt=latest['at']).update(
+            **fields, updated_at=timezone.now()
+        ):
+            changed.append(user_id)
+    if not changed:
+        return
+    updated = list(UserFiles.objects.using(alias).filter(user_id__in=changed))
+    alerts.vitals_written(updated, alias)
+    analytics.mark_stale()
+    for user_files in updated:
+        summaries.refresh(user_files.user_id, ['vitals'], using=alias)
+
+
+class Pending:
+    """Batches of one request, waiting for their commit."""
+
+    def __init__(self, alias, batches):
+        self.alias = alias
+        self.batches = batches
+        self.done = threading.Event()
+        self.error = None
+
+
+class VitalsWriter:
+    def __init__(self, flush_samples, flush_seconds):
+        self.flush_samples = flush_samples
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def submit(self, pending, timeout):
+        """Queue ``pending`` and wait for its commit; raises if it failed or timed out."""
+        self._ensure_started()
+        self.queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError("The samples were not stored in time.")
+        if pending.error is not None:
+            raise pending.error
+
+    def _ensure_started(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='vitals-writer', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            group = [self.queue.get()]
+            size = sum(batch.count for batch in group[0].batches)
+            deadline = time.monotonic() + self.flush_seconds
+            while size < self.flush_samples:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                group.append(pending)
+                size += sum(batch.count for batch in pending.batches)
+            try:
+                self.write(group)
+            except Exception as error:
+                # Keep the thread alive; whoever still waits gets the error.
+                logger.exception("The vitals writer failed")
+                for pending in group:
+                    if not pending.done.is_set():
+                        pending.error = error
+                        pending.done.set()
+            finally:
+                close_old_connections()
+
+    def write(self, group):
+        by_alias = {}
+        for pending in group:
+            by_alias.setdefault(pending.alias, []).append(pending)
+        for alias, waiting in by_alias.items():
+            batches = [batch for pending in waiting for batch in pending.batches]
+            try:
+                with transaction.atomic(using=alias):
+                    VitalsBatch.objects.using(alias).bulk_create(batches, batch_size=500, ignore_conflicts=True)
+            except Exception as error:
+                logger.error("Could not store %d vitals batches", len(batches), exc_info=error)
+                for pending in waiting:
+                    pending.error = error
+                    pending.done.set()
+                continue
+            for pending in waiting:
+                pending.done.set()
+            try:
+                update_current_vitals(alias, batches)
+            except Exception:
+                logger.exception("Could not update current vitals after storing samples")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    # A forked worker starts with a copy of the parent's queue but no thread.
+    if _writer is None or _writer.pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid():
+                _writer = VitalsWriter(
+                    flush_samples=getattr(settings, 'WEARABLE_FLUSH_SAMPLES', 50000),
+                    flush_seconds=getattr(settings, 'WEARABLE_FLUSH_MS', 50) / 1000,
+                )
+    return _writer
+
+
+def store(user, batches):
+    """Write ``batches`` durably, together with other requests' unless buffering is off."""
+    alias = sharding.shard_for_user(user)
+    if not getattr(settings, 'WEARABLE_BUFFERED', True):
+        with transaction.atomic(using=alias):
+            VitalsBatch.objects.using(alias).bulk_create(batches, ignore_conflicts=True)
+        update_current_vitals(alias, batches)
+        return
+    get_writer().submit(Pending(alias, batches), timeout=getattr(settings, 'WEARABLE_WRITE_TIMEOUT', 10))
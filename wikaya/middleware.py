@@ -1,6 +1,71 @@
+import logging
+
+from django.http import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
+from pages import audit, loadshed, profiling
+
+logger = logging.getLogger(__name__)
 
 class DisableCSRFForAPI(MiddlewareMixin):
     def process_request(self, request):
         if request.path.startswith('/auth/'):
-            setattr(request, '_dont_enforce_csrf_checks', True)
\ No newline at end of file
+            setattr(request, '_dont_enforce_csrf_checks', True)
+
+class AuditMiddleware:
+    """Queues an audit event for each request to medical record endpoints, see pages/audit.py."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if audit.audited(request):
+            audit.record_request(request, response)
+        return response
+
+class LoadSheddingMiddleware:
+    """Sheds low-priority requests with a 503 when the worker is overloaded, see pages/loadshed.py."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        tier = loadshed.classify(request)
+        if tier is None:
+            return self.get_response(request)
+        started = loadshed.tracker.admit(tier, loadshed.queue_ms(request))
+        if started is None:
+            response = JsonResponse(
+                {'detail': 'The service is busy, please try again shortly.'}, status=503
+            )
+            response['Retry-After'] = str(loadshed.retry_after(tier))
+            return response
+        try:
+            return self.get_response(request)
+        finally:
+            loadshed.tracker.release(tier, started)
+
+
+class ProfilingMiddleware:
+    """Profiles requests staff ask for and a random sample of the rest, see pages/profiling.py."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if profiling.requested(request):
+            trigger = 'requested' if profiling.is_staff(request) else None
+        else:
+            trigger = 'sampled' if profiling.sampled() else None
+        if trigger is None:
+            return self.get_response(request)
+        with profiling.Profile(trigger) as profile:
+            response = self.get_response(request)
+        try:
+            saved = profile.save(request, response)
+        except Exception:
+            logger.exception("Could not save the profile of %s", request.path)
+            return response
+        if trigger == 'requested':
+            response['X-Profile-Id'] = str(saved.pk)
+        return response
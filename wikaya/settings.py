@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 
@@ -72,6 +73,8 @@ SITE_ID = 1
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # First after security, so shed requests cost next to nothing.
+    'wikaya.middleware.LoadSheddingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -83,9 +86,12 @@ MIDDLEWARE = [
     'wikaya.middleware.DisableCSRFForAPI',
 
     'allauth.account.middleware.AccountMiddleware',
+    'wikaya.middleware.AuditMiddleware',
     
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Last, so profiles cover the view and not the other middleware.
+    'wikaya.middleware.ProfilingMiddleware',
 ]
 
 CORS_ALLOWED_ORIGINS = [
@@ -188,6 +194,176 @@ DATABASES = {
     }
 }
 
+# Horizontal sharding of patient data, see pages/sharding.py.
+# PATIENT_SHARDS lists the database aliases that hold patient records;
+# CustomUser and the auth tables always stay on 'default'.  Workers learn of
+# moved patients through the default cache, so with several processes it
+# must be a shared one (Redis, Memcached).
+PATIENT_SHARDS = ['default']
+
+# Set WIKAYA_SQLITE_SHARDS=N to run locally against N SQLite shards.
+SQLITE_SHARDS = int(os.environ.get('WIKAYA_SQLITE_SHARDS', '0'))
+if SQLITE_SHARDS:
+    PATIENT_SHARDS = [f'shard_{i}' for i in range(SQLITE_SHARDS)]
+    DATABASES = {
+        alias: {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / ('db.sqlite3' if alias == 'default' else f'{alias}.sqlite3'),
+        }
+        for alias in ['default', *PATIENT_SHARDS]
+    }
+
+DATABASE_ROUTERS = ['pages.sharding.PatientShardRouter']
+
+# Messages newer than this stay in the partitioned Message table; older ones
+# are moved to MessageArchive by `manage.py archive_messages`.
+MESSAGE_HOT_WINDOW_DAYS = 180
+MESSAGE_PARTITION_MONTHS_AHEAD = 3
+
+# Vitals alerting (see pages/alerts.py). VITALS_ALERT_RULES replaces the
+# default rules; past the rate limit, new alerts for a patient are recorded
+# but not shown to doctors until the window ends.
+VITALS_ALERT_RATE_LIMIT = 5
+VITALS_ALERT_RATE_WINDOW = 60 * 60
+
+# Drug interaction dataset and the binary index compiled from it, which
+# every worker memory-maps (see pages/interactions.py).
+INTERACTIONS_DATASET = BASE_DIR / 'pages' / 'data' / 'interactions.json'
+INTERACTIONS_INDEX = BASE_DIR / 'interactions.idx'
+
+# Medication autocomplete: time allowed for typo matching per query, how
+# often each worker rebuilds its index from the database, and how many
+# patients must use a name outside the dictionary before it is suggested.
+AUTOCOMPLETE_BUDGET_MS = 5
+AUTOCOMPLETE_REBUILD_SECONDS = 600
+AUTOCOMPLETE_MIN_PATIENTS = 5
+
+# Token-bucket rate limits per user and scope (see pages/ratelimit.py):
+# sustained rate, burst size and requests per UTC day. 'memory' keeps the
+# buckets per worker; 'cache' shares them through RATE_LIMIT_CACHE.
+RATE_LIMIT_BACKEND = os.environ.get('WIKAYA_RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_CACHE = 'default'
+RATE_LIMITS = {
+    'ai-chat': {'rate': '6/min', 'burst': 3, 'daily': 50},
+    'messages': {'rate': '30/min', 'burst': 20, 'daily': 2000},
+}
+
+
+# Worker boot budget checked by `manage.py profile_startup`, and modules that
+# must not be imported during boot (they load on first use, see pages/lazy.py).
+STARTUP_BUDGET_MS = 1200
+STARTUP_DEFERRED_MODULES = ['google.generativeai', 'numpy']
+
+# Audit trail (see pages/audit.py). Events for requests under these paths are
+# queued and written in batches by a background thread; a request waits at
+# most AUDIT_BLOCK_MS for room in a full queue before writing its own event.
+AUDIT_ENABLED = True
+AUDIT_PATH_PREFIXES = ['/api/', '/admin/pages/', '/admin/accounts/']
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_SECONDS = 1.0
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_BLOCK_MS = 50
+
+# AI chat (see pages/aichat.py). AI_CHAT_LLM is the model backend, e.g.
+# 'pages.aichat.StubLLM' for tests. Turns past AI_CHAT_RECENT_TOKENS are
+# folded into a summary of at most AI_CHAT_SUMMARY_TOKENS. GeminiLLM needs
+# GEMINI_API_KEY from the environment.
+AI_CHAT_LLM = os.environ.get('WIKAYA_AI_CHAT_LLM', 'pages.aichat.GeminiLLM')
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
+GEMINI_MODEL = 'gemini-2.0-flash'
+AI_CHAT_MAX_PROMPT_TOKENS = 1000
+AI_CHAT_RECENT_TOKENS = 1500
+AI_CHAT_SUMMARY_TOKENS = 300
+AI_CHAT_SUMMARIZE_IN_BACKGROUND = True
+
+# Nightly health insights (`manage.py generate_health_insights`, see
+# pages/insights.py): concurrent LLM calls, and attempts per patient with
+# exponential backoff starting at INSIGHTS_BACKOFF_SECONDS. INSIGHTS_LLM
+# defaults to AI_CHAT_LLM.
+INSIGHTS_LLM = os.environ.get('WIKAYA_INSIGHTS_LLM')
+INSIGHTS_CONCURRENCY = 8
+INSIGHTS_MAX_ATTEMPTS = 4
+INSIGHTS_BACKOFF_SECONDS = 1.0
+
+# Semantic search over patients' notes (pages/semantic.py).  The embedder is
+# any class with a ``name``, ``dimensions`` and ``embed(texts)`` returning unit
+# vectors; changing it needs ``manage.py build_semantic_index``.  Each worker
+# keeps a searched patient's vectors in memory for SEMANTIC_CACHE_SECONDS.
+SEMANTIC_EMBEDDER = 'pages.semantic.HashingEmbedder'
+SEMANTIC_DIMENSIONS = 512
+SEMANTIC_CACHE_SECONDS = 300
+
+# Lab values are read from uploaded lab reports by this many processes per
+# worker (pages/labs.py), outside the request unless
+# LAB_EXTRACTION_IN_BACKGROUND is off.  A report taking longer than
+# LAB_EXTRACTION_TIMEOUT seconds is marked failed.
+LAB_EXTRACTION_WORKERS = 2
+LAB_EXTRACTION_IN_BACKGROUND = True
+LAB_EXTRACTION_TIMEOUT = 60
+
+# Medical files go to S3-compatible object storage (pages/objectstore.py)
+# when WIKAYA_OBJECT_STORAGE_BUCKET is set, e.g. a local MinIO with
+# ENDPOINT http://localhost:9000.  Clients can then upload lab reports and
+# imaging straight to the bucket through /api/files/uploads/, with forms valid
+# for UPLOAD_URL_SECONDS and files of at most UPLOAD_MAX_BYTES.
+OBJECT_STORAGE = {
+    'ENDPOINT': os.environ.get('WIKAYA_OBJECT_STORAGE_ENDPOINT', 'https://s3.amazonaws.com'),
+    'BUCKET': os.environ.get('WIKAYA_OBJECT_STORAGE_BUCKET', ''),
+    'REGION': os.environ.get('WIKAYA_OBJECT_STORAGE_REGION', 'us-east-1'),
+    'ACCESS_KEY': os.environ.get('WIKAYA_OBJECT_STORAGE_ACCESS_KEY', ''),
+    'SECRET_KEY': os.environ.get('WIKAYA_OBJECT_STORAGE_SECRET_KEY', ''),
+    'ADDRESSING': os.environ.get('WIKAYA_OBJECT_STORAGE_ADDRESSING', 'path'),
+}
+if OBJECT_STORAGE['BUCKET']:
+    STORAGES = {
+        'default': {'BACKEND': 'pages.objectstore.S3Storage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    }
+UPLOAD_URL_SECONDS = 15 * 60
+UPLOAD_MAX_BYTES = 100 * 1024 * 1024
+
+# Deleted accounts are purged in the background (pages/deletion.py), this
+# many rows per table and transaction at a time.
+ACCOUNT_PURGE_BATCH_SIZE = 1000
+ACCOUNT_PURGE_IN_BACKGROUND = True
+
+# Vaccination recall (see pages/recalls.py): how many days ahead due doses
+# are listed and reminded by `manage.py notify_vaccination_recalls`, and
+# whether reminders are also emailed.
+VACCINATION_RECALL_DAYS = 14
+VACCINATION_RECALL_EMAIL = False
+
+# Doses not recorded this long after their time count as missed when
+# `manage.py record_missed_doses` runs (see pages/adherence.py).
+ADHERENCE_GRACE_MINUTES = 120
+
+# Wearable vitals (see pages/wearables.py): each worker writes the samples of
+# concurrent requests together, after at most WEARABLE_FLUSH_MS or once
+# WEARABLE_FLUSH_SAMPLES have come in. Requests wait up to
+# WEARABLE_WRITE_TIMEOUT seconds for the write before answering 503.
+WEARABLE_BUFFERED = True
+WEARABLE_FLUSH_MS = 50
+WEARABLE_FLUSH_SAMPLES = 50000
+WEARABLE_WRITE_TIMEOUT = 10
+
+# Load shedding per worker process (see pages/loadshed.py): requests it can
+# run at once (its threads). LOAD_SHEDDING_TIERS and LOAD_SHEDDING_ROUTES
+# replace the tiers and routes defined there.
+LOAD_SHEDDING_ENABLED = True
+LOAD_SHEDDING_CAPACITY = int(os.environ.get('WIKAYA_WORKER_THREADS', 8))
+
+# Request profiling (see pages/profiling.py): staff ask for it with an
+# X-Profile header; PROFILING_SAMPLE_RATE also profiles that fraction of all
+# requests. Profiles are kept PROFILING_RETENTION_DAYS with their slowest
+# PROFILING_MAX_QUERIES statements.
+PROFILING_SAMPLE_RATE = float(os.environ.get('WIKAYA_PROFILING_SAMPLE_RATE', 0))
+PROFILING_INTERVAL_MS = 5
+PROFILING_MAX_QUERIES = 50
+PROFILING_RETENTION_DAYS = 7
+
+# Admin changelists count rows exactly only below this many; larger results
+# show the PostgreSQL planner's estimate instead (see pages/admin.py).
+ADMIN_EXACT_COUNT_LIMIT = 100000
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators